@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк пути perform_attack: новое соединение на каждый вызов, пул
+соединений и хранилище в памяти (MemoryStorage). Плюс параллельные записи
+add_item: своя транзакция в каждом потоке против писателя с group commit.
+
+Запуск:
+    python bench_db.py [кол-во атак]
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="rq_bench_"), "bench.db")
+
+import bot  # noqa: E402
+
+CHAT_ID = 1
+USER_ID = 1
+
+
+def run_attacks(pool_size: int, attacks: int) -> float:
+    bot.db_pool.close_all()
+    bot.db_pool = bot.ConnectionPool(bot.DB_PATH, pool_size)
+    random.seed(42)
+
+    started = time.perf_counter()
+    for _ in range(attacks):
+        if not bot.get_active_battle(CHAT_ID, USER_ID):
+            bot.start_battle(CHAT_ID, USER_ID, "dark_forest")
+        bot.perform_attack(CHAT_ID, USER_ID, "bench")
+    return time.perf_counter() - started
+
+
+def run_attacks_in_memory(attacks: int) -> float:
+    bot.storage = bot.MemoryStorage()
+    bot.player_cache = bot.PlayerCache(bot.PLAYER_CACHE_SIZE, bot.PLAYER_CACHE_FLUSH_SEC, bot.PLAYER_JOURNAL_PATH)
+    bot.init_player(CHAT_ID, USER_ID, "bench", "warrior")
+    random.seed(42)
+
+    started = time.perf_counter()
+    for _ in range(attacks):
+        if not bot.get_active_battle(CHAT_ID, USER_ID):
+            bot.start_battle(CHAT_ID, USER_ID, "dark_forest")
+        bot.perform_attack(CHAT_ID, USER_ID, "bench")
+    return time.perf_counter() - started
+
+
+def run_concurrent_writes(writers: int, writes: int, via_writer: bool) -> float:
+    def one(i: int):
+        user_id = 1000 + i % writers
+        if via_writer:
+            bot.db_writer.call(bot.add_item, CHAT_ID, user_id, "copper_bar")
+        else:
+            with bot.storage.transaction():
+                bot.add_item(CHAT_ID, user_id, "copper_bar")
+
+    if via_writer:
+        bot.db_writer.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=writers) as pool:
+        list(pool.map(one, range(writes)))
+    elapsed = time.perf_counter() - started
+    if via_writer:
+        bot.db_writer.close()
+    return elapsed
+
+
+def main():
+    attacks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    logging.getLogger("RuneQuestRPG").setLevel(logging.WARNING)
+
+    bot.migrate_database()
+    bot.init_player(CHAT_ID, USER_ID, "bench", "warrior")
+
+    per_call = run_attacks(0, attacks)
+    pooled = run_attacks(bot.DB_POOL_SIZE, attacks)
+    bot.player_cache.close()
+    in_memory = run_attacks_in_memory(attacks)
+
+    print(f"perform_attack x{attacks}")
+    print(f"  connect на вызов: {per_call:.3f} с ({per_call / attacks * 1e6:.0f} мкс/атака)")
+    print(f"  пул ({bot.DB_POOL_SIZE}):       {pooled:.3f} с ({pooled / attacks * 1e6:.0f} мкс/атака)")
+    print(f"  память:         {in_memory:.3f} с ({in_memory / attacks * 1e6:.0f} мкс/атака)")
+    print(f"  ускорение: x{per_call / pooled:.2f}")
+
+    bot.storage = bot.SQLiteStorage()
+    writers = bot.DB_POOL_SIZE
+    direct = run_concurrent_writes(writers, attacks, via_writer=False)
+    grouped = run_concurrent_writes(writers, attacks, via_writer=True)
+    print(f"add_item x{attacks}, {writers} потоков")
+    print(f"  транзакция на запись: {direct:.3f} с ({attacks / direct:.0f} записей/с)")
+    print(f"  писатель + group commit: {grouped:.3f} с ({attacks / grouped:.0f} записей/с)")
+    print(f"  {bot.db_writer.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,18 +15,34 @@ RuneQuestRPG v6.1 УЛУЧШЕННЫЙ — RPG Telegram Bot с интуитив
 
 import os
 import sys
+import json
+import struct
 import sqlite3
 import random
 import logging
 import signal
+import queue
+import time
+import heapq
+import asyncio
+import calendar
 import threading
-from typing import Optional, Dict, Any, Callable, List, Tuple
+import itertools
+import contextvars
+import multiprocessing
+from typing import Optional, Dict, Any, Callable, Deque, Iterable, Iterator, List, Tuple, Union
+from abc import ABC, abstractmethod
+from bisect import bisect_right
 from functools import wraps
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
 from datetime import datetime, timedelta
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 import uvicorn
 
 from telegram import (
@@ -34,11 +50,13 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
 )
 
 # ===================== КОНФИГ =====================
@@ -51,6 +69,59 @@ if not BOT_TOKEN:
 PORT = int(os.getenv("PORT", "10000"))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
+DB_PATH = os.getenv("DB_PATH", "runequestrpg.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_STATEMENT_CACHE = 256
+# FULL — fsync WAL на каждом COMMIT: зафиксированное переживёт и отключение
+# питания. NORMAL быстрее, но последние транзакции при сбое ОС могут пропасть.
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL").upper()
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"❌ DB_SYNCHRONOUS: ожидается OFF, NORMAL, FULL или EXTRA, получено {DB_SYNCHRONOUS}")
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))
+# Апдейты обрабатываются параллельно; по умолчанию вдвое больше потоков БД,
+# чтобы пока одни ждут db_call, другие отвечали в Telegram
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", str(DB_THREADS * 2)))
+DB_QUEUE_WARN_MS = int(os.getenv("DB_QUEUE_WARN_MS", "500"))
+DB_SLOW_QUERY_MS = int(os.getenv("DB_SLOW_QUERY_MS", "200"))
+DB_GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS", "0"))
+DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "256"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", str(PORT)))
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", "10000"))
+PLAYER_CACHE_FLUSH_SEC = float(os.getenv("PLAYER_CACHE_FLUSH_SEC", "2"))
+PLAYER_JOURNAL_PATH = DB_PATH + ".journal"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+BATTLE_IDLE_TTL_SEC = float(os.getenv("BATTLE_IDLE_TTL_SEC", "1800"))
+BATTLE_CHECKPOINT_SEC = float(os.getenv("BATTLE_CHECKPOINT_SEC", "30"))
+FIGHT_RECORDS_KEPT = int(os.getenv("FIGHT_RECORDS_KEPT", "1000"))
+EXPEDITION_MAX_HUNTS = int(os.getenv("EXPEDITION_MAX_HUNTS", "50"))
+EXPEDITION_MAX_ACTIVE = int(os.getenv("EXPEDITION_MAX_ACTIVE", "1"))
+EXPEDITION_SEC_PER_HUNT = float(os.getenv("EXPEDITION_SEC_PER_HUNT", "3"))
+SWEEP_INTERVAL_SEC = float(os.getenv("SWEEP_INTERVAL_SEC", "600"))
+SWEEP_CHUNK_ROWS = int(os.getenv("SWEEP_CHUNK_ROWS", "200"))
+DUNGEON_IDLE_TTL_SEC = float(os.getenv("DUNGEON_IDLE_TTL_SEC", "86400"))
+PVP_QUEUE_TTL_SEC = float(os.getenv("PVP_QUEUE_TTL_SEC", "900"))
+PVP_MMR_START = int(os.getenv("PVP_MMR_START", "1000"))
+PVP_MMR_PER_LEVEL = int(os.getenv("PVP_MMR_PER_LEVEL", "10"))
+PVP_MMR_K = int(os.getenv("PVP_MMR_K", "32"))
+PVP_MMR_BUCKET = int(os.getenv("PVP_MMR_BUCKET", "25"))
+PVP_MMR_WINDOW = int(os.getenv("PVP_MMR_WINDOW", "100"))
+PVP_MMR_WINDOW_MAX = int(os.getenv("PVP_MMR_WINDOW_MAX", "400"))
+PVP_MMR_WIDEN_STEP = int(os.getenv("PVP_MMR_WIDEN_STEP", "25"))
+PVP_WINDOW_WIDEN_SEC = float(os.getenv("PVP_WINDOW_WIDEN_SEC", "30"))
+TOURNAMENT_WORKERS = int(os.getenv("TOURNAMENT_WORKERS", "2"))
+TOURNAMENT_CHUNK_FIGHTS = int(os.getenv("TOURNAMENT_CHUNK_FIGHTS", "64"))
+TOURNAMENT_MIN_ENTRANTS = int(os.getenv("TOURNAMENT_MIN_ENTRANTS", "4"))
+TOURNAMENT_MAX_ENTRANTS = int(os.getenv("TOURNAMENT_MAX_ENTRANTS", "1024"))
+TOURNAMENT_SWISS_ROUNDS = int(os.getenv("TOURNAMENT_SWISS_ROUNDS", "0"))
+TOURNAMENT_PRIZE_PER_ENTRANT = int(os.getenv("TOURNAMENT_PRIZE_PER_ENTRANT", "20"))
+NOTIFY_RATE_PER_SEC = float(os.getenv("NOTIFY_RATE_PER_SEC", "25"))
+NOTIFY_CHAT_INTERVAL_SEC = float(os.getenv("NOTIFY_CHAT_INTERVAL_SEC", "1"))
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "5000"))
+COMBAT_LOG_DIR = os.getenv("COMBAT_LOG_DIR", DB_PATH + ".combat")
+COMBAT_LOG_SEGMENT_BYTES = int(os.getenv("COMBAT_LOG_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+COMBAT_LOG_SEGMENTS_KEPT = int(os.getenv("COMBAT_LOG_SEGMENTS_KEPT", "64"))
+COMBAT_LOG_FLUSH_SEC = float(os.getenv("COMBAT_LOG_FLUSH_SEC", "1"))
+
 if not os.path.exists("logs"):
     os.makedirs("logs", exist_ok=True)
 
@@ -67,6 +138,9 @@ logger = logging.getLogger("RuneQuestRPG")
 MAX_LEVEL = 100
 LEVEL_UP_BASE = 100
 STATS_PER_LEVEL = {"health": 20, "mana": 15, "attack": 5, "defense": 2}
+AUTO_BATTLE_LOG_ROUNDS = 12
+DUNGEON_RUN_FLOORS = 30
+DUNGEON_BOSS_EVERY = 10
 
 # ===================== ENUM И КЛАССЫ =====================
 
@@ -661,486 +735,3101 @@ LOCATIONS: Dict[str, Dict[str, Any]] = {
     },
 }
 
+# ===================== ПРОГРЕССИЯ =====================
+#
+# Таблицы строятся один раз при импорте. Индекс — уровень (1..MAX_LEVEL),
+# нулевой элемент не используется:
+#   XP_TO_NEXT[L]    — опыт, нужный для перехода с L на L+1
+#   CUMULATIVE_XP[L] — суммарный опыт от 1-го уровня до L
+#   STAT_GAINS[L]    — прибавка STATS_PER_LEVEL, накопленная к уровню L
+
+XP_TO_NEXT: List[int] = [0] + [int(LEVEL_UP_BASE * (level ** 1.5)) for level in range(1, MAX_LEVEL + 1)]
+
+CUMULATIVE_XP: List[int] = [0, 0]
+for _level in range(2, MAX_LEVEL + 1):
+    CUMULATIVE_XP.append(CUMULATIVE_XP[-1] + XP_TO_NEXT[_level - 1])
+del _level
+
+STAT_GAINS: List[Dict[str, int]] = [{}] + [
+    {stat: per_level * (level - 1) for stat, per_level in STATS_PER_LEVEL.items()}
+    for level in range(1, MAX_LEVEL + 1)
+]
+
+
+def total_xp(level: int, xp: int) -> int:
+    """Весь набранный опыт: пройденные уровни плюс текущий остаток"""
+    return CUMULATIVE_XP[level] + xp
+
+
+def level_for_total_xp(total: int) -> int:
+    """Уровень по суммарному опыту — бинарный поиск по CUMULATIVE_XP"""
+    return min(MAX_LEVEL, bisect_right(CUMULATIVE_XP, total, lo=1) - 1)
+
+
+def level_progress(level: int, xp: int) -> Tuple[int, int, float]:
+    """(опыт на уровне, нужно до следующего, доля 0..1); на MAX_LEVEL доля 1.0"""
+    if level >= MAX_LEVEL:
+        return xp, 0, 1.0
+    needed = XP_TO_NEXT[level]
+    return xp, needed, min(1.0, xp / needed)
+
+
+def progress_bar(fraction: float, width: int = 10) -> str:
+    filled = int(round(fraction * width))
+    return "▰" * filled + "▱" * (width - filled)
+
+
 # ===================== БД =====================
 
-def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect("runequestrpg.db", timeout=30, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    return conn
+# Снимок текущего апдейта (см. UpdateSnapshot): по нему считаются обращения к SQLite
+current_snapshot: "contextvars.ContextVar[Optional[UpdateSnapshot]]" = contextvars.ContextVar(
+    "current_snapshot", default=None
+)
+
+
+def _on_statement(statement: str):
+    """Trace-колбэк SQLite: счётчик запросов апдейта и буфер для лога медленных вызовов"""
+    snap = current_snapshot.get()
+    if snap is not None:
+        snap.db_round_trips += 1
+    db_metrics.trace(statement)
+
+
+class ConnectionPool:
+    """Ограниченный пул долгоживущих соединений SQLite.
+
+    PRAGMA применяются один раз при создании соединения, подготовленные
+    запросы кешируются самим sqlite3 (cached_statements). Вложенные вызовы
+    в одном потоке переиспользуют уже выданное соединение.
+    При size=0 пул отключён: соединение открывается и закрывается на каждый вызов.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.set_trace_callback(_on_statement)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        if self.size <= 0:
+            return self._connect()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=30)
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        if self.size <= 0:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Соединение на время блока: commit при выходе, rollback при ошибке"""
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self.acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Единица работы: все вызовы БД внутри блока идут одной BEGIN IMMEDIATE…COMMIT"""
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+
+        with db_write_lock:
+            conn = self.acquire()
+            self._local.conn = conn
+            self._local.undo = []
+            self._local.commit = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                yield conn
+                conn.commit()
+                committed = self._local.commit
+            except Exception:
+                conn.rollback()
+                for undo in reversed(self._local.undo):
+                    undo()
+                raise
+            finally:
+                self._local.conn = None
+                self._local.undo = None
+                self._local.commit = None
+                self.release(conn)
+            run_commit_hooks(committed)
+
+    def in_use(self) -> bool:
+        return getattr(self._local, "conn", None) is not None
+
+    def on_rollback(self, undo: Callable):
+        """Регистрирует откат внешнего (не SQLite) состояния для текущей транзакции"""
+        pending = getattr(self._local, "undo", None)
+        if pending is not None:
+            pending.append(undo)
+
+    def on_commit(self, action: Callable):
+        """Выполняет action после COMMIT текущей транзакции; вне транзакции — сразу"""
+        pending = getattr(self._local, "commit", None)
+        if pending is None:
+            action()
+        else:
+            pending.append(action)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+# Транзакции записи в процессе идут строго по одной: SQLite всё равно
+# пропускает только одного писателя, а держать блокировку до конца хуков
+# COMMIT нужно, чтобы следующая транзакция видела их результат (кеш игроков
+# применяет изменения именно там).
+db_write_lock = threading.RLock()
+
+
+def run_commit_hooks(actions: List[Callable]):
+    for action in actions:
+        try:
+            action()
+        except Exception as e:
+            logger.error(f"Ошибка хука после COMMIT: {e}")
+
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+
+def db_connection():
+    return db_pool.connection()
+
+
+def db_transaction():
+    return db_pool.transaction()
+
+
+def transactional(func: Callable) -> Callable:
+    """Выполняет функцию целиком в одной транзакции хранилища"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with storage.transaction():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class DBMetrics:
+    """Метрики функций БД, обёрнутых в safedb_execute.
+
+    По каждой функции: число вызовов, ошибок, суммарное и максимальное время
+    и гистограмма задержек по LATENCY_BUCKETS_MS. Вызовы дольше slow_ms
+    пишутся в лог с аргументами и выполненными SQL-запросами (trace-колбэк
+    соединения отдаёт их уже с подставленными параметрами).
+    """
+
+    LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+    MAX_TRACED_STATEMENTS = 50
+
+    def __init__(self, slow_ms: int):
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._functions: Dict[str, Dict[str, Any]] = {}
+        self.slow_calls = 0
+
+    def trace(self, statement: str):
+        buffer = getattr(self._local, "statements", None)
+        if buffer is not None and len(buffer) < self.MAX_TRACED_STATEMENTS:
+            buffer.append(statement)
+
+    def begin_call(self) -> Tuple[int, bool]:
+        buffer = getattr(self._local, "statements", None)
+        if buffer is None:
+            self._local.statements = []
+            return 0, True
+        return len(buffer), False
+
+    def end_call(
+        self, name: str, mark: Tuple[int, bool], elapsed: float, error: bool, args: Tuple, kwargs: Dict
+    ):
+        start, owner = mark
+        statements = self._local.statements[start:]
+        if owner:
+            self._local.statements = None
+
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            entry = self._functions.get(name)
+            if entry is None:
+                entry = self._functions[name] = {
+                    "calls": 0,
+                    "errors": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "buckets": [0] * (len(self.LATENCY_BUCKETS_MS) + 1),
+                }
+            entry["calls"] += 1
+            entry["errors"] += int(error)
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["buckets"][self._bucket(elapsed_ms)] += 1
+            slow = elapsed_ms >= self.slow_ms
+            if slow:
+                self.slow_calls += 1
+
+        if slow:
+            params = ", ".join([repr(a) for a in args] + [f"{k}={v!r}" for k, v in kwargs.items()])
+            queries = "\n  ".join(statements) or "(нет SQL-запросов)"
+            logger.warning(f"🐢 Медленный вызов {name}({params[:300]}): {elapsed_ms:.1f} мс\n  {queries}")
+
+    def _bucket(self, elapsed_ms: float) -> int:
+        for i, bound in enumerate(self.LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                return i
+        return len(self.LATENCY_BUCKETS_MS)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            functions = {}
+            for name, entry in sorted(self._functions.items()):
+                histogram = {f"le_{bound}ms": n for bound, n in zip(self.LATENCY_BUCKETS_MS, entry["buckets"])}
+                histogram["inf"] = entry["buckets"][-1]
+                functions[name] = {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "avg_ms": round(entry["total_ms"] / entry["calls"], 3) if entry["calls"] else 0.0,
+                    "max_ms": round(entry["max_ms"], 3),
+                    "histogram": histogram,
+                }
+            return {"slow_ms": self.slow_ms, "slow_calls": self.slow_calls, "functions": functions}
+
+    def prometheus(self) -> str:
+        """Гистограммы в текстовом формате Prometheus"""
+        lines = [
+            "# HELP runequest_db_call_duration_seconds Время выполнения функций БД",
+            "# TYPE runequest_db_call_duration_seconds histogram",
+        ]
+        errors = [
+            "# HELP runequest_db_call_errors_total Ошибки функций БД",
+            "# TYPE runequest_db_call_errors_total counter",
+        ]
+        with self._lock:
+            for name, entry in sorted(self._functions.items()):
+                cumulative = 0
+                for bound, n in zip(self.LATENCY_BUCKETS_MS, entry["buckets"]):
+                    cumulative += n
+                    lines.append(
+                        f'runequest_db_call_duration_seconds_bucket{{function="{name}",le="{bound / 1000}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'runequest_db_call_duration_seconds_bucket{{function="{name}",le="+Inf"}} {entry["calls"]}'
+                )
+                lines.append(
+                    f'runequest_db_call_duration_seconds_sum{{function="{name}"}} {entry["total_ms"] / 1000:.6f}'
+                )
+                lines.append(f'runequest_db_call_duration_seconds_count{{function="{name}"}} {entry["calls"]}')
+                errors.append(f'runequest_db_call_errors_total{{function="{name}"}} {entry["errors"]}')
+            lines += errors
+            lines += [
+                "# HELP runequest_db_slow_calls_total Вызовы дольше DB_SLOW_QUERY_MS",
+                "# TYPE runequest_db_slow_calls_total counter",
+                f"runequest_db_slow_calls_total {self.slow_calls}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._functions.clear()
+            self.slow_calls = 0
+
+
+db_metrics = DBMetrics(DB_SLOW_QUERY_MS)
 
 
 def safedb_execute(func: Callable) -> Callable:
+    name = func.__name__
+
     @wraps(func)
     def wrapper(*args, **kwargs):
+        mark = db_metrics.begin_call()
+        started = time.perf_counter()
+        error = False
         try:
             return func(*args, **kwargs)
         except Exception as e:
-            logger.error(f"DB error in {func.__name__}: {e}")
+            error = True
+            logger.error(f"DB error in {name}: {e}")
+            # Внутри внешней транзакции ошибка должна откатить её целиком
+            if storage.in_transaction():
+                raise
             return None
+        finally:
+            db_metrics.end_call(name, mark, time.perf_counter() - started, error, args, kwargs)
     return wrapper
 
 
-@safedb_execute
-def init_database():
-    conn = get_db()
-    c = conn.cursor()
+class DBExecutor:
+    """Выделенный пул потоков для синхронных функций БД.
+
+    Обработчики PTB ждут результат через await, не блокируя event loop.
+    Считает глубину очереди и время ожидания свободного потока.
+    """
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def run(self, func: Callable, *args, **kwargs):
+        enqueued_at = time.perf_counter()
+        with self._lock:
+            self.queued += 1
+
+        def job():
+            waited = time.perf_counter() - enqueued_at
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                depth = self.queued
+            if waited * 1000 > DB_QUEUE_WARN_MS:
+                logger.warning(
+                    f"⏳ Очередь БД: {func.__name__} ждал {waited * 1000:.0f} мс (в очереди {depth})"
+                )
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, ctx.run, job)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            started = self.completed + self.running
+            return {
+                "threads": self.threads,
+                "queue_depth": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "avg_wait_ms": round(self.wait_total / started * 1000, 3) if started else 0.0,
+                "max_wait_ms": round(self.wait_max * 1000, 3),
+            }
 
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS players (
-            user_id INTEGER PRIMARY KEY,
-            chat_id INTEGER,
-            username TEXT,
-            class TEXT NOT NULL,
-            level INTEGER DEFAULT 1,
-            xp INTEGER DEFAULT 0,
-            health INTEGER,
-            max_health INTEGER,
-            mana INTEGER,
-            max_mana INTEGER,
-            attack INTEGER,
-            defense INTEGER,
-            gold INTEGER DEFAULT 0,
-            dungeon_rating INTEGER DEFAULT 0,
-            equipped_weapon TEXT,
-            equipped_armor TEXT,
-            equipped_rune TEXT,
-            pet_id TEXT DEFAULT 'wolf',
-            pet_level INTEGER DEFAULT 1,
-            total_kills INTEGER DEFAULT 0,
-            total_bosses_killed INTEGER DEFAULT 0,
-            total_battles_won INTEGER DEFAULT 0,
-            total_battles_lost INTEGER DEFAULT 0,
-            pvp_wins INTEGER DEFAULT 0,
-            pvp_losses INTEGER DEFAULT 0,
-            craft_count INTEGER DEFAULT 0,
-            current_location TEXT,
-            last_daily_reward TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """
-    )
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+db_executor = DBExecutor(DB_THREADS)
+
+
+async def db_call(func: Callable, *args, **kwargs):
+    return await db_executor.run(func, *args, **kwargs)
+
+
+class DBWriter:
+    """Единственный поток-писатель SQLite с групповой фиксацией (group commit).
+
+    Все записи ставятся в очередь и выполняются одним потоком на собственном
+    соединении. Писатель забирает всё, что накопилось в очереди, пока
+    фиксировалась предыдущая группа, и ещё до DB_GROUP_COMMIT_MS ждёт новых
+    записей (не более DB_GROUP_COMMIT_MAX). При DB_SYNCHRONOUS=FULL каждый
+    COMMIT делает fsync WAL, и группа делит его на все свои записи; даже с
+    окном 0 в неё попадает всё, что пришло за время предыдущего fsync, так что
+    окно нужно лишь при редких одиночных записях. Группа выполняется
+    одной транзакцией BEGIN IMMEDIATE, каждая запись — в своей SAVEPOINT.
+    Ошибка одной записи откатывает только её (вместе с её on_rollback),
+    ошибка COMMIT — всю группу. Future каждой записи завершается только
+    после COMMIT, так что ответ игроку уходит уже по зафиксированным данным.
+    Любой другой сбой посреди группы (упавший откат, SAVEPOINT) откатывает
+    её целиком и завершает ошибкой все ещё не завершённые future; если поток
+    писателя всё же умер, submit() поднимает его заново.
+    """
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.running = False
+        self.writes = 0
+        self.failed = 0
+        self.commits = 0
+        self.max_batch_seen = 0
+        self.commit_total = 0.0
+        self.commit_max = 0.0
+        self.restarts = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._conn = db_pool._connect()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.running = True
+        self._thread.start()
+
+    def is_writer_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        self._ensure_alive()
+        future: Future = Future()
+        self._queue.put((future, contextvars.copy_context(), func, args, kwargs))
+        return future
+
+    def _ensure_alive(self):
+        """Запускает поток писателя заново, если он умер, а close() не вызывался"""
+        with self._lock:
+            thread = self._thread
+            if not self.running or thread is None or thread.is_alive():
+                return
+            logger.error("❌ Писатель БД: поток остановился, запускаю заново")
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = db_pool._connect()
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self.restarts += 1
+            self._thread.start()
+
+    def _collect(self, first) -> Tuple[list, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        conn = self._conn
+        db_pool._local.conn = conn
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch, stop = self._collect(item)
+            self._commit_batch(conn, batch)
+        db_pool._local.conn = None
+        conn.close()
 
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS inventory (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            chat_id INTEGER,
-            item_id TEXT NOT NULL,
-            item_type TEXT,
-            quantity INTEGER DEFAULT 1,
-            FOREIGN KEY(user_id) REFERENCES players(user_id),
-            UNIQUE(user_id, item_id)
-        )
-        """
-    )
+    def _commit_batch(self, conn: sqlite3.Connection, batch: list):
+        done: list = []
+        with db_write_lock:
+            try:
+                self._commit_batch_locked(conn, batch, done)
+            except Exception as e:
+                logger.error(f"Писатель БД: сбой группы из {len(batch)} записей: {e}")
+                self._abort_batch(conn, batch, done, e)
+
+    def _abort_batch(self, conn: sqlite3.Connection, batch: list, done: list, error: Exception):
+        """Откатывает группу целиком и завершает ошибкой все незавершённые future"""
+        db_pool._local.undo = None
+        db_pool._local.commit = None
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error as e:
+                logger.error(f"Писатель БД: ROLLBACK группы не удался: {e}")
+        while done:
+            _, _, undo = done.pop()
+            while undo:
+                try:
+                    undo.pop()()
+                except Exception as e:
+                    logger.error(f"Писатель БД: ошибка отката записи: {e}")
+        unresolved = [future for future, *_ in batch if not future.done()]
+        for future in unresolved:
+            future.set_exception(error)
+        with self._lock:
+            self.failed += len(unresolved)
+
+    def _commit_batch_locked(self, conn: sqlite3.Connection, batch: list, done: list):
+        """done — записи группы, ещё не зафиксированные; у каждой список её отката"""
+        started = time.perf_counter()
+        committed: List[Callable] = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            logger.error(f"Писатель БД: не удалось начать транзакцию: {e}")
+            for future, *_ in batch:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        for future, ctx, func, args, kwargs in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            undo: List[Callable] = []
+            hooks: List[Callable] = []
+            db_pool._local.undo = undo
+            db_pool._local.commit = hooks
+            done.append((future, None, undo))
+            conn.execute("SAVEPOINT write")
+            try:
+                result = ctx.run(func, *args, **kwargs)
+            except Exception as e:
+                conn.execute("ROLLBACK TO write")
+                conn.execute("RELEASE write")
+                while undo:
+                    undo.pop()()
+                done.pop()
+                future.set_exception(e)
+                with self._lock:
+                    self.failed += 1
+                continue
+            finally:
+                db_pool._local.undo = None
+                db_pool._local.commit = None
+            conn.execute("RELEASE write")
+            done[-1] = (future, result, undo)
+            committed.extend(hooks)
 
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS battles (
-            user_id INTEGER PRIMARY KEY,
-            chat_id INTEGER,
-            location_id TEXT,
-            enemy_id TEXT NOT NULL,
-            enemy_health INTEGER,
-            enemy_max_health INTEGER,
-            enemy_damage INTEGER,
-            is_boss BOOLEAN DEFAULT 0,
-            player_health INTEGER,
-            player_max_health INTEGER,
-            is_dungeon BOOLEAN DEFAULT 0,
-            FOREIGN KEY(user_id) REFERENCES players(user_id)
-        )
+        try:
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Писатель БД: COMMIT группы из {len(done)} записей не удался: {e}")
+            conn.rollback()
+            while done:
+                future, _, undo = done[-1]
+                while undo:
+                    undo.pop()()
+                done.pop()
+                future.set_exception(e)
+                with self._lock:
+                    self.failed += 1
+            return
+
+        finished = list(done)
+        done.clear()
+        run_commit_hooks(committed)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.writes += len(finished)
+            self.commits += 1
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.commit_total += elapsed
+            self.commit_max = max(self.commit_max, elapsed)
+        for future, result, _ in finished:
+            future.set_result(result)
+
+    def call(self, func: Callable, *args, **kwargs):
+        """Синхронная запись: через писателя, если он запущен, иначе своей транзакцией.
+
+        Внутри уже открытой транзакции выполняется в ней же: писатель ждал бы
+        db_write_lock, который держит этот поток.
         """
-    )
+        if self.running and not self.is_writer_thread() and not storage.in_transaction():
+            return self.submit(func, *args, **kwargs).result()
+        with storage.transaction():
+            return func(*args, **kwargs)
 
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS dungeon_progress (
-            user_id INTEGER PRIMARY KEY,
-            chat_id INTEGER,
-            current_floor INTEGER DEFAULT 1,
-            is_active BOOLEAN DEFAULT 0,
-            enemies_killed INTEGER DEFAULT 0,
-            FOREIGN KEY(user_id) REFERENCES players(user_id)
-        )
-        """
-    )
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "writes": self.writes,
+                "failed": self.failed,
+                "commits": self.commits,
+                "avg_batch": round(self.writes / self.commits, 2) if self.commits else 0.0,
+                "max_batch": self.max_batch_seen,
+                "avg_commit_ms": round(self.commit_total / self.commits * 1000, 3) if self.commits else 0.0,
+                "max_commit_ms": round(self.commit_max * 1000, 3),
+                "restarts": self.restarts,
+            }
 
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pvp_queue (
-            user_id INTEGER PRIMARY KEY,
-            chat_id INTEGER,
-            is_waiting BOOLEAN DEFAULT 1,
-            confirmed BOOLEAN DEFAULT 0,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(user_id) REFERENCES players(user_id)
-        )
-        """
-    )
+    def close(self):
+        if self._thread is None:
+            return
+        self.running = False
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
 
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pvp_battles (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            attacker_id INTEGER,
-            defender_id INTEGER,
-            chat_id INTEGER,
-            winner_id INTEGER,
-            reward_gold INTEGER,
-            battle_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(attacker_id) REFERENCES players(user_id),
-            FOREIGN KEY(defender_id) REFERENCES players(user_id)
-        )
-        """
-    )
 
-    c.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON players(user_id)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_level ON players(level)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_inventory_user ON inventory(user_id)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_battles_user ON battles(user_id)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_chat ON players(chat_id)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_pvp_confirmed ON pvp_queue(confirmed)")
+db_writer = DBWriter(DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX)
 
-    conn.commit()
-    conn.close()
-    logger.info("✅ База данных инициализирована")
 
+async def db_write(func: Callable, *args, **kwargs):
+    """Запись через писателя с групповой фиксацией; без писателя — как db_call"""
+    if not db_writer.running:
+        return await db_call(func, *args, **kwargs)
+    try:
+        return await asyncio.wrap_future(db_writer.submit(func, *args, **kwargs))
+    except Exception:
+        # Ошибка уже в логе; как и при safedb_execute, обработчик получает None
+        return None
 
-# ===================== ИГРОКИ =====================
 
-@safedb_execute
-def init_player(chat_id: int, user_id: int, username: str, player_class: str) -> bool:
-    if player_class not in CLASSES:
-        player_class = "warrior"
-    class_info = CLASSES[player_class]
+# ===================== МИГРАЦИИ СХЕМЫ =====================
+#
+# Каждая миграция — (версия, описание, шаги). Шаг — SQL-строка или функция от
+# соединения. Миграция выполняется одной транзакцией BEGIN IMMEDIATE вместе с
+# записью в schema_version, так что после сбоя она либо применена целиком,
+# либо не применена вовсе. Уже применённые версии при старте пропускаются.
+#
+# Индексы добавляются только через index_migration: по одному индексу на
+# версию (блокировка записи держится лишь на время построения одного индекса,
+# остальные писатели ждут его в пределах timeout соединения), с IF NOT EXISTS и
+# последующим ANALYZE, чтобы планировщик сразу увидел новую статистику.
 
-    conn = get_db()
-    c = conn.cursor()
-    try:
-        c.execute(
-            """
-            INSERT INTO players (
-                user_id, chat_id, username, class,
-                level, xp, health, max_health, mana, max_mana,
-                attack, defense, gold, pet_id
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                user_id,
-                chat_id,
-                username or "Безымянный",
-                player_class,
-                1,
-                0,
-                class_info["health"],
-                class_info["health"],
-                class_info["mana"],
-                class_info["mana"],
-                class_info["attack"],
-                class_info["defense"],
-                class_info["starting_gold"],
-                "wolf",
-            ),
-        )
-        c.execute(
-            """
-            INSERT OR IGNORE INTO inventory (user_id, chat_id, item_id, item_type, quantity)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (user_id, chat_id, "health_potion", "potion", 3),
-        )
-        conn.commit()
-        logger.info(f"✅ Игрок создан: {username} ({user_id}) - {player_class}")
-        return True
-    except sqlite3.IntegrityError:
-        logger.warning(f"Игрок уже существует: {user_id}")
-        return False
-    finally:
-        conn.close()
+MigrationStep = Union[str, Callable[[sqlite3.Connection], None]]
 
 
-@safedb_execute
-def get_player(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM players WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
-    )
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else None
+def add_column(table: str, column: str, ddl: str) -> MigrationStep:
+    """Шаг миграции: ALTER TABLE ADD COLUMN, если колонки ещё нет"""
 
+    def step(conn: sqlite3.Connection):
+        columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
 
-@safedb_execute
-def player_exists(chat_id: int, user_id: int) -> bool:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT 1 FROM players WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
+    return step
+
+
+def index_migration(version: int, name: str, table: str, columns: str, unique: bool = False):
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    return (
+        version,
+        f"индекс {name} ON {table}({columns})",
+        [
+            f"CREATE {kind} IF NOT EXISTS {name} ON {table}({columns})",
+            f"ANALYZE {name}",
+        ],
     )
-    exists = c.fetchone() is not None
-    conn.close()
-    return exists
 
 
-@safedb_execute
-def add_xp(chat_id: int, user_id: int, username: str, xp_amount: int) -> int:
-    player = get_player(chat_id, user_id)
-    if not player:
-        return 0
-    new_xp = player["xp"] + xp_amount
-    current_level = player["level"]
-    levels_up = 0
+def drop_index_migration(version: int, name: str):
+    return (version, f"удалить индекс {name}", [f"DROP INDEX IF EXISTS {name}"])
 
-    while current_level < MAX_LEVEL:
-        xp_needed = int(LEVEL_UP_BASE * (current_level ** 1.5))
-        if new_xp >= xp_needed:
-            new_xp -= xp_needed
-            current_level += 1
-            levels_up += 1
-        else:
-            break
 
-    conn = get_db()
-    c = conn.cursor()
-    if levels_up > 0:
-        new_health = player["max_health"] + STATS_PER_LEVEL["health"] * levels_up
-        new_mana = player["max_mana"] + STATS_PER_LEVEL["mana"] * levels_up
-        new_attack = player["attack"] + STATS_PER_LEVEL["attack"] * levels_up
-        new_defense = player["defense"] + STATS_PER_LEVEL["defense"] * levels_up
-        c.execute(
+MIGRATIONS: List[Tuple[int, str, List[MigrationStep]]] = [
+    (
+        1,
+        "базовая схема",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS players (
+                user_id INTEGER PRIMARY KEY,
+                chat_id INTEGER,
+                username TEXT,
+                class TEXT NOT NULL,
+                level INTEGER DEFAULT 1,
+                xp INTEGER DEFAULT 0,
+                health INTEGER,
+                max_health INTEGER,
+                mana INTEGER,
+                max_mana INTEGER,
+                attack INTEGER,
+                defense INTEGER,
+                gold INTEGER DEFAULT 0,
+                dungeon_rating INTEGER DEFAULT 0,
+                equipped_weapon TEXT,
+                equipped_armor TEXT,
+                equipped_rune TEXT,
+                pet_id TEXT DEFAULT 'wolf',
+                pet_level INTEGER DEFAULT 1,
+                total_kills INTEGER DEFAULT 0,
+                total_bosses_killed INTEGER DEFAULT 0,
+                total_battles_won INTEGER DEFAULT 0,
+                total_battles_lost INTEGER DEFAULT 0,
+                pvp_wins INTEGER DEFAULT 0,
+                pvp_losses INTEGER DEFAULT 0,
+                craft_count INTEGER DEFAULT 0,
+                current_location TEXT,
+                last_daily_reward TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS inventory (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER,
+                item_id TEXT NOT NULL,
+                item_type TEXT,
+                quantity INTEGER DEFAULT 1,
+                FOREIGN KEY(user_id) REFERENCES players(user_id),
+                UNIQUE(user_id, item_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS battles (
+                user_id INTEGER PRIMARY KEY,
+                chat_id INTEGER,
+                location_id TEXT,
+                enemy_id TEXT NOT NULL,
+                enemy_health INTEGER,
+                enemy_max_health INTEGER,
+                enemy_damage INTEGER,
+                is_boss BOOLEAN DEFAULT 0,
+                player_health INTEGER,
+                player_max_health INTEGER,
+                is_dungeon BOOLEAN DEFAULT 0,
+                FOREIGN KEY(user_id) REFERENCES players(user_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS dungeon_progress (
+                user_id INTEGER PRIMARY KEY,
+                chat_id INTEGER,
+                current_floor INTEGER DEFAULT 1,
+                is_active BOOLEAN DEFAULT 0,
+                enemies_killed INTEGER DEFAULT 0,
+                FOREIGN KEY(user_id) REFERENCES players(user_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pvp_queue (
+                user_id INTEGER PRIMARY KEY,
+                chat_id INTEGER,
+                is_waiting BOOLEAN DEFAULT 1,
+                confirmed BOOLEAN DEFAULT 0,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES players(user_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pvp_battles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                attacker_id INTEGER,
+                defender_id INTEGER,
+                chat_id INTEGER,
+                winner_id INTEGER,
+                reward_gold INTEGER,
+                battle_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(attacker_id) REFERENCES players(user_id),
+                FOREIGN KEY(defender_id) REFERENCES players(user_id)
+            )
+            """,
+        ],
+    ),
+    index_migration(2, "idx_user_id", "players", "user_id"),
+    index_migration(3, "idx_level", "players", "level"),
+    index_migration(4, "idx_inventory_user", "inventory", "user_id"),
+    index_migration(5, "idx_battles_user", "battles", "user_id"),
+    index_migration(6, "idx_chat", "players", "chat_id"),
+    index_migration(7, "idx_pvp_confirmed", "pvp_queue", "confirmed"),
+    # Индексы под форму запросов: равенство по chat_id/user_id, затем порядок сортировки
+    index_migration(8, "idx_players_chat_rank", "players", "chat_id, level DESC, gold DESC, total_kills DESC"),
+    index_migration(9, "idx_players_chat_pvp", "players", "chat_id, pvp_wins DESC, pvp_losses, level, username"),
+    index_migration(
+        10,
+        "idx_players_chat_dungeon",
+        "players",
+        "chat_id, dungeon_rating DESC, total_bosses_killed DESC, level, username",
+    ),
+    index_migration(11, "idx_inventory_user_chat_type", "inventory", "user_id, chat_id, item_type, item_id"),
+    index_migration(12, "idx_pvp_queue_waiting", "pvp_queue", "confirmed, is_waiting, timestamp"),
+    # Старые одноколоночные индексы: дублируют PRIMARY KEY или префикс новых
+    drop_index_migration(13, "idx_user_id"),
+    drop_index_migration(14, "idx_level"),
+    drop_index_migration(15, "idx_inventory_user"),
+    drop_index_migration(16, "idx_battles_user"),
+    drop_index_migration(17, "idx_chat"),
+    drop_index_migration(18, "idx_pvp_confirmed"),
+    # Детерминированные бои: seed, сыгранные действия и статы на начало боя
+    (19, "battles.seed", [add_column("battles", "seed", "INTEGER")]),
+    (20, "battles.actions", [add_column("battles", "actions", "TEXT DEFAULT ''")]),
+    (21, "battles.combat_stats", [add_column("battles", "combat_stats", "TEXT")]),
+    # План забега подземелья: id врагов по этажам через запятую
+    (22, "dungeon_progress.run_plan", [add_column("dungeon_progress", "run_plan", "TEXT")]),
+    # Время последнего изменения: по нему уборщик находит брошенные строки.
+    # ALTER TABLE не принимает DEFAULT CURRENT_TIMESTAMP — старые строки заполняются отдельно
+    (
+        23,
+        "battles.updated_at",
+        [
+            add_column("battles", "updated_at", "TIMESTAMP"),
+            "UPDATE battles SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL",
+        ],
+    ),
+    (
+        24,
+        "dungeon_progress.updated_at",
+        [
+            add_column("dungeon_progress", "updated_at", "TIMESTAMP"),
+            "UPDATE dungeon_progress SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL",
+        ],
+    ),
+    index_migration(25, "idx_battles_updated", "battles", "updated_at"),
+    index_migration(26, "idx_dungeon_active_updated", "dungeon_progress", "is_active, updated_at"),
+    index_migration(27, "idx_pvp_queue_timestamp", "pvp_queue", "timestamp"),
+    # Рейтинг ПВП: NULL до первого боя, у игравших — стартовая оценка по рекорду.
+    # Числа зашиты (значения PVP_MMR_START и PVP_MMR_PER_LEVEL по умолчанию):
+    # миграция должна давать одно и то же при любом окружении.
+    (
+        28,
+        "players.mmr",
+        [
+            add_column("players", "mmr", "INTEGER"),
             """
             UPDATE players
-            SET xp = ?, level = ?, max_health = ?, health = ?, max_mana = ?, mana = ?, attack = ?, defense = ?
-            WHERE user_id = ? AND chat_id = ?
+            SET mmr = 1000 + (level - 1) * 10 + 10 * (pvp_wins - pvp_losses)
+            WHERE mmr IS NULL AND (pvp_wins + pvp_losses) > 0
             """,
-            (
-                new_xp,
-                current_level,
-                new_health,
-                new_health,
-                new_mana,
-                new_mana,
-                new_attack,
-                new_defense,
-                user_id,
-                chat_id,
-            ),
-        )
-        logger.info(f"⬆️ {username} - {levels_up} уровней!")
-    else:
-        c.execute(
-            "UPDATE players SET xp = ? WHERE user_id = ? AND chat_id = ?",
-            (new_xp, user_id, chat_id),
-        )
+        ],
+    ),
+    index_migration(29, "idx_players_chat_mmr", "players", "chat_id, mmr DESC"),
+    drop_index_migration(30, "idx_players_chat_pvp"),
+    (
+        31,
+        "турниры",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS tournaments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                format TEXT NOT NULL,
+                entrants INTEGER,
+                rounds INTEGER,
+                winner_id INTEGER,
+                prize_pool INTEGER,
+                finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            # Бои турнира читаются только целиком по tournament_id — он же начало ключа
+            """
+            CREATE TABLE IF NOT EXISTS tournament_matches (
+                tournament_id INTEGER NOT NULL,
+                round INTEGER NOT NULL,
+                player_a INTEGER NOT NULL,
+                player_b INTEGER NOT NULL,
+                winner_id INTEGER,
+                turns INTEGER,
+                seed INTEGER,
+                PRIMARY KEY (tournament_id, round, player_a),
+                FOREIGN KEY(tournament_id) REFERENCES tournaments(id)
+            ) WITHOUT ROWID
+            """,
+        ],
+    ),
+    # Забеги без предела этажей, начатые до планов на 30 этажей: дальше
+    # продолжать нечем, закрываем (рейтинг подземелья за них уже начислен)
+    (
+        32,
+        "dungeon_progress.current_floor",
+        [
+            """
+            UPDATE dungeon_progress
+            SET is_active = 0, current_floor = 1, run_plan = NULL
+            WHERE is_active = 1 AND current_floor > 30
+            """,
+        ],
+    ),
+]
 
-    conn.commit()
-    conn.close()
-    return levels_up
 
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT MAX(version) AS version FROM schema_version").fetchone()
+    return row["version"] or 0
 
-@safedb_execute
-def add_gold(chat_id: int, user_id: int, amount: int):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE players SET gold = gold + ? WHERE user_id = ? AND chat_id = ?",
-        (amount, user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
 
+def migrate_database(target: Optional[int] = None) -> int:
+    """Доводит схему до последней (или target) версии, возвращает итоговую версию"""
+    versions = [version for version, _, _ in MIGRATIONS]
+    if versions != sorted(set(versions)):
+        raise RuntimeError("Версии миграций должны строго возрастать")
+    target = versions[-1] if target is None else target
 
-@safedb_execute
-def subtract_gold(chat_id: int, user_id: int, amount: int) -> bool:
-    player = get_player(chat_id, user_id)
-    if not player or player["gold"] < amount:
-        return False
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE players SET gold = gold - ? WHERE user_id = ? AND chat_id = ?",
-        (amount, user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
-    return True
+    with db_connection() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.commit()
+        current = get_schema_version(conn)
 
+    for version, description, steps in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        started = time.perf_counter()
+        try:
+            with db_transaction() as conn:
+                # Повторная проверка под блокировкой: другой процесс мог успеть раньше
+                if get_schema_version(conn) >= version:
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description),
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Миграция {version} ({description}) не применена: {e}")
+            raise
+        current = version
+        logger.info(f"🛠 Миграция {version}: {description} ({time.perf_counter() - started:.2f} с)")
 
-# ===================== ИНВЕНТАРЬ =====================
+    logger.info(f"✅ База данных на версии схемы {current}")
+    return current
 
-@safedb_execute
-def get_inventory(chat_id: int, user_id: int) -> List[Dict[str, Any]]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM inventory WHERE user_id = ? AND chat_id = ? ORDER BY item_type, item_id",
-        (user_id, chat_id),
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
 
+# ===================== ХРАНИЛИЩЕ =====================
+#
+# Игровая логика обращается к данным только через объект storage. Интерфейс
+# Storage повторяет таблицы схемы (players, inventory, battles,
+# dungeon_progress, pvp_queue, pvp_battles, tournaments); строки — обычные
+# dict с теми же столбцами, что и в SQLite. SQLiteStorage — рабочая
+# реализация поверх пула соединений, MemoryStorage — словари в памяти для
+# нагрузочных тестов и симуляций без дискового ввода-вывода. Выбор —
+# STORAGE_BACKEND.
 
-@safedb_execute
-def get_item_quantity(chat_id: int, user_id: int, item_id: str) -> int:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
-        (user_id, chat_id, item_id),
-    )
-    row = c.fetchone()
-    conn.close()
-    return row["quantity"] if row else 0
 
+DB_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-@safedb_execute
-def add_item(chat_id: int, user_id: int, item_id: str, quantity: int = 1):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
-        (user_id, chat_id, item_id),
-    )
-    row = c.fetchone()
-    if row:
-        c.execute(
-            "UPDATE inventory SET quantity = quantity + ? WHERE user_id = ? AND chat_id = ? AND item_id = ?",
-            (quantity, user_id, chat_id, item_id),
-        )
-    else:
-        item_type = "misc"
-        if item_id in WEAPONS:
-            item_type = "weapon"
-        elif item_id in ARMOR:
-            item_type = "armor"
-        elif item_id in PETS:
-            item_type = "pet"
-        elif item_id in MATERIALS:
-            item_type = "material"
-        elif item_id in RUNES:
-            item_type = "rune"
-        elif item_id == "health_potion":
-            item_type = "potion"
-
-        c.execute(
-            "INSERT INTO inventory (user_id, chat_id, item_id, item_type, quantity) VALUES (?, ?, ?, ?, ?)",
-            (user_id, chat_id, item_id, item_type, quantity),
-        )
-    conn.commit()
-    conn.close()
 
+def db_timestamp(seconds_ago: float = 0) -> str:
+    """Время UTC в формате CURRENT_TIMESTAMP SQLite: такие строки сравниваются как даты"""
+    return time.strftime(DB_TIMESTAMP_FORMAT, time.gmtime(time.time() - seconds_ago))
 
-@safedb_execute
-def remove_item(chat_id: int, user_id: int, item_id: str, quantity: int = 1) -> bool:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
-        (user_id, chat_id, item_id),
-    )
-    row = c.fetchone()
-    if not row or row["quantity"] < quantity:
-        conn.close()
-        return False
-    if row["quantity"] == quantity:
-        c.execute(
-            "DELETE FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
-            (user_id, chat_id, item_id),
-        )
-    else:
-        c.execute(
-            "UPDATE inventory SET quantity = quantity - ? WHERE user_id = ? AND chat_id = ? AND item_id = ?",
-            (quantity, user_id, chat_id, item_id),
-        )
-    conn.commit()
-    conn.close()
-    return True
 
+def db_timestamp_age(value: Optional[str]) -> float:
+    """Сколько секунд прошло с db_timestamp; 0 для пустого значения"""
+    if not value:
+        return 0.0
+    return max(0.0, time.time() - calendar.timegm(time.strptime(value, DB_TIMESTAMP_FORMAT)))
 
-@safedb_execute
-def get_material(chat_id: int, user_id: int, material_id: str) -> int:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
-        (user_id, chat_id, material_id),
-    )
-    row = c.fetchone()
-    conn.close()
-    return row["quantity"] if row else 0
 
+class Storage(ABC):
+    """Интерфейс хранилища игровых данных"""
 
-@safedb_execute
-def can_use_item(player_class: str, item_id: str) -> bool:
-    if item_id in WEAPONS:
-        return (
-            WEAPONS[item_id].get("class") == player_class
-            or WEAPONS[item_id].get("class") is None
-        )
-    elif item_id in ARMOR:
-        return (
-            ARMOR[item_id].get("class") == player_class
-            or ARMOR[item_id].get("class") is None
-        )
-    return True
+    name = "abstract"
 
+    @abstractmethod
+    def init_schema(self):
+        raise NotImplementedError
 
-@safedb_execute
-def equip_weapon(chat_id: int, user_id: int, weapon_id: str) -> bool:
-    player = get_player(chat_id, user_id)
-    if not player or weapon_id not in WEAPONS:
-        return False
+    # ---------- транзакции ----------
 
-    if not can_use_item(player["class"], weapon_id):
-        return False
+    @abstractmethod
+    def transaction(self):
+        """Контекстный менеджер: все операции внутри блока атомарны"""
+        raise NotImplementedError
 
-    if get_item_quantity(chat_id, user_id, weapon_id) <= 0:
-        return False
+    @abstractmethod
+    def in_transaction(self) -> bool:
+        raise NotImplementedError
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE players SET equipped_weapon = ? WHERE user_id = ? AND chat_id = ?",
-        (weapon_id, user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
-    return True
+    @abstractmethod
+    def on_rollback(self, undo: Callable):
+        """Регистрирует откат внешнего состояния для текущей транзакции"""
+        raise NotImplementedError
 
+    @abstractmethod
+    def on_commit(self, action: Callable):
+        """Выполняет action после фиксации текущей транзакции; вне транзакции — сразу"""
+        raise NotImplementedError
 
-@safedb_execute
-def equip_armor(chat_id: int, user_id: int, armor_id: str) -> bool:
-    player = get_player(chat_id, user_id)
-    if not player or armor_id not in ARMOR:
-        return False
+    # ---------- players ----------
 
-    if not can_use_item(player["class"], armor_id):
-        return False
+    @abstractmethod
+    def get_player(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
 
-    if get_item_quantity(chat_id, user_id, armor_id) <= 0:
-        return False
+    @abstractmethod
+    def get_player_by_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE players SET equipped_armor = ? WHERE user_id = ? AND chat_id = ?",
-        (armor_id, user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
-    return True
+    @abstractmethod
+    def player_exists(self, chat_id: int, user_id: int) -> bool:
+        raise NotImplementedError
 
+    @abstractmethod
+    def insert_player(self, values: Dict[str, Any], items: List[Tuple[str, str, int]] = ()) -> bool:
+        """Создаёт игрока и стартовые предметы; False, если игрок уже есть"""
+        raise NotImplementedError
 
-@safedb_execute
+    @abstractmethod
+    def update_players(self, updates: List[Tuple[int, int, Dict[str, Any]]]):
+        """Пакетная запись столбцов: [(chat_id, user_id, {столбец: значение})]"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def top_players(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def top_pvp(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        """Лестница ПВП: игроки с рейтингом по убыванию MMR"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_pvp_above(self, chat_id: int, mmr: int) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def top_dungeon(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_ranked_above(self, chat_id: int, level: int, gold: int) -> int:
+        raise NotImplementedError
+
+    # ---------- inventory ----------
+
+    @abstractmethod
+    def get_inventory(self, chat_id: int, user_id: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_item_quantity(self, chat_id: int, user_id: int, item_id: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_item(self, chat_id: int, user_id: int, item_id: str, item_type: str, quantity: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_item(self, chat_id: int, user_id: int, item_id: str, quantity: int) -> bool:
+        raise NotImplementedError
+
+    # ---------- battles ----------
+
+    @abstractmethod
+    def get_battle(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_battle(self, chat_id: int, user_id: int, values: Dict[str, Any]):
+        """Создаёт или заменяет бой игрока целиком"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_battle(self, chat_id: int, user_id: int, **values):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_battle(self, chat_id: int, user_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def all_battles(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire_battles(self, before: str, limit: int) -> List[int]:
+        """Удаляет до limit боёв, не менявшихся с before; возвращает их user_id"""
+        raise NotImplementedError
+
+    # ---------- dungeon_progress ----------
+
+    @abstractmethod
+    def get_dungeon(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_dungeon(self, chat_id: int, user_id: int, **values):
+        """Создаёт прогресс подземелья или обновляет указанные столбцы"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire_dungeons(self, before: str, limit: int) -> int:
+        """Закрывает до limit активных забегов, не менявшихся с before"""
+        raise NotImplementedError
+
+    # ---------- pvp_queue ----------
+
+    @abstractmethod
+    def enqueue_pvp(self, chat_id: int, user_id: int):
+        """Ставит игрока в очередь сразу подтверждённым (одна запись)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def dequeue_pvp(self, chat_id: int, user_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_pvp_opponent(self, user_id: int) -> bool:
+        """Сравнение с удалением: убирает ожидающего из очереди, False — его там уже нет"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def pvp_queue_entries(self) -> List[Dict[str, Any]]:
+        """Ожидающие игроки (user_id, chat_id, level, mmr, timestamp) в порядке постановки"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire_pvp_queue(self, before: str, limit: int) -> int:
+        """Убирает из очереди до limit записей, вставших в неё раньше before"""
+        raise NotImplementedError
+
+    # ---------- pvp_battles ----------
+
+    @abstractmethod
+    def record_pvp_battle(
+        self, attacker_id: int, defender_id: int, chat_id: int, winner_id: int, reward_gold: int
+    ) -> int:
+        raise NotImplementedError
+
+    # ---------- tournaments ----------
+
+    @abstractmethod
+    def record_tournament(
+        self,
+        chat_id: int,
+        fmt: str,
+        entrants: int,
+        rounds: int,
+        winner_id: int,
+        prize_pool: int,
+        matches: List[Tuple[int, int, int, int, int, int]],
+    ) -> int:
+        """Строка турнира и все его бои (round, player_a, player_b, winner_id, turns, seed)"""
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    """Хранилище в SQLite через пул соединений db_pool"""
+
+    name = "sqlite"
+
+    def init_schema(self):
+        migrate_database()
+
+    def transaction(self):
+        return db_pool.transaction()
+
+    def in_transaction(self) -> bool:
+        return db_pool.in_use()
+
+    def on_rollback(self, undo: Callable):
+        db_pool.on_rollback(undo)
+
+    def on_commit(self, action: Callable):
+        db_pool.on_commit(action)
+
+    def _one(self, sql: str, params: Tuple) -> Optional[Dict[str, Any]]:
+        with db_connection() as conn:
+            row = conn.execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def _all(self, sql: str, params: Tuple) -> List[Dict[str, Any]]:
+        with db_connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [dict(r) for r in rows]
+
+    def _execute(self, sql: str, params: Tuple) -> int:
+        with db_connection() as conn:
+            return conn.execute(sql, params).rowcount
+
+    # ---------- players ----------
+
+    def get_player(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._one("SELECT * FROM players WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def get_player_by_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._one("SELECT * FROM players WHERE user_id = ?", (user_id,))
+
+    def player_exists(self, chat_id: int, user_id: int) -> bool:
+        return self._one("SELECT 1 FROM players WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)) is not None
+
+    def insert_player(self, values: Dict[str, Any], items: List[Tuple[str, str, int]] = ()) -> bool:
+        columns = ", ".join(values)
+        placeholders = ", ".join("?" for _ in values)
+        try:
+            with db_connection() as conn:
+                conn.execute(f"INSERT INTO players ({columns}) VALUES ({placeholders})", tuple(values.values()))
+                conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO inventory (user_id, chat_id, item_id, item_type, quantity)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    [(values["user_id"], values["chat_id"], *item) for item in items],
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def update_players(self, updates: List[Tuple[int, int, Dict[str, Any]]]):
+        # Строки с одинаковым набором столбцов пишутся одним executemany
+        groups: Dict[Tuple[str, ...], List[Tuple]] = {}
+        for chat_id, user_id, values in updates:
+            if not values:
+                continue
+            cols = tuple(sorted(values))
+            groups.setdefault(cols, []).append(tuple(values[col] for col in cols) + (user_id, chat_id))
+
+        with db_connection() as conn:
+            for cols, params in groups.items():
+                assignments = ", ".join(f"{col} = ?" for col in cols)
+                conn.executemany(
+                    f"UPDATE players SET {assignments} WHERE user_id = ? AND chat_id = ?",
+                    params,
+                )
+
+    def top_players(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        return self._all(
+            """
+            SELECT user_id, username, level, xp, gold, total_kills, total_bosses_killed,
+                   total_battles_won, total_battles_lost, pvp_wins, pvp_losses
+            FROM players
+            WHERE chat_id = ?
+            ORDER BY level DESC, gold DESC, total_kills DESC
+            LIMIT ?
+            """,
+            (chat_id, limit),
+        )
+
+    def top_pvp(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        # idx_players_chat_mmr отдаёт строки уже в порядке рейтинга, без сортировки
+        return self._all(
+            """
+            SELECT user_id, username, level, mmr, pvp_wins, pvp_losses
+            FROM players
+            WHERE chat_id = ? AND mmr IS NOT NULL
+            ORDER BY mmr DESC
+            LIMIT ?
+            """,
+            (chat_id, limit),
+        )
+
+    def count_pvp_above(self, chat_id: int, mmr: int) -> int:
+        row = self._one("SELECT COUNT(*) AS pos FROM players WHERE chat_id = ? AND mmr > ?", (chat_id, mmr))
+        return int(row["pos"]) if row else 0
+
+    def top_dungeon(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        return self._all(
+            """
+            SELECT username, level, dungeon_rating, total_bosses_killed
+            FROM players
+            WHERE chat_id = ? AND dungeon_rating > 0
+            ORDER BY dungeon_rating DESC, total_bosses_killed DESC
+            LIMIT ?
+            """,
+            (chat_id, limit),
+        )
+
+    def count_ranked_above(self, chat_id: int, level: int, gold: int) -> int:
+        row = self._one(
+            """
+            SELECT COUNT(*) AS pos
+            FROM players
+            WHERE chat_id = ?
+              AND level >= ?
+              AND (level > ? OR gold > ?)
+            """,
+            (chat_id, level, level, gold),
+        )
+        return int(row["pos"]) if row else 0
+
+    # ---------- inventory ----------
+
+    def get_inventory(self, chat_id: int, user_id: int) -> List[Dict[str, Any]]:
+        return self._all(
+            "SELECT * FROM inventory WHERE user_id = ? AND chat_id = ? ORDER BY item_type, item_id",
+            (user_id, chat_id),
+        )
+
+    def get_item_quantity(self, chat_id: int, user_id: int, item_id: str) -> int:
+        row = self._one(
+            "SELECT quantity FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
+            (user_id, chat_id, item_id),
+        )
+        return row["quantity"] if row else 0
+
+    def add_item(self, chat_id: int, user_id: int, item_id: str, item_type: str, quantity: int):
+        with db_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE inventory SET quantity = quantity + ? WHERE user_id = ? AND chat_id = ? AND item_id = ?",
+                (quantity, user_id, chat_id, item_id),
+            )
+            if c.rowcount == 0:
+                c.execute(
+                    "INSERT INTO inventory (user_id, chat_id, item_id, item_type, quantity) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, chat_id, item_id, item_type, quantity),
+                )
+
+    def remove_item(self, chat_id: int, user_id: int, item_id: str, quantity: int) -> bool:
+        with db_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT quantity FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
+                (user_id, chat_id, item_id),
+            )
+            row = c.fetchone()
+            if not row or row["quantity"] < quantity:
+                return False
+            if row["quantity"] == quantity:
+                c.execute(
+                    "DELETE FROM inventory WHERE user_id = ? AND chat_id = ? AND item_id = ?",
+                    (user_id, chat_id, item_id),
+                )
+            else:
+                c.execute(
+                    "UPDATE inventory SET quantity = quantity - ? WHERE user_id = ? AND chat_id = ? AND item_id = ?",
+                    (quantity, user_id, chat_id, item_id),
+                )
+        return True
+
+    # ---------- battles ----------
+
+    def get_battle(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._one("SELECT * FROM battles WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def save_battle(self, chat_id: int, user_id: int, values: Dict[str, Any]):
+        values = {"user_id": user_id, "chat_id": chat_id, **values, "updated_at": db_timestamp()}
+        columns = ", ".join(values)
+        placeholders = ", ".join("?" for _ in values)
+        self._execute(
+            f"INSERT OR REPLACE INTO battles ({columns}) VALUES ({placeholders})",
+            tuple(values.values()),
+        )
+
+    def update_battle(self, chat_id: int, user_id: int, **values):
+        values["updated_at"] = db_timestamp()
+        assignments = ", ".join(f"{col} = ?" for col in values)
+        self._execute(
+            f"UPDATE battles SET {assignments} WHERE user_id = ? AND chat_id = ?",
+            (*values.values(), user_id, chat_id),
+        )
+
+    def delete_battle(self, chat_id: int, user_id: int):
+        self._execute("DELETE FROM battles WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def all_battles(self) -> List[Dict[str, Any]]:
+        return self._all("SELECT * FROM battles", ())
+
+    def _expire_chunk(self, select_sql: str, change_sql: str, before: str, limit: int, *params) -> List[int]:
+        """Выбирает по индексу времени до limit user_id и применяет к ним change_sql"""
+        with db_connection() as conn:
+            user_ids = [row["user_id"] for row in conn.execute(select_sql, (before, limit))]
+            if user_ids:
+                placeholders = ", ".join("?" for _ in user_ids)
+                conn.execute(change_sql.format(placeholders=placeholders), (*params, *user_ids))
+        return user_ids
+
+    def expire_battles(self, before: str, limit: int) -> List[int]:
+        return self._expire_chunk(
+            "SELECT user_id FROM battles WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+            "DELETE FROM battles WHERE user_id IN ({placeholders})",
+            before,
+            limit,
+        )
+
+    # ---------- dungeon_progress ----------
+
+    def get_dungeon(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._one("SELECT * FROM dungeon_progress WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def save_dungeon(self, chat_id: int, user_id: int, **values):
+        values["updated_at"] = db_timestamp()
+        with db_connection() as conn:
+            c = conn.cursor()
+            assignments = ", ".join(f"{col} = ?" for col in values)
+            c.execute(
+                f"UPDATE dungeon_progress SET {assignments} WHERE user_id = ? AND chat_id = ?",
+                (*values.values(), user_id, chat_id),
+            )
+            if c.rowcount == 0:
+                row = {"user_id": user_id, "chat_id": chat_id, **values}
+                columns = ", ".join(row)
+                placeholders = ", ".join("?" for _ in row)
+                c.execute(f"INSERT INTO dungeon_progress ({columns}) VALUES ({placeholders})", tuple(row.values()))
+
+    def expire_dungeons(self, before: str, limit: int) -> int:
+        return len(self._expire_chunk(
+            """
+            SELECT user_id FROM dungeon_progress
+            WHERE is_active = 1 AND updated_at < ?
+            ORDER BY updated_at
+            LIMIT ?
+            """,
+            """
+            UPDATE dungeon_progress
+            SET is_active = 0, current_floor = 1, run_plan = NULL, updated_at = ?
+            WHERE user_id IN ({placeholders})
+            """,
+            before,
+            limit,
+            db_timestamp(),
+        ))
+
+    # ---------- pvp_queue ----------
+
+    def enqueue_pvp(self, chat_id: int, user_id: int):
+        self._execute(
+            """
+            INSERT OR REPLACE INTO pvp_queue (user_id, chat_id, is_waiting, confirmed, timestamp)
+            VALUES (?, ?, 1, 1, CURRENT_TIMESTAMP)
+            """,
+            (user_id, chat_id),
+        )
+
+    def dequeue_pvp(self, chat_id: int, user_id: int):
+        self._execute("DELETE FROM pvp_queue WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def claim_pvp_opponent(self, user_id: int) -> bool:
+        return self._execute(
+            "DELETE FROM pvp_queue WHERE user_id = ? AND is_waiting = 1 AND confirmed = 1",
+            (user_id,),
+        ) > 0
+
+    def pvp_queue_entries(self) -> List[Dict[str, Any]]:
+        # CROSS JOIN фиксирует порядок соединения: очередь читается по
+        # idx_pvp_queue_waiting уже в порядке timestamp, игрок — по PRIMARY KEY
+        return self._all(
+            """
+            SELECT q.user_id, q.chat_id, p.level, p.mmr, q.timestamp
+            FROM pvp_queue q
+            CROSS JOIN players p ON p.user_id = q.user_id
+            WHERE q.confirmed = 1
+              AND q.is_waiting = 1
+            ORDER BY q.timestamp ASC
+            """,
+            (),
+        )
+
+    def expire_pvp_queue(self, before: str, limit: int) -> int:
+        return len(self._expire_chunk(
+            "SELECT user_id FROM pvp_queue WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+            "DELETE FROM pvp_queue WHERE user_id IN ({placeholders})",
+            before,
+            limit,
+        ))
+
+    # ---------- pvp_battles ----------
+
+    def record_pvp_battle(
+        self, attacker_id: int, defender_id: int, chat_id: int, winner_id: int, reward_gold: int
+    ) -> int:
+        with db_connection() as conn:
+            c = conn.execute(
+                """
+                INSERT INTO pvp_battles (attacker_id, defender_id, chat_id, winner_id, reward_gold)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (attacker_id, defender_id, chat_id, winner_id, reward_gold),
+            )
+            return c.lastrowid
+
+    # ---------- tournaments ----------
+
+    def record_tournament(
+        self,
+        chat_id: int,
+        fmt: str,
+        entrants: int,
+        rounds: int,
+        winner_id: int,
+        prize_pool: int,
+        matches: List[Tuple[int, int, int, int, int, int]],
+    ) -> int:
+        with db_connection() as conn:
+            c = conn.execute(
+                """
+                INSERT INTO tournaments (chat_id, format, entrants, rounds, winner_id, prize_pool)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (chat_id, fmt, entrants, rounds, winner_id, prize_pool),
+            )
+            tournament_id = c.lastrowid
+            conn.executemany(
+                """
+                INSERT INTO tournament_matches (tournament_id, round, player_a, player_b, winner_id, turns, seed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [(tournament_id,) + match for match in matches],
+            )
+            return tournament_id
+
+
+class MemoryStorage(Storage):
+    """Хранилище в словарях процесса: без диска, для тестов и симуляций.
+
+    Таблицы — dict по первичному ключу (user_id), инвентарь — dict по
+    (user_id, item_id), очередь ПВП хранит порядок вставки. Транзакция держит
+    общий RLock и журнал отмены: при исключении изменения откатываются.
+    """
+
+    name = "memory"
+
+    PLAYER_DEFAULTS: Dict[str, Any] = {
+        "username": None,
+        "level": 1,
+        "xp": 0,
+        "health": None,
+        "max_health": None,
+        "mana": None,
+        "max_mana": None,
+        "attack": None,
+        "defense": None,
+        "gold": 0,
+        "dungeon_rating": 0,
+        "equipped_weapon": None,
+        "equipped_armor": None,
+        "equipped_rune": None,
+        "pet_id": "wolf",
+        "pet_level": 1,
+        "total_kills": 0,
+        "total_bosses_killed": 0,
+        "total_battles_won": 0,
+        "total_battles_lost": 0,
+        "pvp_wins": 0,
+        "pvp_losses": 0,
+        "mmr": None,
+        "craft_count": 0,
+        "current_location": None,
+        "last_daily_reward": None,
+    }
+
+    BATTLE_DEFAULTS: Dict[str, Any] = {
+        "location_id": None,
+        "enemy_health": None,
+        "enemy_max_health": None,
+        "enemy_damage": None,
+        "is_boss": 0,
+        "player_health": None,
+        "player_max_health": None,
+        "is_dungeon": 0,
+        "seed": None,
+        "actions": "",
+        "combat_stats": None,
+        "updated_at": None,
+    }
+
+    DUNGEON_DEFAULTS: Dict[str, Any] = {
+        "current_floor": 1,
+        "is_active": 0,
+        "enemies_killed": 0,
+        "run_plan": None,
+        "updated_at": None,
+    }
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.players: Dict[int, Dict[str, Any]] = {}
+        self.inventory: Dict[int, Dict[str, Dict[str, Any]]] = {}
+        self.battles: Dict[int, Dict[str, Any]] = {}
+        self.dungeon_progress: Dict[int, Dict[str, Any]] = {}
+        self.pvp_queue: Dict[int, Dict[str, Any]] = {}
+        self.pvp_battles: List[Dict[str, Any]] = []
+        self.tournaments: List[Dict[str, Any]] = []
+        self.tournament_matches: List[Dict[str, Any]] = []
+        self._inventory_seq = 0
+
+    def init_schema(self):
+        pass  # таблицы — словари, создавать нечего
+
+    # ---------- транзакции ----------
+
+    @contextmanager
+    def transaction(self):
+        if self.in_transaction():
+            yield self
+            return
+        with self._lock:
+            self._local.undo = []
+            self._local.commit = []
+            try:
+                yield self
+                committed = self._local.commit
+            except Exception:
+                for undo in reversed(self._local.undo):
+                    undo()
+                raise
+            finally:
+                self._local.undo = None
+                self._local.commit = None
+            run_commit_hooks(committed)
+
+    def in_transaction(self) -> bool:
+        return getattr(self._local, "undo", None) is not None
+
+    def on_rollback(self, undo: Callable):
+        pending = getattr(self._local, "undo", None)
+        if pending is not None:
+            pending.append(undo)
+
+    def on_commit(self, action: Callable):
+        pending = getattr(self._local, "commit", None)
+        if pending is None:
+            action()
+        else:
+            pending.append(action)
+
+    def _put(self, table: Dict, key: Any, row: Optional[Dict[str, Any]]):
+        """Записывает (или удаляет при row=None) строку с отменой в транзакции"""
+        before = table.get(key)
+        if row is None:
+            table.pop(key, None)
+        else:
+            table[key] = row
+        if before is None:
+            self.on_rollback(lambda: table.pop(key, None))
+        else:
+            self.on_rollback(lambda: table.__setitem__(key, before))
+
+    def _owned(self, table: Dict, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        row = table.get(user_id)
+        return row if row is not None and row["chat_id"] == chat_id else None
+
+    # ---------- players ----------
+
+    def get_player(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._owned(self.players, chat_id, user_id)
+            return dict(row) if row else None
+
+    def get_player_by_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self.players.get(user_id)
+            return dict(row) if row else None
+
+    def player_exists(self, chat_id: int, user_id: int) -> bool:
+        with self._lock:
+            return self._owned(self.players, chat_id, user_id) is not None
+
+    def insert_player(self, values: Dict[str, Any], items: List[Tuple[str, str, int]] = ()) -> bool:
+        with self.transaction():
+            user_id = values["user_id"]
+            if user_id in self.players:
+                return False
+            row = {**self.PLAYER_DEFAULTS, "created_at": db_timestamp(), **values}
+            self._put(self.players, user_id, row)
+            owned = self.inventory.get(user_id, {})
+            for item_id, item_type, quantity in items:
+                if item_id not in owned:
+                    self.add_item(values["chat_id"], user_id, item_id, item_type, quantity)
+            return True
+
+    def update_players(self, updates: List[Tuple[int, int, Dict[str, Any]]]):
+        with self.transaction():
+            for chat_id, user_id, values in updates:
+                row = self._owned(self.players, chat_id, user_id)
+                if row is not None and values:
+                    self._put(self.players, user_id, {**row, **values})
+
+    def _chat_players(self, chat_id: int) -> List[Dict[str, Any]]:
+        return [row for row in self.players.values() if row["chat_id"] == chat_id]
+
+    def top_players(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        columns = (
+            "user_id", "username", "level", "xp", "gold", "total_kills", "total_bosses_killed",
+            "total_battles_won", "total_battles_lost", "pvp_wins", "pvp_losses",
+        )
+        with self._lock:
+            rows = sorted(
+                self._chat_players(chat_id),
+                key=lambda r: (r["level"], r["gold"], r["total_kills"]),
+                reverse=True,
+            )[:limit]
+            return [{col: row[col] for col in columns} for row in rows]
+
+    def top_pvp(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        columns = ("user_id", "username", "level", "mmr", "pvp_wins", "pvp_losses")
+        with self._lock:
+            rows = sorted(
+                (r for r in self._chat_players(chat_id) if r["mmr"] is not None),
+                key=lambda r: r["mmr"],
+                reverse=True,
+            )[:limit]
+            return [{col: row[col] for col in columns} for row in rows]
+
+    def count_pvp_above(self, chat_id: int, mmr: int) -> int:
+        with self._lock:
+            return sum(1 for r in self._chat_players(chat_id) if r["mmr"] is not None and r["mmr"] > mmr)
+
+    def top_dungeon(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        columns = ("username", "level", "dungeon_rating", "total_bosses_killed")
+        with self._lock:
+            rows = sorted(
+                (r for r in self._chat_players(chat_id) if r["dungeon_rating"] > 0),
+                key=lambda r: (r["dungeon_rating"], r["total_bosses_killed"]),
+                reverse=True,
+            )[:limit]
+            return [{col: row[col] for col in columns} for row in rows]
+
+    def count_ranked_above(self, chat_id: int, level: int, gold: int) -> int:
+        with self._lock:
+            return sum(
+                1
+                for r in self._chat_players(chat_id)
+                if r["level"] > level or (r["level"] == level and r["gold"] > gold)
+            )
+
+    # ---------- inventory ----------
+
+    def get_inventory(self, chat_id: int, user_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = [dict(r) for r in self.inventory.get(user_id, {}).values() if r["chat_id"] == chat_id]
+        rows.sort(key=lambda r: (r["item_type"] or "", r["item_id"]))
+        return rows
+
+    def get_item_quantity(self, chat_id: int, user_id: int, item_id: str) -> int:
+        with self._lock:
+            row = self.inventory.get(user_id, {}).get(item_id)
+            return row["quantity"] if row and row["chat_id"] == chat_id else 0
+
+    def add_item(self, chat_id: int, user_id: int, item_id: str, item_type: str, quantity: int):
+        with self.transaction():
+            owned = self.inventory.setdefault(user_id, {})
+            row = owned.get(item_id)
+            if row is not None and row["chat_id"] == chat_id:
+                self._put(owned, item_id, {**row, "quantity": row["quantity"] + quantity})
+                return
+            if row is not None:
+                return  # UNIQUE(user_id, item_id) — строка другого чата
+            self._inventory_seq += 1
+            self._put(
+                owned,
+                item_id,
+                {
+                    "id": self._inventory_seq,
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "item_id": item_id,
+                    "item_type": item_type,
+                    "quantity": quantity,
+                },
+            )
+
+    def remove_item(self, chat_id: int, user_id: int, item_id: str, quantity: int) -> bool:
+        with self.transaction():
+            owned = self.inventory.get(user_id, {})
+            row = owned.get(item_id)
+            if not row or row["chat_id"] != chat_id or row["quantity"] < quantity:
+                return False
+            if row["quantity"] == quantity:
+                self._put(owned, item_id, None)
+            else:
+                self._put(owned, item_id, {**row, "quantity": row["quantity"] - quantity})
+            return True
+
+    # ---------- battles ----------
+
+    def get_battle(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._owned(self.battles, chat_id, user_id)
+            return dict(row) if row else None
+
+    def save_battle(self, chat_id: int, user_id: int, values: Dict[str, Any]):
+        row = {**self.BATTLE_DEFAULTS, **values, "user_id": user_id, "chat_id": chat_id, "updated_at": db_timestamp()}
+        with self.transaction():
+            self._put(self.battles, user_id, row)
+
+    def update_battle(self, chat_id: int, user_id: int, **values):
+        with self.transaction():
+            row = self._owned(self.battles, chat_id, user_id)
+            if row is not None:
+                self._put(self.battles, user_id, {**row, **values, "updated_at": db_timestamp()})
+
+    def delete_battle(self, chat_id: int, user_id: int):
+        with self.transaction():
+            if self._owned(self.battles, chat_id, user_id) is not None:
+                self._put(self.battles, user_id, None)
+
+    def all_battles(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(row) for row in self.battles.values()]
+
+    def _stale(self, table: Dict[int, Dict[str, Any]], column: str, before: str, limit: int, **where) -> List[int]:
+        rows = [
+            row for row in table.values()
+            if row[column] < before and all(row[key] == value for key, value in where.items())
+        ]
+        rows.sort(key=lambda row: row[column])
+        return [row["user_id"] for row in rows[:limit]]
+
+    def expire_battles(self, before: str, limit: int) -> List[int]:
+        with self.transaction():
+            user_ids = self._stale(self.battles, "updated_at", before, limit)
+            for user_id in user_ids:
+                self._put(self.battles, user_id, None)
+            return user_ids
+
+    # ---------- dungeon_progress ----------
+
+    def get_dungeon(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._owned(self.dungeon_progress, chat_id, user_id)
+            return dict(row) if row else None
+
+    def save_dungeon(self, chat_id: int, user_id: int, **values):
+        with self.transaction():
+            row = self._owned(self.dungeon_progress, chat_id, user_id)
+            if row is None:
+                row = {**self.DUNGEON_DEFAULTS, "user_id": user_id, "chat_id": chat_id}
+            self._put(self.dungeon_progress, user_id, {**row, **values, "updated_at": db_timestamp()})
+
+    def expire_dungeons(self, before: str, limit: int) -> int:
+        with self.transaction():
+            user_ids = self._stale(self.dungeon_progress, "updated_at", before, limit, is_active=1)
+            for user_id in user_ids:
+                row = self.dungeon_progress[user_id]
+                self._put(
+                    self.dungeon_progress,
+                    user_id,
+                    {**row, "is_active": 0, "current_floor": 1, "run_plan": None, "updated_at": db_timestamp()},
+                )
+            return len(user_ids)
+
+    # ---------- pvp_queue ----------
+
+    def enqueue_pvp(self, chat_id: int, user_id: int):
+        with self.transaction():
+            # INSERT OR REPLACE: повторная постановка уходит в конец очереди
+            self._put(self.pvp_queue, user_id, None)
+            self._put(
+                self.pvp_queue,
+                user_id,
+                {
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "is_waiting": 1,
+                    "confirmed": 1,
+                    "timestamp": db_timestamp(),
+                },
+            )
+
+    def dequeue_pvp(self, chat_id: int, user_id: int):
+        with self.transaction():
+            if self._owned(self.pvp_queue, chat_id, user_id) is not None:
+                self._put(self.pvp_queue, user_id, None)
+
+    def claim_pvp_opponent(self, user_id: int) -> bool:
+        with self.transaction():
+            entry = self.pvp_queue.get(user_id)
+            if not entry or not (entry["is_waiting"] and entry["confirmed"]):
+                return False
+            self._put(self.pvp_queue, user_id, None)
+            return True
+
+    def pvp_queue_entries(self) -> List[Dict[str, Any]]:
+        entries = []
+        with self._lock:
+            for entry in sorted(self.pvp_queue.values(), key=lambda entry: entry["timestamp"]):
+                player = self.players.get(entry["user_id"])
+                if player and entry["confirmed"] and entry["is_waiting"]:
+                    entries.append({
+                        "user_id": entry["user_id"],
+                        "chat_id": entry["chat_id"],
+                        "level": player["level"],
+                        "mmr": player["mmr"],
+                        "timestamp": entry["timestamp"],
+                    })
+        return entries
+
+    def expire_pvp_queue(self, before: str, limit: int) -> int:
+        with self.transaction():
+            user_ids = self._stale(self.pvp_queue, "timestamp", before, limit)
+            for user_id in user_ids:
+                self._put(self.pvp_queue, user_id, None)
+            return len(user_ids)
+
+    # ---------- pvp_battles ----------
+
+    def record_pvp_battle(
+        self, attacker_id: int, defender_id: int, chat_id: int, winner_id: int, reward_gold: int
+    ) -> int:
+        with self.transaction():
+            battle_id = len(self.pvp_battles) + 1
+            self.pvp_battles.append(
+                {
+                    "id": battle_id,
+                    "attacker_id": attacker_id,
+                    "defender_id": defender_id,
+                    "chat_id": chat_id,
+                    "winner_id": winner_id,
+                    "reward_gold": reward_gold,
+                    "battle_date": db_timestamp(),
+                }
+            )
+            self.on_rollback(self.pvp_battles.pop)
+            return battle_id
+
+    # ---------- tournaments ----------
+
+    def record_tournament(
+        self,
+        chat_id: int,
+        fmt: str,
+        entrants: int,
+        rounds: int,
+        winner_id: int,
+        prize_pool: int,
+        matches: List[Tuple[int, int, int, int, int, int]],
+    ) -> int:
+        columns = ("round", "player_a", "player_b", "winner_id", "turns", "seed")
+        with self.transaction():
+            tournament_id = len(self.tournaments) + 1
+            self.tournaments.append(
+                {
+                    "id": tournament_id,
+                    "chat_id": chat_id,
+                    "format": fmt,
+                    "entrants": entrants,
+                    "rounds": rounds,
+                    "winner_id": winner_id,
+                    "prize_pool": prize_pool,
+                    "finished_at": db_timestamp(),
+                }
+            )
+            self.on_rollback(self.tournaments.pop)
+            mark = len(self.tournament_matches)
+            self.tournament_matches.extend(
+                {"tournament_id": tournament_id, **dict(zip(columns, match))} for match in matches
+            )
+            self.on_rollback(lambda: self.tournament_matches.__delitem__(slice(mark, None)))
+            return tournament_id
+
+
+STORAGE_BACKENDS: Dict[str, Callable[[], Storage]] = {
+    "sqlite": SQLiteStorage,
+    "memory": MemoryStorage,
+}
+
+storage: Storage = STORAGE_BACKENDS[STORAGE_BACKEND]()
+
+
+# ===================== КЕШ ИГРОКОВ =====================
+
+_UNSET = object()
+
+
+class PlayerCache:
+    """Кеш строк players с отложенной записью (write-behind).
+
+    get_player читает из памяти, изменения применяются к строке в кеше и
+    дописываются в журнал (JSON-строки с итоговыми значениями столбцов).
+    Внутри транзакции изменения сначала копятся в черновике потока (его
+    видит только сама транзакция) и попадают в строку и журнал хуком после
+    COMMIT; откат просто выбрасывает черновик.
+    Фоновый поток раз в PLAYER_CACHE_FLUSH_SEC сбрасывает изменённые столбцы
+    в хранилище одной транзакцией; при старте recover() проигрывает журнал,
+    оставшийся после падения. Вытесняются только чистые строки (LRU).
+    """
+
+    def __init__(self, capacity: int, flush_interval: float, journal_path: str):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self._rows: "OrderedDict[Tuple[int, int], Dict[str, Any]]" = OrderedDict()
+        self._by_user: Dict[int, Tuple[int, int]] = {}
+        self._dirty: Dict[Tuple[int, int], set] = {}
+        self._dirty_since: Dict[Tuple[int, int], float] = {}
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._tx = threading.local()
+        self._journal = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+
+    # ---------- чтение ----------
+
+    def _remember(self, key: Tuple[int, int], loaded: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            row = self._rows.setdefault(key, loaded)
+            self._by_user[key[1]] = key
+            self._evict()
+            return row
+
+    def _ensure(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        key = (chat_id, user_id)
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self.hits += 1
+                self._rows.move_to_end(key)
+                return row
+            self.misses += 1
+
+        loaded = storage.get_player(chat_id, user_id)
+        return self._remember(key, loaded) if loaded else None
+
+    def _staged(self) -> Dict[Tuple[int, int], Dict[str, Any]]:
+        """Черновик незафиксированных изменений текущего потока"""
+        staged = getattr(self._tx, "staged", None)
+        if staged is None:
+            staged = self._tx.staged = {}
+        return staged
+
+    def _view(self, key: Tuple[int, int], row: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            return {**row, **self._staged().get(key, {})}
+
+    def get(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        row = self._ensure(chat_id, user_id)
+        if row is None:
+            return None
+        return self._view((chat_id, user_id), row)
+
+    def get_by_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            key = self._by_user.get(user_id)
+        if key is not None:
+            return self.get(*key)
+
+        with self._lock:
+            self.misses += 1
+        loaded = storage.get_player_by_user(user_id)
+        if not loaded:
+            return None
+        key = (loaded["chat_id"], user_id)
+        return self._view(key, self._remember(key, loaded))
+
+    # ---------- изменения ----------
+
+    def mutate(
+        self,
+        chat_id: int,
+        user_id: int,
+        apply: Callable[[Dict[str, Any]], Dict[str, Any]],
+    ) -> Optional[Dict[str, Any]]:
+        """Атомарно применяет apply(строка) -> {столбец: значение}; возвращает изменения"""
+        key = (chat_id, user_id)
+        row = self._ensure(chat_id, user_id)
+        if row is None:
+            return None
+        with self._lock:
+            row = self._rows.setdefault(key, row)
+            if not storage.in_transaction():
+                changes = apply(dict(row))
+                if changes:
+                    row.update(changes)
+                    self._mark_dirty(key, changes)
+                return changes
+
+            staged = self._staged().setdefault(key, {})
+            changes = apply({**row, **staged})
+            if changes:
+                before = {col: staged.get(col, _UNSET) for col in changes}
+                staged.update(changes)
+                storage.on_rollback(lambda: self._unstage(key, before))
+                storage.on_commit(lambda: self._commit(key, row, changes))
+            return changes
+
+    def set(self, chat_id: int, user_id: int, **values) -> bool:
+        return self.mutate(chat_id, user_id, lambda row: values) is not None
+
+    def add(self, chat_id: int, user_id: int, **deltas) -> bool:
+        return (
+            self.mutate(
+                chat_id,
+                user_id,
+                lambda row: {col: row[col] + delta for col, delta in deltas.items()},
+            )
+            is not None
+        )
+
+    def _unstage(self, key: Tuple[int, int], before: Dict[str, Any]):
+        staged = self._staged().get(key, {})
+        for col, value in before.items():
+            if value is _UNSET:
+                staged.pop(col, None)
+            else:
+                staged[col] = value
+        if not staged:
+            self._staged().pop(key, None)
+
+    def _commit(self, key: Tuple[int, int], row: Dict[str, Any], changes: Dict[str, Any]):
+        """Хук после COMMIT: переносит изменения из черновика в строку и журнал"""
+        with self._lock:
+            row = self._rows.setdefault(key, row)
+            self._by_user[key[1]] = key
+            row.update(changes)
+            self._mark_dirty(key, changes)
+            staged = self._staged().get(key, {})
+            for col, value in changes.items():
+                if staged.get(col, _UNSET) == value:
+                    del staged[col]
+            if not staged:
+                self._staged().pop(key, None)
+
+    def _mark_dirty(self, key: Tuple[int, int], values: Dict[str, Any]):
+        self._dirty.setdefault(key, set()).update(values)
+        self._dirty_since.setdefault(key, time.monotonic())
+        self._write_journal(key, values)
+
+    def _evict(self):
+        if len(self._rows) <= self.capacity:
+            return
+        for key in list(self._rows):
+            if len(self._rows) <= self.capacity:
+                break
+            if key in self._dirty:
+                continue
+            del self._rows[key]
+            self._by_user.pop(key[1], None)
+            self.evictions += 1
+
+    # ---------- журнал ----------
+
+    def _write_journal(self, key: Tuple[int, int], values: Dict[str, Any]):
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps({"k": key, "v": values}, ensure_ascii=False) + "\n")
+        self._journal.flush()
+
+    def _rotate_journal(self):
+        """Переносит текущий журнал в .flushing до подтверждения записи в SQLite"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not os.path.exists(self.journal_path):
+            return
+        flushing = self.journal_path + ".flushing"
+        if not os.path.exists(flushing):
+            os.replace(self.journal_path, flushing)
+            return
+        with open(self.journal_path, encoding="utf-8") as src, open(flushing, "a", encoding="utf-8") as dst:
+            dst.write(src.read())
+        os.remove(self.journal_path)
+
+    def recover(self) -> int:
+        """Проигрывает журнал, оставшийся после аварийной остановки"""
+        applied = 0
+        paths = [p for p in (self.journal_path + ".flushing", self.journal_path) if os.path.exists(p)]
+        if not paths:
+            return 0
+
+        with storage.transaction():
+            for path in paths:
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break  # оборванная последняя запись
+                        (chat_id, user_id), values = entry["k"], entry["v"]
+                        if not values or not all(col.isidentifier() for col in values):
+                            continue
+                        storage.update_players([(chat_id, user_id, values)])
+                        applied += 1
+
+        for path in paths:
+            os.remove(path)
+        logger.info(f"♻️ Журнал кеша игроков: применено {applied} записей")
+        return applied
+
+    # ---------- сброс в SQLite ----------
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                batch = {
+                    key: {col: self._rows[key][col] for col in cols}
+                    for key, cols in self._dirty.items()
+                }
+                oldest = min(self._dirty_since.values())
+                self._dirty.clear()
+                self._dirty_since.clear()
+                self._rotate_journal()
+
+            try:
+                db_writer.call(
+                    storage.update_players,
+                    [(chat_id, user_id, values) for (chat_id, user_id), values in batch.items()],
+                )
+            except Exception as e:
+                logger.error(f"Ошибка сброса кеша игроков: {e}")
+                with self._lock:
+                    for key, values in batch.items():
+                        self._dirty.setdefault(key, set()).update(values)
+                        self._dirty_since.setdefault(key, oldest)
+                return 0
+
+            flushing = self.journal_path + ".flushing"
+            if os.path.exists(flushing):
+                os.remove(flushing)
+
+            lag = time.monotonic() - oldest
+            with self._lock:
+                self.flushes += 1
+                self.rows_flushed += len(batch)
+                self.last_flush_lag = lag
+                self.max_flush_lag = max(self.max_flush_lag, lag)
+                self._evict()
+            return len(batch)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фонового сброса кеша: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="player-cache-flush", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._rows),
+                "capacity": self.capacity,
+                "dirty": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "flushes": self.flushes,
+                "rows_flushed": self.rows_flushed,
+                "last_flush_lag_sec": round(self.last_flush_lag, 3),
+                "max_flush_lag_sec": round(self.max_flush_lag, 3),
+            }
+
+
+player_cache = PlayerCache(PLAYER_CACHE_SIZE, PLAYER_CACHE_FLUSH_SEC, PLAYER_JOURNAL_PATH)
+
+
+# ===================== ПРОФИЛЬ СТАТОВ =====================
+
+class StatProfile:
+    """Итоговые боевые статы: класс, уровень, оружие, броня, питомец и руна"""
+
+    __slots__ = ("attack", "defense", "crit_chance", "spell_power")
+
+    def __init__(self, attack: int, defense: int, crit_chance: int, spell_power: int):
+        self.attack = attack
+        self.defense = defense
+        self.crit_chance = crit_chance
+        self.spell_power = spell_power
+
+    def as_dict(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def compile_stat_profile(player: Dict[str, Any]) -> StatProfile:
+    info = CLASSES[player["class"]]
+    attack = player["attack"]
+    defense = player["defense"]
+    crit_chance = info.get("crit_chance", 5)
+
+    weapon = WEAPONS.get(player["equipped_weapon"])
+    if weapon:
+        attack += weapon["attack"]
+        crit_chance += weapon["crit"]
+
+    armor = ARMOR.get(player["equipped_armor"])
+    if armor:
+        defense += armor["defense"]
+
+    pet = PETS.get(player["pet_id"])
+    if pet:
+        attack += pet["attack_bonus"]
+        defense += pet["defense_bonus"]
+
+    rune = RUNES.get(player.get("equipped_rune"))
+    if rune:
+        attack += rune["attack_bonus"]
+        defense += rune["defense_bonus"]
+        crit_chance += rune["crit_bonus"]
+
+    return StatProfile(attack, defense, crit_chance, info.get("spell_power", 0))
+
+
+class StatProfileCache:
+    """Скомпилированные StatProfile по (chat_id, user_id).
+
+    Профиль собирается из строки player_cache при первом обращении и живёт
+    до invalidate(): его вызывают equip_weapon, equip_armor, equip_rune,
+    buy_pet и повышение уровня в add_xp. Счётчик поколений не даёт сохранить
+    профиль, собранный из строки, которую успели изменить параллельно.
+    invalidate() вызывается после изменения строки, поэтому его хук после
+    COMMIT срабатывает уже тогда, когда player_cache показывает новую строку.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._profiles: "OrderedDict[Tuple[int, int], StatProfile]" = OrderedDict()
+        self._generation: Dict[Tuple[int, int], int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, chat_id: int, user_id: int) -> Optional[StatProfile]:
+        key = (chat_id, user_id)
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is not None:
+                self.hits += 1
+                self._profiles.move_to_end(key)
+                return profile
+            self.misses += 1
+            generation = self._generation.get(key, 0)
+
+        player = player_cache.get(chat_id, user_id)
+        if not player:
+            return None
+        profile = compile_stat_profile(player)
+        with self._lock:
+            if self._generation.get(key, 0) == generation:
+                self._profiles[key] = profile
+                while len(self._profiles) > self.capacity:
+                    self._profiles.popitem(last=False)
+        return profile
+
+    def _drop(self, key: Tuple[int, int]):
+        with self._lock:
+            self._profiles.pop(key, None)
+            self._generation[key] = self._generation.get(key, 0) + 1
+
+    def invalidate(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id)
+        self._drop(key)
+        self.invalidations += 1
+        # Откат вернёт строке старое снаряжение — профиль снова устареет
+        storage.on_rollback(lambda: self._drop(key))
+        # До COMMIT другие потоки видят старую строку и могли собрать по ней
+        # профиль уже под новым поколением — сбрасываем его ещё раз
+        storage.on_commit(lambda: self._drop(key))
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+            self._generation.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._profiles),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+stat_profiles = StatProfileCache(PLAYER_CACHE_SIZE)
+
+
+# ===================== АКТИВНЫЕ БОИ =====================
+
+class BattleStore:
+    """Активные бои охоты и подземелья в памяти процесса.
+
+    Таблица battles больше не служит черновиком на каждый удар: start_battle,
+    perform_attack и end_battle меняют только память, а фоновый поток раз в
+    BATTLE_CHECKPOINT_SEC записывает изменённые и удалённые бои одной
+    транзакцией (и ещё раз при остановке). rehydrate() при старте поднимает
+    бои из таблицы; до него промах читается из хранилища. Бой без действий
+    дольше BATTLE_IDLE_TTL_SEC считается брошенным и удаляется.
+    Как и в одной строке battles, у игрока не больше одного боя.
+    """
+
+    def __init__(self, idle_ttl: float, checkpoint_interval: float):
+        self.idle_ttl = idle_ttl
+        self.checkpoint_interval = checkpoint_interval
+        self._battles: Dict[int, Dict[str, Any]] = {}
+        self._touched: Dict[int, float] = {}
+        self._dirty: set = set()
+        self._deleted: Dict[int, int] = {}  # user_id -> chat_id строки, которую нужно удалить
+        self._lock = threading.RLock()
+        self._checkpoint_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.rehydrated = False
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.checkpoints = 0
+        self.rows_checkpointed = 0
+        self.last_checkpoint_at = 0.0
+
+    # ---------- чтение ----------
+
+    def _expire(self, user_id: int, now: float) -> bool:
+        if now - self._touched.get(user_id, now) <= self.idle_ttl:
+            return False
+        row = self._battles.pop(user_id)
+        self._touched.pop(user_id, None)
+        self._dirty.discard(user_id)
+        self._deleted[user_id] = row["chat_id"]
+        self.expired += 1
+        return True
+
+    def get(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._battles.get(user_id)
+            if row is not None and not self._expire(user_id, time.monotonic()):
+                self.hits += 1
+                return dict(row) if row["chat_id"] == chat_id else None
+            self.misses += 1
+            if self.rehydrated or user_id in self._deleted:
+                return None
+
+        loaded = storage.get_battle(chat_id, user_id)
+        if not loaded:
+            return None
+        with self._lock:
+            if user_id in self._deleted:
+                return None
+            row = self._battles.setdefault(user_id, loaded)
+            self._touched.setdefault(user_id, time.monotonic())
+            return dict(row) if row["chat_id"] == chat_id else None
+
+    # ---------- изменения ----------
+
+    def _change(self, user_id: int, row: Optional[Dict[str, Any]]):
+        """Ставит строку боя (None — удаляет) и регистрирует откат"""
+        before = self._battles.get(user_id)
+        was_deleted = self._deleted.get(user_id)
+        self._put(user_id, row)
+        storage.on_rollback(lambda: self._undo(user_id, before, was_deleted))
+
+    def _put(self, user_id: int, row: Optional[Dict[str, Any]]):
+        with self._lock:
+            if row is None:
+                old = self._battles.pop(user_id, None)
+                self._touched.pop(user_id, None)
+                self._dirty.discard(user_id)
+                if old is not None:
+                    self._deleted[user_id] = old["chat_id"]
+            else:
+                self._battles[user_id] = row
+                self._touched[user_id] = time.monotonic()
+                self._dirty.add(user_id)
+
+    def _undo(self, user_id: int, before: Optional[Dict[str, Any]], was_deleted: Optional[int]):
+        with self._lock:
+            self._put(user_id, before)
+            if was_deleted is not None:
+                self._deleted[user_id] = was_deleted
+
+    def save(self, chat_id: int, user_id: int, values: Dict[str, Any]):
+        row = {**MemoryStorage.BATTLE_DEFAULTS, **values, "user_id": user_id, "chat_id": chat_id}
+        self._change(user_id, row)
+
+    def update(self, chat_id: int, user_id: int, **values):
+        with self._lock:
+            row = self._battles.get(user_id)
+            if row is None or row["chat_id"] != chat_id:
+                return
+            self._change(user_id, {**row, **values})
+
+    def delete(self, chat_id: int, user_id: int):
+        with self._lock:
+            row = self._battles.get(user_id)
+            if row is not None and row["chat_id"] == chat_id:
+                self._change(user_id, None)
+            elif row is None and not self.rehydrated:
+                # Строка могла остаться в таблице — удалим при контрольной точке
+                self._deleted[user_id] = chat_id
+
+    # ---------- контрольные точки ----------
+
+    def rehydrate(self) -> int:
+        """Поднимает бои, сохранённые при прошлой остановке.
+
+        Время простоя продолжается с updated_at строки, так что бой, брошенный
+        до перезапуска, не получает новый BATTLE_IDLE_TTL_SEC.
+        """
+        rows = storage.all_battles()
+        now = time.monotonic()
+        with self._lock:
+            for row in rows:
+                if row["user_id"] not in self._battles and row["user_id"] not in self._deleted:
+                    self._battles[row["user_id"]] = row
+                    self._touched[row["user_id"]] = now - db_timestamp_age(row.get("updated_at"))
+            self.rehydrated = True
+        logger.info(f"♻️ Активных боёв восстановлено: {len(rows)}")
+        return len(rows)
+
+    def _write(self, rows: List[Dict[str, Any]], deleted: Dict[int, int]):
+        for user_id, chat_id in deleted.items():
+            storage.delete_battle(chat_id, user_id)
+        for row in rows:
+            values = {col: value for col, value in row.items() if col not in ("user_id", "chat_id")}
+            storage.save_battle(row["chat_id"], row["user_id"], values)
+
+    def checkpoint(self) -> int:
+        with self._checkpoint_lock:
+            with self._lock:
+                now = time.monotonic()
+                for user_id in list(self._battles):
+                    self._expire(user_id, now)
+                if not self._dirty and not self._deleted:
+                    return 0
+                rows = [dict(self._battles[user_id]) for user_id in self._dirty]
+                deleted = dict(self._deleted)
+                self._dirty.clear()
+                self._deleted.clear()
+
+            try:
+                db_writer.call(self._write, rows, deleted)
+            except Exception as e:
+                logger.error(f"Ошибка контрольной точки боёв: {e}")
+                with self._lock:
+                    for row in rows:
+                        if row["user_id"] in self._battles:
+                            self._dirty.add(row["user_id"])
+                    for user_id, chat_id in deleted.items():
+                        if user_id not in self._battles:
+                            self._deleted.setdefault(user_id, chat_id)
+                return 0
+
+            with self._lock:
+                self.checkpoints += 1
+                self.rows_checkpointed += len(rows) + len(deleted)
+                self.last_checkpoint_at = time.time()
+            return len(rows) + len(deleted)
+
+    def keep(self, user_ids: Iterable[int]) -> int:
+        """Строки этих боёв удалены из таблицы; живые бои запишутся при следующей точке"""
+        with self._lock:
+            alive = [user_id for user_id in user_ids if user_id in self._battles]
+            self._dirty.update(alive)
+            return len(alive)
+
+    def _checkpoint_loop(self):
+        while not self._stop.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой контрольной точки боёв: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._checkpoint_loop, name="battle-checkpoint", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.checkpoint()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._battles),
+                "dirty": len(self._dirty),
+                "pending_deletes": len(self._deleted),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "checkpoints": self.checkpoints,
+                "rows_checkpointed": self.rows_checkpointed,
+                "idle_ttl_sec": self.idle_ttl,
+            }
+
+
+battle_store = BattleStore(BATTLE_IDLE_TTL_SEC, BATTLE_CHECKPOINT_SEC)
+
+
+# ===================== УБОРКА УСТАРЕВШИХ СТРОК =====================
+
+class StaleRowSweeper:
+    """Периодически убирает брошенные бои, забеги подземелья и записи очереди ПВП.
+
+    Каждая таблица чистится порциями по chunk строк, по одной короткой
+    транзакции на порцию через писателя, поэтому блокировка записи не
+    задерживает игроков. Строки выбираются по индексам времени
+    (idx_battles_updated, idx_dungeon_active_updated, idx_pvp_queue_timestamp).
+    """
+
+    def __init__(self, chunk: int, battle_ttl: float, dungeon_ttl: float, pvp_queue_ttl: float):
+        self.chunk = chunk
+        self.ttl = {"battles": battle_ttl, "dungeons": dungeon_ttl, "pvp_queue": pvp_queue_ttl}
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.reclaimed = {table: 0 for table in self.ttl}
+        self.last_report: Dict[str, Any] = {}
+
+    def _expire_battles(self, before: str) -> int:
+        user_ids = storage.expire_battles(before, self.chunk)
+        # Бой мог быть поднят из таблицы при старте и ещё жить в памяти
+        battle_store.keep(user_ids)
+        return len(user_ids)
+
+    def _sweep(self, table: str, expire: Callable[[str], int]) -> int:
+        before = db_timestamp(self.ttl[table])
+        total = 0
+        while True:
+            count = db_writer.call(expire, before)
+            total += count
+            if count < self.chunk:
+                return total
+
+    def run(self) -> Dict[str, Any]:
+        """Один проход уборки; возвращает число убранных строк по таблицам"""
+        with self._lock:
+            started = time.perf_counter()
+            # Сначала память: просроченные бои удалятся из таблицы этой же точкой
+            expired = battle_store.expired
+            battle_store.checkpoint()
+            report = {
+                "battles": battle_store.expired - expired + self._sweep("battles", self._expire_battles),
+                "dungeons": self._sweep("dungeons", lambda before: storage.expire_dungeons(before, self.chunk)),
+                "pvp_queue": self._sweep("pvp_queue", lambda before: storage.expire_pvp_queue(before, self.chunk)),
+            }
+            pvp_matchmaker.expire(self.ttl["pvp_queue"])
+            for table, count in report.items():
+                self.reclaimed[table] += count
+            self.runs += 1
+            report["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            report["at"] = time.time()
+            self.last_report = report
+        if any(report[table] for table in self.ttl):
+            logger.info(
+                f"🧹 Уборка: боёв {report['battles']}, забегов {report['dungeons']}, "
+                f"очередь ПВП {report['pvp_queue']} ({report['elapsed_ms']} мс)"
+            )
+        return report
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "reclaimed": dict(self.reclaimed),
+                "last": dict(self.last_report),
+                "chunk": self.chunk,
+                "ttl_sec": dict(self.ttl),
+            }
+
+
+stale_rows = StaleRowSweeper(SWEEP_CHUNK_ROWS, BATTLE_IDLE_TTL_SEC, DUNGEON_IDLE_TTL_SEC, PVP_QUEUE_TTL_SEC)
+
+
+async def sweep_stale_rows_job(context: ContextTypes.DEFAULT_TYPE):
+    """Задача JobQueue: проход уборки в пуле потоков БД"""
+    await db_call(stale_rows.run)
+
+
+# ===================== КОНТЕКСТ АПДЕЙТА =====================
+
+_NOT_LOADED = object()
+
+
+class UpdateSnapshot:
+    """Игрок, бой и подземелье одного апдейта, загруженные не более одного раза.
+
+    Живёт в context.snapshot; функции боя принимают его через snap= и
+    обновляют вместо повторных запросов. db_round_trips — число выполненных
+    SQLite-запросов за апдейт.
+    """
+
+    __slots__ = ("chat_id", "user_id", "update_id", "_player", "_battle", "_dungeon", "db_round_trips")
+
+    def __init__(self, chat_id: int, user_id: int, update_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.update_id = update_id
+        self._player: Any = _NOT_LOADED
+        self._battle: Any = _NOT_LOADED
+        self._dungeon: Any = _NOT_LOADED
+        self.db_round_trips = 0
+
+    @property
+    def player(self) -> Optional[Dict[str, Any]]:
+        if self._player is _NOT_LOADED:
+            self._player = get_player(self.chat_id, self.user_id)
+        return self._player
+
+    @player.setter
+    def player(self, value: Optional[Dict[str, Any]]):
+        self._player = value
+
+    @property
+    def battle(self) -> Optional[Dict[str, Any]]:
+        if self._battle is _NOT_LOADED:
+            self._battle = get_active_battle(self.chat_id, self.user_id)
+        return self._battle
+
+    @battle.setter
+    def battle(self, value: Optional[Dict[str, Any]]):
+        self._battle = value
+
+    @property
+    def dungeon(self) -> Optional[Dict[str, Any]]:
+        if self._dungeon is _NOT_LOADED:
+            self._dungeon = get_dungeon_progress(self.chat_id, self.user_id)
+        return self._dungeon
+
+    @dungeon.setter
+    def dungeon(self, value: Optional[Dict[str, Any]]):
+        self._dungeon = value
+
+    def invalidate(self, *parts: str):
+        for part in parts or ("player", "battle", "dungeon"):
+            setattr(self, "_" + part, _NOT_LOADED)
+
+    def preload(self, *parts: str) -> "UpdateSnapshot":
+        for part in parts:
+            getattr(self, part)
+        return self
+
+    async def load(self, *parts: str) -> "UpdateSnapshot":
+        """Догружает части снимка одним переходом в пул потоков БД"""
+        if any(getattr(self, "_" + part) is _NOT_LOADED for part in parts):
+            await db_call(self.preload, *parts)
+        return self
+
+
+def get_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> UpdateSnapshot:
+    snap = getattr(context, "snapshot", None)
+    if snap is None or snap.update_id != update.update_id:
+        snap = UpdateSnapshot(update.effective_chat.id, update.effective_user.id, update.update_id)
+        context.snapshot = snap
+        current_snapshot.set(snap)
+    return snap
+
+
+def write_snapshot(
+    snap: Optional[UpdateSnapshot], chat_id: int, user_id: int, *parts: str
+) -> UpdateSnapshot:
+    """Снимок для функции записи: части parts перечитываются уже внутри транзакции.
+
+    Обработчик грузит снимок в пуле чтения, до постановки записи в очередь, —
+    к BEGIN IMMEDIATE тот же бой мог закончить другой апдейт игрока (двойное
+    нажатие), и старые строки выдали бы награду второй раз. Игрок и бой
+    читаются из кешей в памяти, так что перечитывание почти бесплатно.
+    """
+    if snap is None:
+        return UpdateSnapshot(chat_id, user_id)
+    snap.invalidate(*parts)
+    return snap
+
+
+class RoundTripStats:
+    """Сводка по числу запросов к SQLite на апдейт"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.updates = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, snap: UpdateSnapshot):
+        with self._lock:
+            self.updates += 1
+            self.total += snap.db_round_trips
+            self.max = max(self.max, snap.db_round_trips)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "updates": self.updates,
+                "avg_round_trips": round(self.total / self.updates, 2) if self.updates else 0.0,
+                "max_round_trips": self.max,
+            }
+
+
+round_trip_stats = RoundTripStats()
+
+
+async def begin_update_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запускается до обработчиков: заводит снимок, чтобы учесть все запросы апдейта"""
+    if update.effective_chat and update.effective_user:
+        get_snapshot(update, context)
+
+
+async def track_round_trips(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запускается после обработчиков: фиксирует число запросов к БД за апдейт"""
+    snap = getattr(context, "snapshot", None)
+    current_snapshot.set(None)
+    if snap is None or snap.update_id != update.update_id:
+        return
+    round_trip_stats.record(snap)
+    logger.debug(f"Апдейт {update.update_id}: {snap.db_round_trips} запросов к БД")
+
+
+# ===================== ИГРОКИ =====================
+
+@safedb_execute
+def init_player(chat_id: int, user_id: int, username: str, player_class: str) -> bool:
+    if player_class not in CLASSES:
+        player_class = "warrior"
+    class_info = CLASSES[player_class]
+
+    created = storage.insert_player(
+        {
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "username": username or "Безымянный",
+            "class": player_class,
+            "level": 1,
+            "xp": 0,
+            "health": class_info["health"],
+            "max_health": class_info["health"],
+            "mana": class_info["mana"],
+            "max_mana": class_info["mana"],
+            "attack": class_info["attack"],
+            "defense": class_info["defense"],
+            "gold": class_info["starting_gold"],
+            "pet_id": "wolf",
+        },
+        items=[("health_potion", "potion", 3)],
+    )
+    if not created:
+        logger.warning(f"Игрок уже существует: {user_id}")
+        return False
+
+    logger.info(f"✅ Игрок создан: {username} ({user_id}) - {player_class}")
+    return True
+
+
+@safedb_execute
+def get_player(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+    return player_cache.get(chat_id, user_id)
+
+
+@safedb_execute
+def player_exists(chat_id: int, user_id: int) -> bool:
+    return storage.player_exists(chat_id, user_id)
+
+
+@safedb_execute
+def add_xp(chat_id: int, user_id: int, username: str, xp_amount: int) -> int:
+    levels_up = 0
+
+    def apply(player: Dict[str, Any]) -> Dict[str, Any]:
+        nonlocal levels_up
+        old_level = player["level"]
+        total = total_xp(old_level, player["xp"]) + xp_amount
+        new_level = max(old_level, level_for_total_xp(total))
+        new_xp = total - CUMULATIVE_XP[new_level]
+        levels_up = new_level - old_level
+
+        if levels_up == 0:
+            return {"xp": new_xp}
+
+        gains = {stat: STAT_GAINS[new_level][stat] - STAT_GAINS[old_level][stat] for stat in STATS_PER_LEVEL}
+        new_health = player["max_health"] + gains["health"]
+        new_mana = player["max_mana"] + gains["mana"]
+        return {
+            "xp": new_xp,
+            "level": new_level,
+            "max_health": new_health,
+            "health": new_health,
+            "max_mana": new_mana,
+            "mana": new_mana,
+            "attack": player["attack"] + gains["attack"],
+            "defense": player["defense"] + gains["defense"],
+        }
+
+    if player_cache.mutate(chat_id, user_id, apply) is None:
+        return 0
+    if levels_up > 0:
+        stat_profiles.invalidate(chat_id, user_id)
+        logger.info(f"⬆️ {username} - {levels_up} уровней!")
+    return levels_up
+
+
+@safedb_execute
+def add_gold(chat_id: int, user_id: int, amount: int):
+    player_cache.add(chat_id, user_id, gold=amount)
+
+
+@safedb_execute
+def subtract_gold(chat_id: int, user_id: int, amount: int) -> bool:
+    changes = player_cache.mutate(
+        chat_id,
+        user_id,
+        lambda player: {"gold": player["gold"] - amount} if player["gold"] >= amount else {},
+    )
+    return bool(changes)
+
+
+# ===================== ИНВЕНТАРЬ =====================
+
+@safedb_execute
+def get_inventory(chat_id: int, user_id: int) -> List[Dict[str, Any]]:
+    return storage.get_inventory(chat_id, user_id)
+
+
+@safedb_execute
+def get_item_quantity(chat_id: int, user_id: int, item_id: str) -> int:
+    return storage.get_item_quantity(chat_id, user_id, item_id)
+
+
+@safedb_execute
+def add_item(chat_id: int, user_id: int, item_id: str, quantity: int = 1):
+    item_type = "misc"
+    if item_id in WEAPONS:
+        item_type = "weapon"
+    elif item_id in ARMOR:
+        item_type = "armor"
+    elif item_id in PETS:
+        item_type = "pet"
+    elif item_id in MATERIALS:
+        item_type = "material"
+    elif item_id in RUNES:
+        item_type = "rune"
+    elif item_id == "health_potion":
+        item_type = "potion"
+
+    storage.add_item(chat_id, user_id, item_id, item_type, quantity)
+
+
+@safedb_execute
+def remove_item(chat_id: int, user_id: int, item_id: str, quantity: int = 1) -> bool:
+    return storage.remove_item(chat_id, user_id, item_id, quantity)
+
+
+@safedb_execute
+def get_material(chat_id: int, user_id: int, material_id: str) -> int:
+    return storage.get_item_quantity(chat_id, user_id, material_id)
+
+
+@safedb_execute
+def can_use_item(player_class: str, item_id: str) -> bool:
+    if item_id in WEAPONS:
+        return (
+            WEAPONS[item_id].get("class") == player_class
+            or WEAPONS[item_id].get("class") is None
+        )
+    elif item_id in ARMOR:
+        return (
+            ARMOR[item_id].get("class") == player_class
+            or ARMOR[item_id].get("class") is None
+        )
+    return True
+
+
+@safedb_execute
+def equip_weapon(chat_id: int, user_id: int, weapon_id: str) -> bool:
+    player = get_player(chat_id, user_id)
+    if not player or weapon_id not in WEAPONS:
+        return False
+
+    if not can_use_item(player["class"], weapon_id):
+        return False
+
+    if get_item_quantity(chat_id, user_id, weapon_id) <= 0:
+        return False
+
+    player_cache.set(chat_id, user_id, equipped_weapon=weapon_id)
+    stat_profiles.invalidate(chat_id, user_id)
+    return True
+
+
+@safedb_execute
+def equip_armor(chat_id: int, user_id: int, armor_id: str) -> bool:
+    player = get_player(chat_id, user_id)
+    if not player or armor_id not in ARMOR:
+        return False
+
+    if not can_use_item(player["class"], armor_id):
+        return False
+
+    if get_item_quantity(chat_id, user_id, armor_id) <= 0:
+        return False
+
+    player_cache.set(chat_id, user_id, equipped_armor=armor_id)
+    stat_profiles.invalidate(chat_id, user_id)
+    return True
+
+
+@safedb_execute
+def equip_rune(chat_id: int, user_id: int, rune_id: str) -> bool:
+    if rune_id not in RUNES or not player_exists(chat_id, user_id):
+        return False
+
+    if get_item_quantity(chat_id, user_id, rune_id) <= 0:
+        return False
+
+    player_cache.set(chat_id, user_id, equipped_rune=rune_id)
+    stat_profiles.invalidate(chat_id, user_id)
+    return True
+
+
+@safedb_execute
 def buy_item(chat_id: int, user_id: int, item_id: str) -> bool:
     player = get_player(chat_id, user_id)
     if not player:
@@ -1180,70 +3869,182 @@ def buy_pet(chat_id: int, user_id: int, pet_id: str) -> bool:
     if not subtract_gold(chat_id, user_id, price):
         return False
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE players SET pet_id = ?, pet_level = 1 WHERE user_id = ? AND chat_id = ?",
-        (pet_id, user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
+    player_cache.set(chat_id, user_id, pet_id=pet_id, pet_level=1)
+    stat_profiles.invalidate(chat_id, user_id)
     return True
 
 
 # ===================== БОИ =====================
 
+BATTLE_ATTACK = "a"
+BATTLE_POTION = "p"
+BATTLE_ESCAPE = "e"
+
+
 def calculate_damage(
     attacker_attack: int,
     defender_defense: int,
     attacker_crit_chance: int = 5,
     spell_power: int = 0,
+    rng: Optional[random.Random] = None,
 ) -> Tuple[int, bool]:
+    rng = rng or random
     base_damage = max(1, attacker_attack - defender_defense // 2)
-    variation = random.uniform(0.85, 1.15)
+    variation = rng.uniform(0.85, 1.15)
     damage = int(base_damage * variation)
 
     if spell_power > 0:
-        spell_damage = int(spell_power * random.uniform(0.8, 1.2))
+        spell_damage = int(spell_power * rng.uniform(0.8, 1.2))
         damage += spell_damage
 
-    is_crit = random.randint(1, 100) <= attacker_crit_chance
+    is_crit = rng.randint(1, 100) <= attacker_crit_chance
     if is_crit:
         damage = int(damage * 1.5)
 
     return max(1, damage), is_crit
 
 
-def get_player_battle_stats(player: Dict[str, Any]) -> Dict[str, int]:
-    stats = {
-        "attack": player["attack"],
-        "defense": player["defense"],
-        "crit_chance": CLASSES[player["class"]].get("crit_chance", 5),
-        "spell_power": CLASSES[player["class"]].get("spell_power", 0),
+def get_player_battle_stats(player: Dict[str, Any]) -> StatProfile:
+    return stat_profiles.get(player["chat_id"], player["user_id"]) or compile_stat_profile(player)
+
+
+# ---------- детерминированный движок боя ----------
+#
+# У каждого боя свой seed, сохранённый вместе с ним. Ход N (0 — выбор врага)
+# берёт случайные числа из battle_rng(seed, N), поэтому бой воспроизводится
+# по seed и строке действий (battles.actions) без хранения состояния ГСЧ.
+# Статы игрока фиксируются в начале боя (battles.combat_stats).
+
+def new_battle_seed() -> int:
+    return random.getrandbits(63)
+
+
+def battle_rng(seed: Optional[int], turn: int):
+    """ГСЧ хода turn; для боёв, начатых до появления seed, — общий random"""
+    if seed is None:
+        return random
+    return random.Random(f"{seed}:{turn}")
+
+
+def pack_combat_stats(player: Dict[str, Any]) -> str:
+    """Атака, крит и сила заклинаний из профиля + базовая защита, по которой бьёт враг"""
+    stats = get_player_battle_stats(player)
+    return f"{stats.attack}:{stats.crit_chance}:{stats.spell_power}:{player['defense']}"
+
+
+def combat_state(battle: Dict[str, Any], player_hp: int, player: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    packed = battle.get("combat_stats") or pack_combat_stats(player)
+    attack, crit_chance, spell_power, defense = (int(x) for x in packed.split(":"))
+    return {
+        "enemy_id": battle["enemy_id"],
+        "enemy_hp": battle["enemy_health"],
+        "enemy_damage": battle["enemy_damage"],
+        "player_hp": player_hp,
+        "player_max_hp": battle["player_max_health"],
+        "attack": attack,
+        "crit_chance": crit_chance,
+        "spell_power": spell_power,
+        "defense": defense,
+    }
+
+
+def combat_turn(state: Dict[str, Any], action: str, rng) -> Dict[str, Any]:
+    """Один ход боя без обращения к хранилищу: меняет state и возвращает события хода.
+
+    outcome: None — бой продолжается, "victory", "defeat" или "escaped".
+    """
+    turn: Dict[str, Any] = {
+        "action": action,
+        "damage": 0,
+        "is_crit": False,
+        "heal": 0,
+        "enemy_damage": 0,
+        "loot": None,
+        "outcome": None,
+    }
+
+    if action == BATTLE_ATTACK:
+        damage, is_crit = calculate_damage(
+            state["attack"], 0, state["crit_chance"], state["spell_power"], rng
+        )
+        state["enemy_hp"] -= damage
+        turn["damage"] = damage
+        turn["is_crit"] = is_crit
+        if state["enemy_hp"] <= 0:
+            turn["outcome"] = "victory"
+            loot = ENEMIES.get(state["enemy_id"], {}).get("loot")
+            if rng.randint(1, 100) <= 40 and loot:
+                turn["loot"] = rng.choice(loot)
+            return turn
+
+    elif action == BATTLE_POTION:
+        turn["heal"] = int(state["player_max_hp"] * 0.5)
+        state["player_hp"] = min(state["player_max_hp"], state["player_hp"] + turn["heal"])
+
+    elif action == BATTLE_ESCAPE:
+        if rng.randint(1, 100) <= 50:
+            turn["outcome"] = "escaped"
+            return turn
+
+    else:
+        raise ValueError(f"Неизвестное действие боя: {action!r}")
+
+    enemy_damage, _ = calculate_damage(state["enemy_damage"], state["defense"], 5, 0, rng)
+    state["player_hp"] -= enemy_damage
+    turn["enemy_damage"] = enemy_damage
+    if state["player_hp"] <= 0:
+        turn["outcome"] = "defeat"
+    return turn
+
+
+def replay_fight(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Переигрывает бой по seed и строке действий; хранилище не трогает"""
+    state = combat_state(record, record["player_health"])
+    turns = []
+    for number, action in enumerate(record["actions"], 1):
+        turn = combat_turn(state, action, battle_rng(record["seed"], number))
+        turns.append(turn)
+        if turn["outcome"]:
+            break
+    return {
+        "outcome": turns[-1]["outcome"] if turns else None,
+        "enemy_hp": max(0, state["enemy_hp"]),
+        "player_hp": max(0, state["player_hp"]),
+        "loot": turns[-1]["loot"] if turns else None,
+        "turns": turns,
     }
 
-    if player["equipped_weapon"] and player["equipped_weapon"] in WEAPONS:
-        weapon = WEAPONS[player["equipped_weapon"]]
-        stats["attack"] += weapon["attack"]
-        stats["crit_chance"] += weapon["crit"]
 
-    if player["equipped_armor"] and player["equipped_armor"] in ARMOR:
-        armor = ARMOR[player["equipped_armor"]]
-        stats["defense"] += armor["defense"]
+FIGHT_RECORD_FIELDS = (
+    "seed", "location_id", "enemy_id", "enemy_health", "enemy_max_health", "enemy_damage",
+    "is_boss", "is_dungeon", "player_health", "player_max_health", "combat_stats",
+)
+
+fight_records: Deque[Dict[str, Any]] = deque(maxlen=FIGHT_RECORDS_KEPT)
+
+
+def record_fight(battle: Dict[str, Any], actions: str, outcome: Dict[str, Any]):
+    """Запоминает завершённый бой для replay_fight (последние FIGHT_RECORDS_KEPT)"""
+    if battle.get("seed") is None:
+        return
+    record = {field: battle.get(field) for field in FIGHT_RECORD_FIELDS}
+    record["enemy_health"] = battle["enemy_max_health"]  # бой начинается с полным HP врага
+    record.update(actions=actions, **outcome)
+    fight_records.append(record)
 
-    if player["pet_id"] and player["pet_id"] in PETS:
-        pet = PETS[player["pet_id"]]
-        stats["attack"] += pet["attack_bonus"]
-        stats["defense"] += pet["defense_bonus"]
+    def forget():
+        if record in fight_records:
+            fight_records.remove(record)
 
-    return stats
+    storage.on_rollback(forget)
 
 
 @safedb_execute
 def start_battle(
-    chat_id: int, user_id: int, location_id: str
+    chat_id: int, user_id: int, location_id: str, snap: Optional[UpdateSnapshot] = None
 ) -> Optional[Dict[str, Any]]:
-    player = get_player(chat_id, user_id)
+    snap = write_snapshot(snap, chat_id, user_id, "player", "battle")
+    player = snap.player
     if not player:
         return None
 
@@ -1257,101 +4058,239 @@ def start_battle(
     if player["level"] > location["max_level"] + 10:
         return None
 
-    possible_enemies = location["enemies"]
-    enemy_id = random.choice(possible_enemies)
-    enemy_template = ENEMIES[enemy_id].copy()
+    battle = roll_hunt_battle(player, location_id, player["health"])
+    battle_store.save(chat_id, user_id, battle)
+    combat_log.emit([battle_start_event(user_id, battle)])
 
-    level_diff = max(1, player["level"] - enemy_template["level"])
-    scale = 1.0 + level_diff * 0.12
+    snap.invalidate("battle")
+    enemy = ENEMIES[battle["enemy_id"]]
+    return {
+        "enemy_id": battle["enemy_id"],
+        "enemy_name": enemy["name"],
+        "enemy_emoji": enemy["emoji"],
+        "enemy_level": enemy["level"],
+        "enemy_health": battle["enemy_health"],
+        "enemy_max_health": battle["enemy_max_health"],
+        "enemy_damage": battle["enemy_damage"],
+        "is_boss": enemy.get("boss", False),
+    }
 
-    enemy_template["current_hp"] = int(enemy_template["hp"] * scale)
-    enemy_template["scaled_damage"] = int(enemy_template["damage"] * scale)
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT OR REPLACE INTO battles
-        (user_id, chat_id, location_id, enemy_id, enemy_health, enemy_max_health,
-         enemy_damage, is_boss, player_health, player_max_health, is_dungeon)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-        """,
-        (
-            user_id,
-            chat_id,
-            location_id,
-            enemy_id,
-            enemy_template["current_hp"],
-            int(enemy_template["hp"] * scale),
-            enemy_template["scaled_damage"],
-            int(enemy_template.get("boss", False)),
-            player["health"],
-            player["max_health"],
-        ),
-    )
-    conn.commit()
-    conn.close()
+def roll_hunt_battle(
+    player: Dict[str, Any], location_id: str, player_health: int, combat_stats: Optional[str] = None
+) -> Dict[str, Any]:
+    """Строка battles для охоты: враг локации, масштаб по разнице уровней, свой seed"""
+    seed = new_battle_seed()
+    enemy_id = battle_rng(seed, 0).choice(LOCATIONS[location_id]["enemies"])
+    enemy = ENEMIES[enemy_id]
+
+    level_diff = max(1, player["level"] - enemy["level"])
+    scale = 1.0 + level_diff * 0.12
 
     return {
+        "location_id": location_id,
         "enemy_id": enemy_id,
-        "enemy_name": enemy_template["name"],
-        "enemy_emoji": enemy_template["emoji"],
-        "enemy_level": enemy_template["level"],
-        "enemy_health": enemy_template["current_hp"],
-        "enemy_max_health": int(enemy_template["hp"] * scale),
-        "enemy_damage": enemy_template["scaled_damage"],
-        "is_boss": enemy_template.get("boss", False),
+        "enemy_health": int(enemy["hp"] * scale),
+        "enemy_max_health": int(enemy["hp"] * scale),
+        "enemy_damage": int(enemy["damage"] * scale),
+        "is_boss": int(enemy.get("boss", False)),
+        "player_health": player_health,
+        "player_max_health": player["max_health"],
+        "is_dungeon": 0,
+        "seed": seed,
+        "actions": "",
+        "combat_stats": combat_stats or pack_combat_stats(player),
     }
 
 
 @safedb_execute
 def get_active_battle(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM battles WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
-    )
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return battle_store.get(chat_id, user_id)
 
 
 @safedb_execute
 def end_battle(chat_id: int, user_id: int):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "DELETE FROM battles WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
+    battle_store.delete(chat_id, user_id)
+
+
+def play_battle_turns(
+    chat_id: int,
+    user_id: int,
+    player: Dict[str, Any],
+    battle: Dict[str, Any],
+    actions: Iterable[str],
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Играет ходы actions (до исхода) и сохраняет бой одним изменением.
+
+    Если бой завершился, строка не обновляется — её закроет finish_battle_*,
+    а сам бой попадёт в fight_records.
+    """
+    state = combat_state(battle, player["health"], player)
+    played = battle.get("actions") or ""
+    turns = []
+    events: List[bytes] = []
+    for action in actions:
+        played += action
+        turn = combat_turn(state, action, battle_rng(battle.get("seed"), len(played)))
+        turns.append(turn)
+        events.extend(battle_turn_events(user_id, battle.get("seed"), len(played), turn, state))
+        if turn["outcome"]:
+            combat_log.emit(events)
+            record_fight(
+                battle,
+                played,
+                {
+                    "outcome": turn["outcome"],
+                    "enemy_hp": max(0, state["enemy_hp"]),
+                    "player_hp": max(0, state["player_hp"]),
+                    "loot": turn["loot"],
+                },
+            )
+            return turns, state
+
+    combat_log.emit(events)
+    battle_store.update(chat_id, user_id, enemy_health=state["enemy_hp"], actions=played)
+    battle["enemy_health"] = state["enemy_hp"]
+    battle["actions"] = played
+    return turns, state
 
 
 @safedb_execute
-def perform_attack(chat_id: int, user_id: int, username: str) -> Dict[str, Any]:
-    player = get_player(chat_id, user_id)
-    battle = get_active_battle(chat_id, user_id)
+@transactional
+def perform_attack(
+    chat_id: int, user_id: int, username: str, snap: Optional[UpdateSnapshot] = None
+) -> Dict[str, Any]:
+    snap = write_snapshot(snap, chat_id, user_id, "player", "battle")
+    player = snap.player
+    battle = snap.battle
     if not player or not battle:
         return {"success": False, "message": "Нет активного боя."}
 
-    player_stats = get_player_battle_stats(player)
-    damage, is_crit = calculate_damage(
-        player_stats["attack"],
-        0,
-        player_stats["crit_chance"],
-        player_stats["spell_power"],
+    (turn,), state = play_battle_turns(chat_id, user_id, player, battle, BATTLE_ATTACK)
+
+    result: Dict[str, Any] = {
+        "success": True,
+        "damage": turn["damage"],
+        "is_crit": turn["is_crit"],
+        "enemy_hp": max(0, state["enemy_hp"]),
+        "enemy_max_hp": battle["enemy_max_health"],
+        "enemy_defeated": turn["outcome"] == "victory",
+        "victory": False,
+        "defeat": False,
+        "xp_gained": 0,
+        "gold_gained": 0,
+        "level_up": 0,
+        "gold_lost": 0,
+        "loot": None,
+        "is_dungeon": bool(battle["is_dungeon"]),
+    }
+
+    if turn["outcome"] == "victory":
+        result.update(finish_battle_victory(chat_id, user_id, username, player, battle, snap, turn["loot"]))
+
+    else:
+        result["enemy_damage"] = turn["enemy_damage"]
+        result["player_hp"] = max(0, state["player_hp"])
+        result["player_max_hp"] = player["max_health"]
+
+        if turn["outcome"] == "defeat":
+            result["defeat"] = True
+            result["gold_lost"] = finish_battle_defeat(chat_id, user_id, player, battle, snap)
+        else:
+            player_cache.set(chat_id, user_id, health=state["player_hp"])
+
+    snap.invalidate("player")
+    return result
+
+
+def finish_battle_victory(
+    chat_id: int,
+    user_id: int,
+    username: str,
+    player: Dict[str, Any],
+    battle: Dict[str, Any],
+    snap: UpdateSnapshot,
+    loot: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Награда за убитого врага: золото, опыт, счётчики, добыча и этаж подземелья"""
+    end_battle(chat_id, user_id)
+    snap.battle = None
+    enemy = ENEMIES.get(battle["enemy_id"], {"xp": 0, "gold": 0, "loot": []})
+    xp = enemy.get("xp", 0)
+    gold = enemy.get("gold", 0)
+
+    if player["pet_id"] in PETS:
+        xp = int(xp * PETS[player["pet_id"]]["xp_bonus"])
+
+    add_gold(chat_id, user_id, gold)
+    level_up = add_xp(chat_id, user_id, username, xp)
+
+    player_cache.add(
+        chat_id,
+        user_id,
+        total_kills=1,
+        total_battles_won=1,
+        total_bosses_killed=1 if battle["is_boss"] else 0,
     )
 
-    new_enemy_hp = battle["enemy_health"] - damage
+    if loot:
+        add_item(chat_id, user_id, loot)
+
+    if battle["is_dungeon"]:
+        end_dungeon_logic(chat_id, user_id, victory=True)
+        snap.invalidate("dungeon")
+    return {
+        "xp_gained": xp,
+        "gold_gained": gold,
+        "level_up": level_up,
+        "victory": True,
+        "loot": loot,
+    }
+
+
+def finish_battle_defeat(
+    chat_id: int,
+    user_id: int,
+    player: Dict[str, Any],
+    battle: Dict[str, Any],
+    snap: UpdateSnapshot,
+) -> int:
+    """Поражение: бой закрыт, штраф 10% золота, HP восстановлено; возвращает потерю"""
+    gold_lost = apply_battle_defeat(chat_id, user_id, player["gold"])
+    snap.battle = None
+    if battle["is_dungeon"]:
+        end_dungeon_logic(chat_id, user_id, victory=False)
+        snap.invalidate("dungeon")
+    return gold_lost
+
+
+@safedb_execute
+@transactional
+def auto_battle(
+    chat_id: int, user_id: int, username: str, snap: Optional[UpdateSnapshot] = None
+) -> Dict[str, Any]:
+    """Бой до конца за один вызов.
+
+    Ходы идут в памяти через тот же combat_turn, что и perform_attack, поэтому
+    строка battles и HP игрока не переписываются после каждого удара —
+    в хранилище попадает только итог боя.
+    """
+    snap = write_snapshot(snap, chat_id, user_id, "player", "battle")
+    player = snap.player
+    battle = snap.battle
+    if not player or not battle:
+        return {"success": False, "message": "Нет активного боя."}
+
+    turns, state = play_battle_turns(chat_id, user_id, player, battle, itertools.repeat(BATTLE_ATTACK))
+    last = turns[-1]
+    player_hp = state["player_hp"]
+
     result: Dict[str, Any] = {
         "success": True,
-        "damage": damage,
-        "is_crit": is_crit,
-        "enemy_hp": max(0, new_enemy_hp),
+        "rounds": [(turn["damage"], turn["is_crit"], turn["enemy_damage"]) for turn in turns],
         "enemy_max_hp": battle["enemy_max_health"],
-        "enemy_defeated": new_enemy_hp <= 0,
+        "player_hp": max(0, player_hp),
+        "player_max_hp": player["max_health"],
         "victory": False,
         "defeat": False,
         "xp_gained": 0,
@@ -1362,291 +4301,865 @@ def perform_attack(chat_id: int, user_id: int, username: str) -> Dict[str, Any]:
         "is_dungeon": bool(battle["is_dungeon"]),
     }
 
-    if new_enemy_hp <= 0:
+    if last["outcome"] == "victory":
+        if player_hp != player["health"]:
+            player_cache.set(chat_id, user_id, health=player_hp)
+        result.update(finish_battle_victory(chat_id, user_id, username, player, battle, snap, last["loot"]))
+    else:
+        result["defeat"] = True
+        result["gold_lost"] = finish_battle_defeat(chat_id, user_id, player, battle, snap)
+
+    snap.invalidate("player")
+    return result
+
+
+@safedb_execute
+def apply_battle_defeat(chat_id: int, user_id: int, gold: int) -> int:
+    end_battle(chat_id, user_id)
+    gold_lost = int(gold * 0.1)
+    if gold_lost > 0:
+        subtract_gold(chat_id, user_id, gold_lost)
+    player_cache.mutate(
+        chat_id,
+        user_id,
+        lambda p: {"health": p["max_health"], "total_battles_lost": p["total_battles_lost"] + 1},
+    )
+    return gold_lost
+
+
+@safedb_execute
+def set_player_health(chat_id: int, user_id: int, health: int):
+    player_cache.set(chat_id, user_id, health=health)
+
+
+@safedb_execute
+@transactional
+def use_battle_potion(
+    chat_id: int, user_id: int, snap: Optional[UpdateSnapshot] = None
+) -> Dict[str, Any]:
+    snap = write_snapshot(snap, chat_id, user_id, "player", "battle")
+    player = snap.player
+    battle = snap.battle
+    if not player or not battle:
+        return {"success": False, "message": "Нет активного боя."}
+
+    if not remove_item(chat_id, user_id, "health_potion", 1):
+        return {"success": False, "message": "❌ Нет зелий лечения."}
+
+    (turn,), state = play_battle_turns(chat_id, user_id, player, battle, BATTLE_POTION)
+    new_player_hp = state["player_hp"]
+
+    result: Dict[str, Any] = {
+        "success": True,
+        "heal_amount": turn["heal"],
+        "healed_hp": new_player_hp + turn["enemy_damage"],
+        "enemy_damage": turn["enemy_damage"],
+        "player_hp": new_player_hp,
+        "player_max_hp": player["max_health"],
+        "defeat": turn["outcome"] == "defeat",
+        "gold_lost": 0,
+    }
+
+    if result["defeat"]:
+        result["gold_lost"] = apply_battle_defeat(chat_id, user_id, player["gold"])
+        snap.battle = None
+    else:
+        set_player_health(chat_id, user_id, new_player_hp)
+
+    snap.invalidate("player")
+    return result
+
+
+@safedb_execute
+@transactional
+def attempt_escape(
+    chat_id: int, user_id: int, snap: Optional[UpdateSnapshot] = None
+) -> Dict[str, Any]:
+    snap = write_snapshot(snap, chat_id, user_id, "player", "battle")
+    player = snap.player
+    battle = snap.battle
+    if not player or not battle:
+        return {"success": False, "message": "Нет активного боя."}
+
+    (turn,), state = play_battle_turns(chat_id, user_id, player, battle, BATTLE_ESCAPE)
+    if turn["outcome"] == "escaped":
         end_battle(chat_id, user_id)
-        enemy = ENEMIES.get(battle["enemy_id"], {"xp": 0, "gold": 0, "loot": []})
-        xp = enemy.get("xp", 0)
-        gold = enemy.get("gold", 0)
+        snap.battle = None
+        return {"success": True, "escaped": True}
+
+    new_player_hp = state["player_hp"]
+    result: Dict[str, Any] = {
+        "success": True,
+        "escaped": False,
+        "enemy_damage": turn["enemy_damage"],
+        "player_hp": new_player_hp,
+        "player_max_hp": player["max_health"],
+        "defeat": turn["outcome"] == "defeat",
+        "gold_lost": 0,
+    }
 
-        if player["pet_id"] in PETS:
-            xp = int(xp * PETS[player["pet_id"]]["xp_bonus"])
+    if result["defeat"]:
+        result["gold_lost"] = apply_battle_defeat(chat_id, user_id, player["gold"])
+        snap.battle = None
+    else:
+        set_player_health(chat_id, user_id, new_player_hp)
 
-        add_gold(chat_id, user_id, gold)
-        level_up = add_xp(chat_id, user_id, username, xp)
+    snap.invalidate("player")
+    return result
 
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
-            """
-            UPDATE players
-            SET total_kills = total_kills + 1,
-                total_battles_won = total_battles_won + 1
-            WHERE user_id = ? AND chat_id = ?
-            """,
-            (user_id, chat_id),
-        )
-        if battle["is_boss"]:
-            c.execute(
-                """
-                UPDATE players
-                SET total_bosses_killed = total_bosses_killed + 1
-                WHERE user_id = ? AND chat_id = ?
-                """,
-                (user_id, chat_id),
-            )
-        conn.commit()
-        conn.close()
 
-        result.update(
-            {
-                "xp_gained": xp,
-                "gold_gained": gold,
-                "level_up": level_up,
-                "victory": True,
-            }
-        )
+# ===================== ЖУРНАЛ БОЁВ =====================
+#
+# Двоичный журнал событий боя для аналитики и баланса: начало боя, каждый
+# удар, зелье, побег и итог. Запись — заголовок COMBAT_EVENT_HEADER (вид,
+# время, seed боя, user_id, номер хода) и полезная нагрузка фиксированного
+# формата по виду события, всё little-endian. Файлы-сегменты начинаются с
+# COMBAT_LOG_MAGIC; новый сегмент открывается при старте и по достижении
+# COMBAT_LOG_SEGMENT_BYTES, старше COMBAT_LOG_SEGMENTS_KEPT — удаляются.
+# В SQLite журнал не пишет: события копятся в памяти и дописываются в файл
+# фоновым потоком.
+
+COMBAT_LOG_MAGIC = b"RQCL\x01"
+
+EVENT_START = 1
+EVENT_SWING = 2
+EVENT_POTION = 3
+EVENT_ESCAPE = 4
+EVENT_RESULT = 5
+
+COMBAT_EVENT_HEADER = struct.Struct("<BdQqH")
+COMBAT_EVENT_PAYLOADS: Dict[int, Tuple[str, struct.Struct, Tuple[str, ...]]] = {
+    EVENT_START: (
+        "start",
+        struct.Struct("<16s16sIIiIBB"),
+        ("location_id", "enemy_id", "enemy_hp", "enemy_damage", "player_hp", "player_max_hp", "is_boss", "is_dungeon"),
+    ),
+    EVENT_SWING: (
+        "swing",
+        struct.Struct("<IBIii"),
+        ("damage", "is_crit", "enemy_damage", "enemy_hp", "player_hp"),
+    ),
+    EVENT_POTION: ("potion", struct.Struct("<IIi"), ("heal", "enemy_damage", "player_hp")),
+    EVENT_ESCAPE: ("escape", struct.Struct("<BIi"), ("escaped", "enemy_damage", "player_hp")),
+    EVENT_RESULT: ("result", struct.Struct("<BHi16s"), ("outcome", "rounds", "player_hp", "loot")),
+}
+COMBAT_ACTION_EVENTS = {BATTLE_ATTACK: EVENT_SWING, BATTLE_POTION: EVENT_POTION, BATTLE_ESCAPE: EVENT_ESCAPE}
+COMBAT_OUTCOMES = ("victory", "defeat", "escaped")
 
-        if random.randint(1, 100) <= 40 and enemy.get("loot"):
-            loot_item = random.choice(enemy["loot"])
-            add_item(chat_id, user_id, loot_item)
-            result["loot"] = loot_item
 
-        if battle["is_dungeon"]:
-            end_dungeon_logic(chat_id, user_id, victory=True)
+def _pack_event(kind: int, seed: int, user_id: int, turn: int, *values) -> bytes:
+    _, payload, _ = COMBAT_EVENT_PAYLOADS[kind]
+    return COMBAT_EVENT_HEADER.pack(kind, time.time(), seed or 0, user_id, turn) + payload.pack(*values)
+
+
+def battle_start_event(user_id: int, battle: Dict[str, Any]) -> bytes:
+    return _pack_event(
+        EVENT_START,
+        battle["seed"],
+        user_id,
+        0,
+        (battle["location_id"] or "").encode(),
+        battle["enemy_id"].encode(),
+        battle["enemy_max_health"],
+        battle["enemy_damage"],
+        battle["player_health"],
+        battle["player_max_health"],
+        int(battle["is_boss"]),
+        int(battle["is_dungeon"]),
+    )
+
 
+def battle_turn_events(user_id: int, seed: int, number: int, turn: Dict[str, Any], state: Dict[str, Any]) -> List[bytes]:
+    """Событие хода по итогам combat_turn и, если бой закончился, событие итога"""
+    kind = COMBAT_ACTION_EVENTS[turn["action"]]
+    player_hp = max(0, state["player_hp"])
+    if kind == EVENT_SWING:
+        values = (turn["damage"], int(turn["is_crit"]), turn["enemy_damage"], max(0, state["enemy_hp"]), player_hp)
+    elif kind == EVENT_POTION:
+        values = (turn["heal"], turn["enemy_damage"], player_hp)
     else:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
-            "UPDATE battles SET enemy_health = ? WHERE user_id = ? AND chat_id = ?",
-            (new_enemy_hp, user_id, chat_id),
-        )
-        conn.commit()
-        conn.close()
+        values = (int(turn["outcome"] == "escaped"), turn["enemy_damage"], player_hp)
+    events = [_pack_event(kind, seed, user_id, number, *values)]
+    if turn["outcome"]:
+        events.append(_pack_event(
+            EVENT_RESULT,
+            seed,
+            user_id,
+            number,
+            COMBAT_OUTCOMES.index(turn["outcome"]) + 1,
+            number,
+            player_hp,
+            (turn["loot"] or "").encode(),
+        ))
+    return events
+
+
+class CombatLog:
+    """Дописывает события боя в сегменты журнала из фонового потока.
+
+    emit() только кладёт готовые байты в буфер, поэтому транзакция боя не
+    ждёт диска. Пока журнал не запущен (скрипты, тесты), события не копятся.
+    При откате транзакции ещё не записанные события убираются из буфера.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int, segments_kept: int, flush_interval: float):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segments_kept = segments_kept
+        self.flush_interval = flush_interval
+        self.running = False
+        self._buffer: List[List[bytes]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._segment = 0
+        self.events = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.segments_opened = 0
+        self.retracted = 0
+
+    def emit(self, events: List[bytes]):
+        if not self.running or not events:
+            return
+        with self._lock:
+            self._buffer.append(events)
+        storage.on_rollback(lambda: self._retract(events))
+
+    def _retract(self, events: List[bytes]):
+        with self._lock:
+            for i, pending in enumerate(self._buffer):
+                if pending is events:
+                    del self._buffer[i]
+                    self.retracted += len(events)
+                    return
+
+    # ---------- сегменты ----------
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"segment-{number:08d}.rqcl")
+
+    def _open_segment(self):
+        if self._file is not None:
+            self._file.close()
+        self._segment += 1
+        self._file = open(self._segment_path(self._segment), "ab")
+        self._file.write(COMBAT_LOG_MAGIC)
+        self.segments_opened += 1
+        if self.segments_kept:
+            for path in combat_log_segments(self.directory)[:-self.segments_kept]:
+                os.remove(path)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batches, self._buffer = self._buffer, []
+            if not batches:
+                return 0
+            count = 0
+            for events in batches:
+                # События одного emit не разрываются: ротация только на границе пачки
+                data = b"".join(events)
+                if self._file is None or self._file.tell() + len(data) > self.segment_bytes:
+                    self._open_segment()
+                self._file.write(data)
+                count += len(events)
+                self.bytes_written += len(data)
+            self._file.flush()
+            self.events += count
+            self.flushes += 1
+            return count
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала боёв: {e}")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        existing = combat_log_segments(self.directory)
+        # Хвост прошлого сегмента мог оборваться на середине записи — всегда новый сегмент
+        self._segment = int(os.path.basename(existing[-1])[8:16]) if existing else 0
+        self.running = True
+        self._thread = threading.Thread(target=self._flush_loop, name="combat-log", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self.running = False
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = sum(len(events) for events in self._buffer)
+        return {
+            "running": self.running,
+            "events": self.events,
+            "pending": pending,
+            "retracted": self.retracted,
+            "bytes": self.bytes_written,
+            "flushes": self.flushes,
+            "segments_opened": self.segments_opened,
+            "segment": self._segment,
+        }
 
-        enemy_damage, _ = calculate_damage(
-            battle["enemy_damage"], player["defense"], 5, 0
-        )
-        new_player_hp = player["health"] - enemy_damage
 
-        result["enemy_damage"] = enemy_damage
-        result["player_hp"] = max(0, new_player_hp)
-        result["player_max_hp"] = player["max_health"]
+combat_log = CombatLog(COMBAT_LOG_DIR, COMBAT_LOG_SEGMENT_BYTES, COMBAT_LOG_SEGMENTS_KEPT, COMBAT_LOG_FLUSH_SEC)
+
+
+def combat_log_segments(directory: str) -> List[str]:
+    """Сегменты журнала по порядку записи"""
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if name.startswith("segment-") and name.endswith(".rqcl"))
+    return [os.path.join(directory, name) for name in names]
+
+
+def read_combat_log(directory: str = COMBAT_LOG_DIR) -> Iterator[Dict[str, Any]]:
+    """Потоково читает журнал боёв: по одному событию-dict, сегмент за сегментом.
+
+    Оборванная запись в конце сегмента (остановка посреди записи) пропускается.
+    """
+    for path in combat_log_segments(directory):
+        with open(path, "rb") as f:
+            if f.read(len(COMBAT_LOG_MAGIC)) != COMBAT_LOG_MAGIC:
+                logger.warning(f"⚠️ {path}: не сегмент журнала боёв, пропущен")
+                continue
+            while True:
+                header = f.read(COMBAT_EVENT_HEADER.size)
+                if len(header) < COMBAT_EVENT_HEADER.size:
+                    break
+                kind, at, seed, user_id, turn = COMBAT_EVENT_HEADER.unpack(header)
+                if kind not in COMBAT_EVENT_PAYLOADS:
+                    logger.warning(f"⚠️ {path}: неизвестное событие {kind}, остаток сегмента пропущен")
+                    break
+                name, payload, fields = COMBAT_EVENT_PAYLOADS[kind]
+                body = f.read(payload.size)
+                if len(body) < payload.size:
+                    break
+                event = {"kind": name, "time": at, "seed": seed, "user_id": user_id, "turn": turn}
+                for field, value in zip(fields, payload.unpack(body)):
+                    event[field] = value.rstrip(b"\0").decode() if isinstance(value, bytes) else value
+                if kind == EVENT_RESULT:
+                    event["outcome"] = COMBAT_OUTCOMES[event["outcome"] - 1]
+                yield event
 
-        if new_player_hp <= 0:
-            end_battle(chat_id, user_id)
-            gold_lost = int(player["gold"] * 0.1)
-            if gold_lost > 0:
-                subtract_gold(chat_id, user_id, gold_lost)
 
-            conn = get_db()
-            c = conn.cursor()
-            c.execute(
-                """
-                UPDATE players
-                SET health = max_health,
-                    total_battles_lost = total_battles_lost + 1
-                WHERE user_id = ? AND chat_id = ?
-                """,
-                (user_id, chat_id),
-            )
-            conn.commit()
-            conn.close()
+# ===================== ПОДЗЕМЕЛЬЯ =====================
 
-            result["defeat"] = True
-            result["gold_lost"] = gold_lost
+# Пулы врагов и веса по этажам строятся один раз при импорте. Обычный этаж
+# тянет врага из не-боссов с весом 1 / (1 + |уровень - целевой уровень этажа|),
+# каждый DUNGEON_BOSS_EVERY-й этаж — босс по тем же весам.
 
-            if battle["is_dungeon"]:
-                end_dungeon_logic(chat_id, user_id, victory=False)
+DUNGEON_ENEMIES: List[str] = [eid for eid, e in ENEMIES.items() if not e.get("boss")]
+DUNGEON_BOSSES: List[str] = [eid for eid, e in ENEMIES.items() if e.get("boss")]
 
-        else:
-            conn = get_db()
-            c = conn.cursor()
-            c.execute(
-                "UPDATE players SET health = ? WHERE user_id = ? AND chat_id = ?",
-                (new_player_hp, user_id, chat_id),
-            )
-            conn.commit()
-            conn.close()
 
-    return result
+def is_boss_floor(floor: int) -> bool:
+    return floor % DUNGEON_BOSS_EVERY == 0
+
+
+def _floor_pool(floor: int) -> Tuple[List[str], List[float]]:
+    pool = DUNGEON_BOSSES if is_boss_floor(floor) else DUNGEON_ENEMIES
+    levels = [ENEMIES[eid]["level"] for eid in pool]
+    low, high = min(levels), max(levels)
+    target = low + (high - low) * (floor - 1) / max(1, DUNGEON_RUN_FLOORS - 1)
+    return pool, list(itertools.accumulate(1.0 / (1.0 + abs(level - target)) for level in levels))
+
+
+DUNGEON_FLOOR_POOLS: List[Tuple[List[str], List[float]]] = [([], [])] + [
+    _floor_pool(floor) for floor in range(1, DUNGEON_RUN_FLOORS + 1)
+]
+DUNGEON_FLOOR_SCALE: List[float] = [0.0] + [1.0 + (floor - 1) * 0.15 for floor in range(1, DUNGEON_RUN_FLOORS + 1)]
+
+
+def generate_dungeon_run(rng) -> str:
+    """План забега на DUNGEON_RUN_FLOORS этажей за один проход: id врагов через запятую"""
+    return ",".join(
+        rng.choices(pool, cum_weights=weights)[0] for pool, weights in DUNGEON_FLOOR_POOLS[1:]
+    )
 
 
-# ===================== ПОДЗЕМЕЛЬЯ =====================
+def spawn_dungeon_floor(
+    chat_id: int, user_id: int, player: Dict[str, Any], floor: int, enemy_id: str
+) -> Dict[str, Any]:
+    enemy = ENEMIES[enemy_id]
+    scale = DUNGEON_FLOOR_SCALE[floor]
+    enemy_health = int(enemy["hp"] * scale)
+    enemy_damage = int(enemy["damage"] * scale)
+
+    battle = {
+        "location_id": f"dungeon_floor_{floor}",
+        "enemy_id": enemy_id,
+        "enemy_health": enemy_health,
+        "enemy_max_health": enemy_health,
+        "enemy_damage": enemy_damage,
+        "is_boss": int(enemy.get("boss", False)),
+        "player_health": player["health"],
+        "player_max_health": player["max_health"],
+        "is_dungeon": 1,
+        "seed": new_battle_seed(),
+        "actions": "",
+        "combat_stats": pack_combat_stats(player),
+    }
+    battle_store.save(chat_id, user_id, battle)
+    combat_log.emit([battle_start_event(user_id, battle)])
+    return {
+        "floor": floor,
+        "floors": DUNGEON_RUN_FLOORS,
+        "is_boss": bool(enemy.get("boss", False)),
+        "enemy_id": enemy_id,
+        "enemy_name": enemy["name"],
+        "enemy_emoji": enemy["emoji"],
+        "enemy_health": enemy_health,
+        "enemy_max_health": enemy_health,
+        "enemy_damage": enemy_damage,
+    }
+
 
 @safedb_execute
-def start_dungeon(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM dungeon_progress WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
-    )
-    row = c.fetchone()
-
+def start_dungeon(
+    chat_id: int, user_id: int, snap: Optional[UpdateSnapshot] = None
+) -> Optional[Dict[str, Any]]:
+    snap = write_snapshot(snap, chat_id, user_id, "player", "battle", "dungeon")
+    row = snap.dungeon
     if row and row["is_active"]:
-        conn.close()
         return None
 
-    player = get_player(chat_id, user_id)
+    player = snap.player
     if not player:
-        conn.close()
         return None
 
-    floor = 1
-    if not row:
-        c.execute(
-            """
-            INSERT INTO dungeon_progress (user_id, chat_id, current_floor, is_active)
-            VALUES (?, ?, ?, 1)
-            """,
-            (user_id, chat_id, floor),
-        )
-    else:
-        floor = row["current_floor"]
-        c.execute(
-            "UPDATE dungeon_progress SET is_active = 1 WHERE user_id = ? AND chat_id = ?",
-            (user_id, chat_id),
-        )
+    plan = generate_dungeon_run(battle_rng(new_battle_seed(), 0))
+    storage.save_dungeon(chat_id, user_id, current_floor=1, is_active=1, run_plan=plan)
+    result = spawn_dungeon_floor(chat_id, user_id, player, 1, plan.split(",", 1)[0])
+
+    snap.invalidate("battle", "dungeon")
+    return result
 
-    conn.commit()
-    conn.close()
 
-    enemy_id = random.choice(list(ENEMIES.keys()))
-    enemy_template = ENEMIES[enemy_id].copy()
-    scale = 1.0 + (floor - 1) * 0.15
-    enemy_template["current_hp"] = int(enemy_template["hp"] * scale)
-    enemy_template["scaled_damage"] = int(enemy_template["damage"] * scale)
+@safedb_execute
+def continue_dungeon(
+    chat_id: int, user_id: int, snap: Optional[UpdateSnapshot] = None
+) -> Optional[Dict[str, Any]]:
+    """Следующий этаж активного забега — враг берётся из сохранённого плана"""
+    snap = write_snapshot(snap, chat_id, user_id, "player", "battle", "dungeon")
+    row = snap.dungeon
+    player = snap.player
+    if not row or not row["is_active"] or not player or snap.battle:
+        return None
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT OR REPLACE INTO battles
-        (user_id, chat_id, location_id, enemy_id, enemy_health, enemy_max_health,
-         enemy_damage, is_boss, player_health, player_max_health, is_dungeon)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-        """,
-        (
-            user_id,
-            chat_id,
-            f"dungeon_floor_{floor}",
-            enemy_id,
-            enemy_template["current_hp"],
-            int(enemy_template["hp"] * scale),
-            enemy_template["scaled_damage"],
-            int(enemy_template.get("boss", False)),
-            player["health"],
-            player["max_health"],
-        ),
-    )
-    conn.commit()
-    conn.close()
+    floor = row["current_floor"]
+    if floor > DUNGEON_RUN_FLOORS:
+        # Забег глубже плана: закрываем, иначе игрок не начнёт новый
+        storage.save_dungeon(chat_id, user_id, current_floor=1, is_active=0, run_plan=None)
+        snap.invalidate("dungeon")
+        return None
+
+    plan = row.get("run_plan")
+    if not plan:
+        # Забег начат до появления планов
+        plan = generate_dungeon_run(random)
+        storage.save_dungeon(chat_id, user_id, run_plan=plan)
+    result = spawn_dungeon_floor(chat_id, user_id, player, floor, plan.split(",")[floor - 1])
+
+    snap.invalidate("battle", "dungeon")
+    return result
 
-    return {
-        "floor": floor,
-        "enemy_id": enemy_id,
-        "enemy_name": enemy_template["name"],
-        "enemy_emoji": enemy_template["emoji"],
-        "enemy_health": enemy_template["current_hp"],
-        "enemy_max_health": int(enemy_template["hp"] * scale),
-        "enemy_damage": enemy_template["scaled_damage"],
-    }
+
+@safedb_execute
+def get_dungeon_progress(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+    return storage.get_dungeon(chat_id, user_id)
 
 
 @safedb_execute
 def end_dungeon_logic(chat_id: int, user_id: int, victory: bool):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM dungeon_progress WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
-    )
-    row = c.fetchone()
+    row = storage.get_dungeon(chat_id, user_id)
     if not row:
-        conn.close()
         return
 
     current_floor = row["current_floor"]
 
     if victory:
-        c.execute(
-            """
-            UPDATE dungeon_progress
-            SET current_floor = current_floor + 1,
-                enemies_killed = enemies_killed + 1,
-                is_active = 1
-            WHERE user_id = ? AND chat_id = ?
-            """,
-            (user_id, chat_id),
+        cleared = current_floor >= DUNGEON_RUN_FLOORS
+        storage.save_dungeon(
+            chat_id,
+            user_id,
+            current_floor=1 if cleared else current_floor + 1,
+            enemies_killed=row["enemies_killed"] + 1,
+            is_active=0 if cleared else 1,
         )
-        c.execute(
-            "UPDATE players SET dungeon_rating = MAX(dungeon_rating, ?) WHERE user_id = ? AND chat_id = ?",
-            (current_floor + 1, user_id, chat_id),
+        player_cache.mutate(
+            chat_id,
+            user_id,
+            lambda p: {"dungeon_rating": max(p["dungeon_rating"], current_floor + 1)},
         )
     else:
-        c.execute(
-            """
-            UPDATE dungeon_progress
-            SET current_floor = 1,
-                is_active = 0
-            WHERE user_id = ? AND chat_id = ?
-            """,
-            (user_id, chat_id),
+        storage.save_dungeon(chat_id, user_id, current_floor=1, is_active=0)
+
+
+# ===================== ЭКСПЕДИЦИИ =====================
+
+class ExpeditionTracker:
+    """Счётчик экспедиций в пути: не больше EXPEDITION_MAX_ACTIVE на игрока.
+
+    Используется только из event loop бота, поэтому без блокировок.
+    """
+
+    def __init__(self, max_active: int):
+        self.max_active = max_active
+        self._active: Dict[int, int] = {}
+        self.started = 0
+        self.completed = 0
+        self.rejected = 0
+        self.hunts = 0
+
+    def try_start(self, user_id: int) -> bool:
+        if self._active.get(user_id, 0) >= self.max_active:
+            self.rejected += 1
+            return False
+        self._active[user_id] = self._active.get(user_id, 0) + 1
+        self.started += 1
+        return True
+
+    def finish(self, user_id: int, hunts: int = 0):
+        left = self._active.get(user_id, 0) - 1
+        if left > 0:
+            self._active[user_id] = left
+        else:
+            self._active.pop(user_id, None)
+        self.completed += 1
+        self.hunts += hunts
+
+    def active(self, user_id: int) -> int:
+        return self._active.get(user_id, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": sum(self._active.values()),
+            "players": len(self._active),
+            "max_active_per_player": self.max_active,
+            "started": self.started,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "hunts": self.hunts,
+        }
+
+
+expeditions = ExpeditionTracker(EXPEDITION_MAX_ACTIVE)
+
+
+@safedb_execute
+@transactional
+def run_expedition(
+    chat_id: int, user_id: int, username: str, location_id: str, hunts: int
+) -> Dict[str, Any]:
+    """K охот подряд без интерфейса; итог применяется одной транзакцией.
+
+    Бои идут через combat_turn с собственным seed у каждого, HP переносится
+    между охотами, статы фиксируются на старте экспедиции. Первое поражение
+    завершает экспедицию.
+    """
+    player = get_player(chat_id, user_id)
+    location = LOCATIONS.get(location_id)
+    if not player or not location:
+        return {"success": False, "message": "Персонаж или локация не найдены."}
+    if player["level"] < location["min_level"] or player["level"] > location["max_level"] + 10:
+        return {"success": False, "message": "Локация не подходит по уровню."}
+
+    combat_stats = pack_combat_stats(player)
+    xp_bonus = PETS[player["pet_id"]]["xp_bonus"] if player["pet_id"] in PETS else 1.0
+    hp = player["health"]
+    summary: Dict[str, Any] = {
+        "success": True,
+        "location_id": location_id,
+        "planned": hunts,
+        "won": 0,
+        "bosses": 0,
+        "rounds": 0,
+        "xp_gained": 0,
+        "gold_gained": 0,
+        "loot": {},
+        "defeat": False,
+        "gold_lost": 0,
+        "level_up": 0,
+    }
+
+    for _ in range(hunts):
+        battle = roll_hunt_battle(player, location_id, hp, combat_stats)
+        state = combat_state(battle, hp)
+        played = ""
+        events = [battle_start_event(user_id, battle)]
+        while True:
+            played += BATTLE_ATTACK
+            turn = combat_turn(state, BATTLE_ATTACK, battle_rng(battle["seed"], len(played)))
+            events.extend(battle_turn_events(user_id, battle["seed"], len(played), turn, state))
+            if turn["outcome"]:
+                break
+        combat_log.emit(events)
+        hp = state["player_hp"]
+        summary["rounds"] += len(played)
+        record_fight(
+            battle,
+            played,
+            {"outcome": turn["outcome"], "enemy_hp": max(0, state["enemy_hp"]), "player_hp": max(0, hp), "loot": turn["loot"]},
         )
-        c.execute(
-            "SELECT current_floor FROM dungeon_progress WHERE user_id = ? AND chat_id = ?",
-            (user_id, chat_id),
+        if turn["outcome"] == "defeat":
+            summary["defeat"] = True
+            break
+
+        enemy = ENEMIES[battle["enemy_id"]]
+        summary["won"] += 1
+        summary["bosses"] += int(battle["is_boss"])
+        summary["xp_gained"] += int(enemy.get("xp", 0) * xp_bonus)
+        summary["gold_gained"] += enemy.get("gold", 0)
+        if turn["loot"]:
+            summary["loot"][turn["loot"]] = summary["loot"].get(turn["loot"], 0) + 1
+
+    if summary["won"]:
+        if not summary["defeat"]:
+            player_cache.set(chat_id, user_id, health=hp)
+        add_gold(chat_id, user_id, summary["gold_gained"])
+        player_cache.add(
+            chat_id,
+            user_id,
+            total_kills=summary["won"],
+            total_battles_won=summary["won"],
+            total_bosses_killed=summary["bosses"],
+        )
+        for item_id, quantity in summary["loot"].items():
+            add_item(chat_id, user_id, item_id, quantity)
+        summary["level_up"] = add_xp(chat_id, user_id, username, summary["xp_gained"])
+
+    if summary["defeat"]:
+        gold = player_cache.get(chat_id, user_id)["gold"]
+        summary["gold_lost"] = int(gold * 0.1)
+        if summary["gold_lost"] > 0:
+            subtract_gold(chat_id, user_id, summary["gold_lost"])
+        player_cache.mutate(
+            chat_id,
+            user_id,
+            lambda p: {"health": p["max_health"], "total_battles_lost": p["total_battles_lost"] + 1},
         )
-        floor_row = c.fetchone()
-        if floor_row and floor_row["current_floor"] > 1:
-            player = get_player(chat_id, user_id)
-            if player:
-                c.execute(
-                    "UPDATE players SET dungeon_rating = ? WHERE user_id = ? AND chat_id = ?",
-                    (floor_row["current_floor"], user_id, chat_id),
-                )
 
-    conn.commit()
-    conn.close()
+    summary["hunts"] = summary["won"] + int(summary["defeat"])
+    return summary
 
 
 # ===================== ПВП (ГЛОБАЛЬНОЕ) =====================
 
-@safedb_execute
-def add_pvp_queue(chat_id: int, user_id: int):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT OR REPLACE INTO pvp_queue (user_id, chat_id, is_waiting, confirmed, timestamp)
-        VALUES (?, ?, 1, 0, CURRENT_TIMESTAMP)
-        """,
-        (user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
+def pvp_rating(player: Dict[str, Any]) -> int:
+    """MMR игрока; до первого боя — стартовый рейтинг с поправкой на уровень"""
+    if player.get("mmr") is not None:
+        return player["mmr"]
+    return PVP_MMR_START + (player["level"] - 1) * PVP_MMR_PER_LEVEL
+
+
+def elo_delta(rating: int, opponent_rating: int, score: float) -> int:
+    """Изменение рейтинга по Эло: score — 1 победа, 0 поражение"""
+    expected = 1.0 / (1.0 + 10 ** ((opponent_rating - rating) / 400))
+    return round(PVP_MMR_K * (score - expected))
+
+
+class PvpMatchmaker:
+    """Очередь ПВП в памяти: корзины по MMR шириной bucket, внутри корзины — FIFO.
+
+    Окно поиска игрока растёт от PVP_MMR_WINDOW на PVP_MMR_WIDEN_STEP каждые
+    PVP_WINDOW_WIDEN_SEC ожидания, но не больше PVP_MMR_WINDOW_MAX. Пара
+    подходит, если разница рейтингов укладывается в окно хотя бы одного из
+    двух. Голова корзины ждёт дольше всех в ней, значит и окно у неё шире
+    всех — поэтому поиску достаточно посмотреть по одной голове в каждой из
+    соседних корзин (их 2 * PVP_MMR_WINDOW_MAX / bucket + 1, точность — ширина
+    корзины).
+
+    Таблица pvp_queue остаётся резервной копией: в неё пишется только
+    постановка и уход из очереди, а при старте очередь поднимается из неё.
+    """
+
+    def __init__(self, bucket: int, window: int, window_max: int, widen_step: int, widen_sec: float):
+        self.bucket = bucket
+        self.window = window
+        self.window_max = window_max
+        self.widen_step = widen_step
+        self.widen_sec = widen_sec
+        self._buckets: Dict[int, "OrderedDict[int, Dict[str, Any]]"] = {}
+        self._entries: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self.searches = 0
+        self.matches = 0
+        self.expired = 0
+        self.conflicts = 0
+        self.wait_total = 0.0
+
+    def window_for(self, entry: Optional[Dict[str, Any]], now: float) -> int:
+        if entry is None:
+            return self.window
+        widened = self.window + int((now - entry["joined"]) / self.widen_sec) * self.widen_step
+        return min(self.window_max, widened)
+
+    def _put(self, entry: Dict[str, Any]):
+        self._entries[entry["user_id"]] = entry
+        self._buckets.setdefault(entry["rating"] // self.bucket, OrderedDict())[entry["user_id"]] = entry
+
+    def _pop(self, user_id: int) -> Optional[Dict[str, Any]]:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            key = entry["rating"] // self.bucket
+            bucket = self._buckets[key]
+            del bucket[user_id]
+            if not bucket:
+                del self._buckets[key]
+        return entry
+
+    def join(self, chat_id: int, user_id: int, rating: int, waited: float = 0.0) -> bool:
+        """Ставит игрока в очередь; False, если он уже ждёт (место в очереди сохраняется)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if entry["rating"] != rating:
+                    self._pop(user_id)
+                    self._put({**entry, "rating": rating})
+                return False
+            self._put({"user_id": user_id, "chat_id": chat_id, "rating": rating, "joined": time.monotonic() - waited})
+        storage.on_rollback(lambda: self.remove(user_id))
+        return True
+
+    def remove(self, *user_ids: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            removed = [entry for entry in map(self._pop, user_ids) if entry is not None]
+        if removed:
+            storage.on_rollback(lambda: self._restore(removed))
+        return removed
+
+    def claim(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Забирает ожидающего из очереди для боя; None — его уже забрал другой бой"""
+        claimed = self.remove(user_id)
+        if not claimed:
+            with self._lock:
+                self.conflicts += 1
+            return None
+        return claimed[0]
+
+    def _restore(self, entries: List[Dict[str, Any]]):
+        with self._lock:
+            for entry in entries:
+                if entry["user_id"] not in self._entries:
+                    self._put(entry)
+
+    def find(self, user_id: int, rating: int) -> Optional[Dict[str, Any]]:
+        """Дольше всех ждущий подходящий соперник (из очереди его не убирает)"""
+        now = time.monotonic()
+        with self._lock:
+            self.searches += 1
+            own_window = self.window_for(self._entries.get(user_id), now)
+            best = None
+            first = (rating - self.window_max) // self.bucket
+            last = (rating + self.window_max) // self.bucket
+            for key in range(first, last + 1):
+                bucket = self._buckets.get(key)
+                if not bucket:
+                    continue
+                for candidate in bucket.values():
+                    if candidate["user_id"] != user_id:
+                        break
+                else:
+                    continue
+                window = max(own_window, self.window_for(candidate, now))
+                if abs(candidate["rating"] - rating) <= window and (best is None or candidate["joined"] < best["joined"]):
+                    best = candidate
+            return dict(best) if best else None
+
+    def matched(self, entry: Dict[str, Any]):
+        with self._lock:
+            self.matches += 1
+            self.wait_total += time.monotonic() - entry["joined"]
+
+    def expire(self, ttl: float) -> int:
+        """Убирает из памяти тех, кто ждёт дольше ttl (строки таблицы чистит уборщик)"""
+        deadline = time.monotonic() - ttl
+        with self._lock:
+            stale = [user_id for user_id, entry in self._entries.items() if entry["joined"] < deadline]
+            for user_id in stale:
+                self._pop(user_id)
+            self.expired += len(stale)
+        return len(stale)
+
+    def rehydrate(self) -> int:
+        entries = storage.pvp_queue_entries()
+        with self._lock:
+            for row in entries:
+                if row["user_id"] not in self._entries:
+                    self._put({
+                        "user_id": row["user_id"],
+                        "chat_id": row["chat_id"],
+                        "rating": pvp_rating(row),
+                        "joined": time.monotonic() - db_timestamp_age(row["timestamp"]),
+                    })
+        logger.info(f"♻️ Очередь ПВП восстановлена: {len(entries)}")
+        return len(entries)
+
+    def waiting(self, user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._entries
+
+    def first_sighting(self, user_id: int, finder_id: int) -> bool:
+        """True, если finder_id видит ожидающего user_id впервые: стоит его уведомить"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False
+            seen = entry.setdefault("seen_by", set())
+            if finder_id in seen:
+                return False
+            seen.add(finder_id)
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "waiting": len(self._entries),
+                "buckets": len(self._buckets),
+                "searches": self.searches,
+                "matches": self.matches,
+                "expired": self.expired,
+                "conflicts": self.conflicts,
+                "avg_wait_sec": round(self.wait_total / self.matches, 3) if self.matches else 0.0,
+                "bucket": self.bucket,
+                "window": [self.window, self.window_max],
+            }
+
+
+pvp_matchmaker = PvpMatchmaker(
+    PVP_MMR_BUCKET, PVP_MMR_WINDOW, PVP_MMR_WINDOW_MAX, PVP_MMR_WIDEN_STEP, PVP_WINDOW_WIDEN_SEC
+)
 
 
 @safedb_execute
-def confirm_pvp_search(chat_id: int, user_id: int):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE pvp_queue SET confirmed = 1 WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
+@transactional
+def add_pvp_queue(chat_id: int, user_id: int, rating: int):
+    """Постановка в очередь; в таблицу пишет только новую постановку"""
+    if pvp_matchmaker.join(chat_id, user_id, rating):
+        storage.enqueue_pvp(chat_id, user_id)
 
 
 @safedb_execute
+@transactional
 def cancel_pvp_search(chat_id: int, user_id: int):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM pvp_queue WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-    conn.commit()
-    conn.close()
+    if pvp_matchmaker.remove(user_id):
+        storage.dequeue_pvp(chat_id, user_id)
 
 
 @safedb_execute
@@ -1656,64 +5169,54 @@ def find_pvp_opponent(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
     if not player:
         return None
 
-    min_level = max(1, player["level"] - 5)
-    max_level = player["level"] + 5
-
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT p.user_id,
-               p.chat_id,
-               p.username,
-               p.level,
-               p.attack,
-               p.defense,
-               p.gold,
-               p.class
-        FROM players p
-        JOIN pvp_queue q ON p.user_id = q.user_id
-        WHERE p.user_id != ?
-          AND p.level BETWEEN ? AND ?
-          AND q.confirmed = 1
-          AND q.is_waiting = 1
-        ORDER BY q.timestamp ASC
-        LIMIT 1
-        """,
-        (user_id, min_level, max_level),
-    )
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    entry = pvp_matchmaker.find(user_id, pvp_rating(player))
+    if not entry:
+        return None
+    opponent = player_cache.get_by_user(entry["user_id"])
+    if not opponent:
+        # Игрока больше нет — его место в очереди уже ничего не значит
+        pvp_matchmaker.remove(entry["user_id"])
+        return None
+    return opponent
 
 
 @safedb_execute
+@transactional
 def pvp_battle(
     attacker_chat_id: int, attacker_id: int, defender_id: int, username: str
 ) -> Dict[str, Any]:
-    """БОЙ ПВП между игроками"""
+    """БОЙ ПВП между игроками.
+
+    Захват соперника, бой и награды — одна транзакция BEGIN IMMEDIATE.
+    Защитник сначала забирается из очереди сравнением с удалением (в памяти
+    матчмейкера и строкой pvp_queue); второй одновременный бой с тем же
+    защитником получает отказ, ничего не прочитав и не записав.
+    """
+    if attacker_id == defender_id:
+        return {"success": False, "message": "Нельзя сражаться с самим собой."}
     attacker = get_player(attacker_chat_id, attacker_id)
+    if not attacker:
+        return {"success": False, "message": "Один из игроков не найден."}
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM players WHERE user_id = ?", (defender_id,))
-    drow = c.fetchone()
-    conn.close()
+    claimed = pvp_matchmaker.claim(defender_id)
+    if claimed is None or not storage.claim_pvp_opponent(defender_id):
+        return {"success": False, "message": "Соперник уже в бою или покинул арену."}
 
-    if not attacker or not drow:
-        return {"success": False, "message": "Один из игроков не найден."}
+    defender = player_cache.get_by_user(defender_id)
+    if not defender:
+        # Защитник уже снят с очереди: только откат вернёт его туда
+        raise RuntimeError(f"Защитник {defender_id} забран из очереди ПВП, но не найден")
 
-    defender = dict(drow)
     defender_chat_id = defender["chat_id"]
 
     attacker_stats = get_player_battle_stats(attacker)
     defender_stats = get_player_battle_stats(defender)
 
     attacker_damage, attacker_crit = calculate_damage(
-        attacker_stats["attack"],
-        defender_stats["defense"],
-        attacker_stats["crit_chance"],
-        attacker_stats["spell_power"],
+        attacker_stats.attack,
+        defender_stats.defense,
+        attacker_stats.crit_chance,
+        attacker_stats.spell_power,
     )
     defender_new_hp = defender["health"] - attacker_damage
 
@@ -1722,10 +5225,10 @@ def pvp_battle(
         attacker_new_hp = attacker["health"]
     else:
         defender_damage, defender_crit = calculate_damage(
-            defender_stats["attack"],
-            attacker_stats["defense"],
-            defender_stats["crit_chance"],
-            defender_stats["spell_power"],
+            defender_stats.attack,
+            attacker_stats.defense,
+            defender_stats.crit_chance,
+            defender_stats.spell_power,
         )
         attacker_new_hp = attacker["health"] - defender_damage
 
@@ -1743,36 +5246,36 @@ def pvp_battle(
             winner_id = defender_id
             reward_gold = int(attacker["gold"] * 0.05)
 
-    conn = get_db()
-    c = conn.cursor()
-
-    c.execute(
-        """
-        INSERT INTO pvp_battles (attacker_id, defender_id, chat_id, winner_id, reward_gold)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (attacker_id, defender_id, attacker_chat_id, winner_id, reward_gold),
-    )
-
-    c.execute(
-        "UPDATE players SET pvp_wins = pvp_wins + 1, gold = gold + ? WHERE user_id = ?",
-        (reward_gold, winner_id),
-    )
+    storage.record_pvp_battle(attacker_id, defender_id, attacker_chat_id, winner_id, reward_gold)
+    # Нападающий мог стоять в очереди с прошлого поиска — бой её закрывает
+    storage.dequeue_pvp(attacker_chat_id, attacker_id)
+    for entry in [claimed] + pvp_matchmaker.remove(attacker_id):
+        pvp_matchmaker.matched(entry)
 
-    loser_id = defender_id if winner_id == attacker_id else attacker_id
-    c.execute(
-        "UPDATE players SET pvp_losses = pvp_losses + 1, health = max_health WHERE user_id = ?",
-        (loser_id,),
-    )
+    # Эло считается от рейтингов до боя: сумма изменений обоих равна нулю
+    attacker_mmr, defender_mmr = pvp_rating(attacker), pvp_rating(defender)
+    attacker_delta = elo_delta(attacker_mmr, defender_mmr, 1.0 if winner_id == attacker_id else 0.0)
+    defender_delta = -attacker_delta
 
-    c.execute(
-        "DELETE FROM pvp_queue WHERE user_id IN (?, ?)",
-        (attacker_id, defender_id),
+    if winner_id == attacker_id:
+        winner_key, loser_key = (attacker_chat_id, attacker_id), (defender_chat_id, defender_id)
+        winner_mmr, loser_mmr = attacker_mmr + attacker_delta, defender_mmr + defender_delta
+    else:
+        winner_key, loser_key = (defender_chat_id, defender_id), (attacker_chat_id, attacker_id)
+        winner_mmr, loser_mmr = defender_mmr + defender_delta, attacker_mmr + attacker_delta
+
+    player_cache.add(*winner_key, pvp_wins=1, gold=reward_gold)
+    player_cache.set(*winner_key, mmr=winner_mmr)
+    player_cache.mutate(
+        *loser_key,
+        lambda p: {
+            "pvp_losses": p["pvp_losses"] + 1,
+            "health": p["max_health"],
+            "gold": max(0, p["gold"] - reward_gold),
+            "mmr": loser_mmr,
+        },
     )
 
-    conn.commit()
-    conn.close()
-
     return {
         "success": True,
         "attacker_damage": attacker_damage,
@@ -1787,10 +5290,412 @@ def pvp_battle(
         if winner_id == attacker_id
         else attacker["username"],
         "reward_gold": reward_gold,
+        "attacker_mmr": attacker_mmr + attacker_delta,
+        "attacker_mmr_delta": attacker_delta,
+        "defender_mmr": defender_mmr + defender_delta,
+        "defender_mmr_delta": defender_delta,
+        "defender_id": defender_id,
         "defender_chat_id": defender_chat_id,
     }
 
 
+# ===================== ТУРНИРЫ =====================
+
+TOURNAMENT_MAX_TURNS = 40
+TOURNAMENT_PAYOUTS = (0.5, 0.3, 0.2)
+TOURNAMENT_FORMATS = {"bracket": "🏆 Олимпийская система", "swiss": "🇨🇭 Швейцарская система"}
+
+
+def tournament_entrant(player: Dict[str, Any]) -> Dict[str, Any]:
+    """Снимок участника: только то, что нужно бою, — уходит в другой процесс"""
+    stats = get_player_battle_stats(player)
+    return {
+        "user_id": player["user_id"],
+        "chat_id": player["chat_id"],
+        "username": player["username"],
+        "health": player["max_health"],
+        "attack": stats.attack,
+        "defense": stats.defense,
+        "crit_chance": stats.crit_chance,
+        "spell_power": stats.spell_power,
+        "rating": pvp_rating(player),
+    }
+
+
+@safedb_execute
+def snapshot_tournament_entrants(chat_id: int, user_ids: List[int]) -> List[Dict[str, Any]]:
+    """Статы фиксируются на старте: дальше турнир хранилище не читает"""
+    entrants = []
+    for user_id in user_ids:
+        player = get_player(chat_id, user_id)
+        if player:
+            entrants.append(tournament_entrant(player))
+    return entrants
+
+
+def tournament_duel(a: Dict[str, Any], b: Dict[str, Any], seed: int) -> Dict[str, Any]:
+    """Бой двух снимков без хранилища и глобального состояния.
+
+    Удары — тот же calculate_damage, что в ПВП, ход N берёт battle_rng(seed, N),
+    так что бой воспроизводится по seed. Если за TOURNAMENT_MAX_TURNS ходов
+    никто не пал, побеждает тот, у кого осталась большая доля здоровья.
+    """
+    fighters = (a, b)
+    hp = [a["health"], b["health"]]
+    first = battle_rng(seed, 0).randint(0, 1)
+    turns = 0
+    while turns < TOURNAMENT_MAX_TURNS and hp[0] > 0 and hp[1] > 0:
+        striker = (first + turns) % 2
+        target = 1 - striker
+        damage, _ = calculate_damage(
+            fighters[striker]["attack"],
+            fighters[target]["defense"],
+            fighters[striker]["crit_chance"],
+            fighters[striker]["spell_power"],
+            battle_rng(seed, turns + 1),
+        )
+        hp[target] -= damage
+        turns += 1
+
+    share = [hp[i] / fighters[i]["health"] for i in (0, 1)]
+    winner = 0 if share[0] > share[1] or (share[0] == share[1] and first == 0) else 1
+    return {
+        "a": a["user_id"],
+        "b": b["user_id"],
+        "winner_id": fighters[winner]["user_id"],
+        "turns": turns,
+        "seed": seed,
+    }
+
+
+def resolve_tournament_fights(fights: List[Tuple[Dict[str, Any], Dict[str, Any], int]]) -> List[Dict[str, Any]]:
+    """Задание для пула процессов: пачка боёв одного раунда"""
+    return [tournament_duel(a, b, seed) for a, b, seed in fights]
+
+
+def by_rating(entrants: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return sorted(entrants, key=lambda e: (-e["rating"], e["user_id"]))
+
+
+def bracket_pairings(alive: List[Dict[str, Any]]) -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any]]], List[Dict[str, Any]]]:
+    """Раунд олимпийской системы с пересевом: сильнейший против слабейшего.
+
+    Если участников не степень двойки, лучшие по рейтингу проходят первый
+    раунд без боя — после него сетка всегда ровная.
+    """
+    size = 1
+    while size < len(alive):
+        size *= 2
+    ranked = by_rating(alive)
+    byes, rest = ranked[:size - len(alive)], ranked[size - len(alive):]
+    return [(rest[i], rest[-1 - i]) for i in range(len(rest) // 2)], byes
+
+
+def swiss_pairings(
+    entrants: List[Dict[str, Any]], scores: Dict[int, int], played: set, had_bye: set
+) -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any]]], List[Dict[str, Any]]]:
+    """Раунд швейцарской системы: соседи по таблице, без повторных встреч по возможности.
+
+    При нечётном числе участников проход без боя (очко) получает самый слабый
+    в таблице из тех, у кого его ещё не было.
+    """
+    order = sorted(entrants, key=lambda e: (-scores[e["user_id"]], -e["rating"], e["user_id"]))
+    byes = []
+    if len(order) % 2:
+        bye = next((e for e in reversed(order) if e["user_id"] not in had_bye), order[-1])
+        order.remove(bye)
+        byes.append(bye)
+
+    pairs = []
+    while order:
+        a = order.pop(0)
+        index = next(
+            (i for i, b in enumerate(order) if frozenset((a["user_id"], b["user_id"])) not in played),
+            0,
+        )
+        pairs.append((a, order.pop(index)))
+    return pairs, byes
+
+
+def tournament_standings(
+    entrants: List[Dict[str, Any]], scores: Dict[int, int], opponents: Dict[int, List[int]]
+) -> List[Dict[str, Any]]:
+    """Итоговая таблица: победы, затем коэффициент Бухгольца (сумма очков соперников), затем рейтинг"""
+    buchholz = {uid: sum(scores[o] for o in opponents[uid]) for uid in scores}
+    return sorted(
+        entrants,
+        key=lambda e: (-scores[e["user_id"]], -buchholz[e["user_id"]], -e["rating"], e["user_id"]),
+    )
+
+
+@safedb_execute
+@transactional
+def record_tournament(
+    chat_id: int,
+    fmt: str,
+    entrants: int,
+    rounds: int,
+    matches: List[Tuple[int, int, int, int, int, int]],
+    payouts: List[Tuple[int, int, int]],
+) -> int:
+    """Итог турнира одной транзакцией: строка турнира, все бои и призовые (chat_id, user_id, gold)"""
+    prize_pool = sum(gold for _, _, gold in payouts)
+    winner_id = payouts[0][1] if payouts else None
+    tournament_id = storage.record_tournament(chat_id, fmt, entrants, rounds, winner_id, prize_pool, matches)
+    for player_chat_id, user_id, gold in payouts:
+        player_cache.add(player_chat_id, user_id, gold=gold)
+    return tournament_id
+
+
+def tournament_round_report(
+    round_no: int, rounds: int, results: List[Dict[str, Any]], byes: List[Dict[str, Any]], names: Dict[int, str],
+    shown: int = 8,
+) -> str:
+    lines = [f"⚔️ ТУРНИР: раунд {round_no}/{rounds}, боёв: {len(results)}\n"]
+    for r in results[:shown]:
+        loser_id = r["b"] if r["winner_id"] == r["a"] else r["a"]
+        lines.append(f"🥊 {names[r['winner_id']]} победил {names[loser_id]} ({r['turns']} ход.)")
+    if len(results) > shown:
+        lines.append(f"…и ещё {len(results) - shown} боёв")
+    if byes:
+        lines.append("\nБез боя проходят: " + ", ".join(names[e["user_id"]] for e in byes[:shown])
+                     + (f" и ещё {len(byes) - shown}" if len(byes) > shown else ""))
+    return "\n".join(lines)
+
+
+def tournament_final_report(summary: Dict[str, Any]) -> str:
+    lines = [
+        f"🏁 ТУРНИР ЗАВЕРШЁН — {TOURNAMENT_FORMATS[summary['format']]}\n",
+        f"Участников: {summary['entrants']}, раундов: {summary['rounds']}, боёв: {summary['fights']}",
+        f"Призовой фонд: {summary['prize_pool']} 💰\n",
+    ]
+    for medal, (entrant, wins, gold) in zip(("🥇", "🥈", "🥉"), summary["podium"]):
+        lines.append(f"{medal} {entrant['username']} — побед: {wins}, +{gold} 💰")
+    return "\n".join(lines)
+
+
+class TournamentRunner:
+    """Турниры ПВП по чатам: запись в лобби, раунды в пуле процессов, итог одной транзакцией.
+
+    Лобби живут в памяти и трогаются только из event loop бота. На старте
+    статы участников снимаются один раз, бои раунда — чистые функции
+    tournament_duel, которые пачками по TOURNAMENT_CHUNK_FIGHTS уходят в
+    ProcessPoolExecutor и не касаются ни хранилища, ни кешей. Итоги каждого
+    раунда сразу уходят в чат через notifier, а все бои и призовые пишутся
+    одной транзакцией record_tournament после последнего раунда.
+    Пул процессов создаётся при первом турнире методом spawn: к этому
+    моменту в процессе уже работают потоки писателя и кешей, а fork копирует
+    их блокировки в неизвестном состоянии.
+    """
+
+    def __init__(self, workers: int, chunk: int):
+        self.workers = workers
+        self.chunk = max(1, chunk)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lobbies: Dict[int, Dict[str, Any]] = {}
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.fights = 0
+        self.fight_time = 0.0
+
+    def lobby(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        return self._lobbies.get(chat_id)
+
+    def open(self, chat_id: int, organizer_id: int, username: str, fmt: str) -> Optional[str]:
+        """Открывает запись; организатор записывается первым. Возвращает текст ошибки или None"""
+        if fmt not in TOURNAMENT_FORMATS:
+            return "❌ Неизвестный формат турнира."
+        if chat_id in self._lobbies:
+            return "❌ В этом чате уже идёт запись на турнир."
+        self._lobbies[chat_id] = {
+            "format": fmt,
+            "organizer_id": organizer_id,
+            "entrants": {organizer_id: username},
+            "running": False,
+        }
+        return None
+
+    def join(self, chat_id: int, user_id: int, username: str) -> Optional[str]:
+        lobby = self._lobbies.get(chat_id)
+        if lobby is None:
+            return "❌ Запись на турнир не открыта."
+        if lobby["running"]:
+            return "⏳ Турнир уже начался."
+        if user_id in lobby["entrants"]:
+            return "Ты уже записан."
+        if len(lobby["entrants"]) >= TOURNAMENT_MAX_ENTRANTS:
+            return f"❌ Мест нет: не больше {TOURNAMENT_MAX_ENTRANTS} участников."
+        lobby["entrants"][user_id] = username
+        return None
+
+    def leave(self, chat_id: int, user_id: int) -> Optional[str]:
+        lobby = self._lobbies.get(chat_id)
+        if lobby is None or user_id not in lobby["entrants"]:
+            return "Ты не записан на турнир."
+        if lobby["running"]:
+            return "⏳ Турнир уже начался."
+        if user_id == lobby["organizer_id"]:
+            return "Организатор может только отменить турнир."
+        del lobby["entrants"][user_id]
+        return None
+
+    def cancel(self, chat_id: int, user_id: int) -> Optional[str]:
+        lobby = self._lobbies.get(chat_id)
+        if lobby is None:
+            return "❌ Запись на турнир не открыта."
+        if user_id != lobby["organizer_id"]:
+            return "Отменить турнир может только организатор."
+        if lobby["running"]:
+            return "⏳ Турнир уже начался."
+        del self._lobbies[chat_id]
+        return None
+
+    def begin(self, chat_id: int, user_id: int) -> Optional[str]:
+        """Закрывает запись перед run(); возвращает текст ошибки или None"""
+        lobby = self._lobbies.get(chat_id)
+        if lobby is None:
+            return "❌ Запись на турнир не открыта."
+        if user_id != lobby["organizer_id"]:
+            return "Начать турнир может только организатор."
+        if lobby["running"]:
+            return "⏳ Турнир уже идёт."
+        if len(lobby["entrants"]) < TOURNAMENT_MIN_ENTRANTS:
+            return f"Для старта нужно участников: не меньше {TOURNAMENT_MIN_ENTRANTS}."
+        lobby["running"] = True
+        return None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def _resolve(self, fights: List[Tuple[Dict[str, Any], Dict[str, Any], int]]) -> List[Dict[str, Any]]:
+        """Бои раунда пачками в пуле процессов; при TOURNAMENT_WORKERS=0 — в потоке"""
+        if not fights:
+            return []
+        started = time.perf_counter()
+        if self.workers > 0:
+            loop = asyncio.get_running_loop()
+            pool = self._executor()
+            parts = await asyncio.gather(*(
+                loop.run_in_executor(pool, resolve_tournament_fights, fights[i:i + self.chunk])
+                for i in range(0, len(fights), self.chunk)
+            ))
+        else:
+            parts = [await asyncio.to_thread(resolve_tournament_fights, fights)]
+        self.fight_time += time.perf_counter() - started
+        self.fights += len(fights)
+        return [result for part in parts for result in part]
+
+    async def play(self, chat_id: int, fmt: str, entrants: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Все раунды турнира по снимкам участников; хранилище не трогает"""
+        by_id = {e["user_id"]: e for e in entrants}
+        names = {uid: e["username"] for uid, e in by_id.items()}
+        scores = {uid: 0 for uid in by_id}
+        opponents: Dict[int, List[int]] = {uid: [] for uid in by_id}
+        played: set = set()
+        had_bye: set = set()
+        matches: List[Tuple[int, int, int, int, int, int]] = []
+
+        rounds = (len(entrants) - 1).bit_length()
+        if fmt == "swiss" and TOURNAMENT_SWISS_ROUNDS > 0:
+            rounds = min(TOURNAMENT_SWISS_ROUNDS, len(entrants) - 1)
+        alive = list(entrants)
+
+        for round_no in range(1, rounds + 1):
+            if fmt == "bracket":
+                pairs, byes = bracket_pairings(alive)
+            else:
+                pairs, byes = swiss_pairings(entrants, scores, played, had_bye)
+            results = await self._resolve([(a, b, new_battle_seed()) for a, b in pairs])
+
+            for r in results:
+                scores[r["winner_id"]] += 1
+                opponents[r["a"]].append(r["b"])
+                opponents[r["b"]].append(r["a"])
+                played.add(frozenset((r["a"], r["b"])))
+                matches.append((round_no, r["a"], r["b"], r["winner_id"], r["turns"], r["seed"]))
+            for e in byes:
+                scores[e["user_id"]] += 1
+                had_bye.add(e["user_id"])
+            if fmt == "bracket":
+                alive = byes + [by_id[r["winner_id"]] for r in results]
+
+            notifier.send(chat_id, tournament_round_report(round_no, rounds, results, byes, names))
+
+        standings = tournament_standings(entrants, scores, opponents)
+        prize_pool = TOURNAMENT_PRIZE_PER_ENTRANT * len(entrants)
+        podium = [
+            (e, scores[e["user_id"]], int(prize_pool * share))
+            for e, share in zip(standings, TOURNAMENT_PAYOUTS)
+        ]
+        return {
+            "format": fmt,
+            "entrants": len(entrants),
+            "rounds": rounds,
+            "fights": len(matches),
+            "matches": matches,
+            "prize_pool": sum(gold for _, _, gold in podium),
+            "podium": podium,
+        }
+
+    async def run(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        """Проводит турнир, открытый begin(): снимок, раунды, одна запись итога"""
+        lobby = self._lobbies[chat_id]
+        self.started += 1
+        try:
+            entrants = await db_call(snapshot_tournament_entrants, chat_id, list(lobby["entrants"]))
+            if not entrants or len(entrants) < TOURNAMENT_MIN_ENTRANTS:
+                notifier.send(chat_id, "❌ Турнир отменён: не хватает участников.")
+                return None
+
+            summary = await self.play(chat_id, lobby["format"], entrants)
+            payouts = [(e["chat_id"], e["user_id"], gold) for e, _, gold in summary["podium"] if gold > 0]
+            tournament_id = await db_write(
+                record_tournament, chat_id, summary["format"], summary["entrants"], summary["rounds"],
+                summary["matches"], payouts,
+            )
+            if tournament_id is None:
+                raise RuntimeError("итог турнира не записан")
+
+            summary["tournament_id"] = tournament_id
+            notifier.send(chat_id, tournament_final_report(summary))
+            self.completed += 1
+            logger.info(
+                f"🏆 Турнир #{tournament_id} в чате {chat_id}: {summary['entrants']} участников, "
+                f"{summary['fights']} боёв"
+            )
+            return summary
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"❌ Турнир в чате {chat_id} сорвался: {e}")
+            notifier.send(chat_id, "❌ Турнир сорвался, призовые не начислены.")
+            return None
+        finally:
+            self._lobbies.pop(chat_id, None)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "lobbies": len(self._lobbies),
+            "running": sum(1 for lobby in self._lobbies.values() if lobby["running"]),
+            "started": self.started,
+            "completed": self.completed,
+            "failed": self.failed,
+            "fights": self.fights,
+            "fights_per_sec": round(self.fights / self.fight_time) if self.fight_time else 0,
+            "workers": self.workers,
+        }
+
+
+tournaments = TournamentRunner(TOURNAMENT_WORKERS, TOURNAMENT_CHUNK_FIGHTS)
+
+
 # ===================== КРАФТИНГ =====================
 
 @safedb_execute
@@ -1825,14 +5730,7 @@ def craft_item(chat_id: int, user_id: int, recipe_id: str) -> Dict[str, Any]:
     subtract_gold(chat_id, user_id, recipe["gold"])
     add_item(chat_id, user_id, recipe["result"])
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE players SET craft_count = craft_count + 1 WHERE user_id = ? AND chat_id = ?",
-        (user_id, chat_id),
-    )
-    conn.commit()
-    conn.close()
+    player_cache.add(chat_id, user_id, craft_count=1)
 
     return {
         "success": True,
@@ -1843,86 +5741,40 @@ def craft_item(chat_id: int, user_id: int, recipe_id: str) -> Dict[str, Any]:
 
 # ===================== РЕЙТИНГИ =====================
 
+# Рейтинги читают SQLite напрямую, без сброса кеша игроков: таблица отстаёт
+# от кеша не больше чем на PLAYER_CACHE_FLUSH_SEC, для лидербордов это приемлемо,
+# а синхронный flush на каждый просмотр топа вставал бы в очередь писателя.
+
 @safedb_execute
 def get_global_leaderboard(chat_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT user_id, username, level, gold, total_kills, total_bosses_killed,
-               total_battles_won, total_battles_lost, pvp_wins, pvp_losses
-        FROM players
-        WHERE chat_id = ?
-        ORDER BY level DESC, gold DESC, total_kills DESC
-        LIMIT ?
-        """,
-        (chat_id, limit),
-    )
-    data = [dict(r) for r in c.fetchall()]
-    conn.close()
-    return data
+    return storage.top_players(chat_id, limit)
 
 
 @safedb_execute
 def get_pvp_leaderboard(chat_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT username, level, pvp_wins, pvp_losses,
-               CASE WHEN (pvp_wins + pvp_losses) > 0
-                    THEN ROUND(100.0 * pvp_wins / (pvp_wins + pvp_losses), 2)
-                    ELSE 0 END AS winrate
-        FROM players
-        WHERE chat_id = ? AND (pvp_wins + pvp_losses) > 0
-        ORDER BY pvp_wins DESC, winrate DESC
-        LIMIT ?
-        """,
-        (chat_id, limit),
-    )
-    data = [dict(r) for r in c.fetchall()]
-    conn.close()
-    return data
+    return storage.top_pvp(chat_id, limit)
+
+
+@safedb_execute
+def get_pvp_rank(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+    """Место игрока в лестнице ПВП: COUNT по диапазону idx_players_chat_mmr"""
+    player = get_player(chat_id, user_id)
+    if not player or player.get("mmr") is None:
+        return None
+    return {"mmr": player["mmr"], "place": storage.count_pvp_above(chat_id, player["mmr"]) + 1}
 
 
 @safedb_execute
 def get_dungeon_leaderboard(chat_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT username, level, dungeon_rating, total_bosses_killed
-        FROM players
-        WHERE chat_id = ? AND dungeon_rating > 0
-        ORDER BY dungeon_rating DESC, total_bosses_killed DESC
-        LIMIT ?
-        """,
-        (chat_id, limit),
-    )
-    data = [dict(r) for r in c.fetchall()]
-    conn.close()
-    return data
+    return storage.top_dungeon(chat_id, limit)
 
 
 @safedb_execute
-def get_player_position(chat_id: int, user_id: int) -> int:
-    player = get_player(chat_id, user_id)
+def get_player_position(chat_id: int, user_id: int, snap: Optional[UpdateSnapshot] = None) -> int:
+    player = snap.player if snap else get_player(chat_id, user_id)
     if not player:
         return 0
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT COUNT(*) AS pos
-        FROM players
-        WHERE chat_id = ?
-          AND (level > ? OR (level = ? AND gold > ?))
-        """,
-        (chat_id, player["level"], player["level"], player["gold"]),
-    )
-    row = c.fetchone()
-    conn.close()
-    return int(row["pos"]) + 1 if row else 1
+    return storage.count_ranked_above(chat_id, player["level"], player["gold"]) + 1
 
 
 def build_player_card(player: Dict[str, Any]) -> str:
@@ -1939,13 +5791,179 @@ def build_player_card(player: Dict[str, Any]) -> str:
     )
 
 
+# ===================== УВЕДОМЛЕНИЯ =====================
+
+class Notifier:
+    """Исходящие сообщения, которые бот шлёт сам (не в ответ на нажатие).
+
+    У каждого чата своя очередь, а чаты с ожидающими сообщениями лежат в куче
+    по времени, когда в них снова можно писать: не чаще раза в chat_interval
+    секунд в чат, как требуют лимиты Telegram. Отправщик берёт из кучи
+    ближайший готовый чат с учётом общего лимита rate_per_sec, поэтому ждёт
+    только тот чат, что упёрся в свой интервал или получил RetryAfter, — в
+    остальные сообщения идут своим чередом. Заблокировавшие бота чаты
+    пропускаются. Переполненная очередь отбрасывает новые сообщения, а не
+    копит память.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, rate_per_sec: float, chat_interval: float, max_queue: int):
+        self.interval = 1.0 / rate_per_sec
+        self.chat_interval = chat_interval
+        self.max_queue = max_queue
+        self.bot = None
+        self._pending: Optional[Dict[int, Deque[Tuple[str, Any, int]]]] = None
+        self._ready: List[Tuple[float, int, int]] = []  # (когда можно писать, порядок, chat_id)
+        self._order = itertools.count()
+        self._size = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: set = set()
+        self._last_sent = 0.0
+        self._chat_sent: Dict[int, float] = {}
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self, bot):
+        self.bot = bot
+        self._pending = {}
+        self._ready = []
+        self._size = 0
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        """Досылает очередь (не дольше timeout) и останавливает отправщик"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Не отправлено уведомлений при остановке: {self._size}")
+        self._task.cancel()
+        for task in list(self._sending):
+            task.cancel()
+        self._task = None
+
+    def send(self, chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+        """Ставит сообщение в очередь; вызывать из event loop бота"""
+        if self._pending is None:
+            self.dropped += 1
+            return False
+        if self._size >= self.max_queue:
+            self.dropped += 1
+            logger.warning(f"⚠️ Очередь уведомлений переполнена, сообщение в {chat_id} отброшено")
+            return False
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = self._pending[chat_id] = deque()
+            self._schedule(chat_id, self._chat_sent.get(chat_id, 0.0) + self.chat_interval)
+        pending.append((text, reply_markup, 1))
+        self._size += 1
+        self._idle.clear()
+        return True
+
+    def _schedule(self, chat_id: int, at: float):
+        heapq.heappush(self._ready, (at, next(self._order), chat_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._ready:
+                await self._wakeup.wait()
+                continue
+            delay = max(self._ready[0][0], self._last_sent + self.interval) - time.monotonic()
+            if delay > 0:
+                # Новый чат может оказаться готов раньше — тогда будит send()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            self._last_sent = self._chat_sent[chat_id] = time.monotonic()
+            if len(self._chat_sent) > self.max_queue:
+                # Отметки старше интервала больше ничего не ограничивают
+                horizon = self._last_sent - self.chat_interval
+                self._chat_sent = {chat: at for chat, at in self._chat_sent.items() if at > horizon}
+            task = asyncio.create_task(self._deliver(chat_id))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _deliver(self, chat_id: int):
+        """Отправляет первое сообщение чата; чат возвращается в кучу, пока в нём что-то есть"""
+        pending = self._pending[chat_id]
+        text, reply_markup, attempt = pending[0]
+        retry_at = None
+        try:
+            await self.bot.send_message(chat_id, text, reply_markup=reply_markup)
+            self.sent += 1
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+            self.retried += 1
+            logger.warning(f"⏳ Telegram просит подождать {seconds} с (чат {chat_id}, попытка {attempt})")
+            if attempt < self.MAX_ATTEMPTS:
+                pending[0] = (text, reply_markup, attempt + 1)
+                retry_at = time.monotonic() + seconds
+            else:
+                self.failed += 1
+        except Forbidden:
+            self.failed += 1
+        except TelegramError as e:
+            self.failed += 1
+            logger.warning(f"⚠️ Уведомление в {chat_id} не отправлено: {e}")
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка отправки уведомления в {chat_id}: {e}")
+
+        if retry_at is None:
+            pending.popleft()
+            self._size -= 1
+            retry_at = self._chat_sent.get(chat_id, 0.0) + self.chat_interval
+        if pending:
+            self._schedule(chat_id, retry_at)
+        else:
+            del self._pending[chat_id]
+            if not self._size:
+                self._idle.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "queue_depth": self._size,
+            "chats_waiting": len(self._pending) if self._pending is not None else 0,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_per_sec": round(1.0 / self.interval, 2),
+            "chat_interval_sec": self.chat_interval,
+        }
+
+
+notifier = Notifier(NOTIFY_RATE_PER_SEC, NOTIFY_CHAT_INTERVAL_SEC, NOTIFY_QUEUE_SIZE)
+
+
 # ===================== TELEGRAM ОБРАБОТЧИКИ =====================
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
 
-    if player_exists(chat.id, user.id):
+    if await db_call(player_exists, chat.id, user.id):
         await show_main_menu(update, context)
         return
 
@@ -1982,7 +6000,7 @@ async def cb_select_class(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = query.message.chat
 
     class_name = query.data.replace("class_", "")
-    created = init_player(chat.id, user.id, user.username or user.first_name, class_name)
+    created = await db_write(init_player, chat.id, user.id, user.username or user.first_name, class_name)
     if not created:
         await query.answer("Ошибка создания персонажа.", show_alert=True)
         return
@@ -2007,7 +6025,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
 
-    player = get_player(chat.id, user.id)
+    snap = await get_snapshot(update, context).load("player")
+    player = snap.player
     if not player:
         text = "❌ Сначала создай персонажа: /start"
         if query:
@@ -2017,7 +6036,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     info = CLASSES[player["class"]]
-    pos = get_player_position(chat.id, user.id)
+    pos = await db_call(get_player_position, chat.id, user.id, snap=snap)
     
     text = (
         f"🎮 RuneQuestRPG\n\n"
@@ -2061,7 +6080,8 @@ async def cb_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    snap = await get_snapshot(update, context).load("player")
+    player = snap.player
     if not player:
         await query.answer("Персонаж не найден.", show_alert=True)
         return
@@ -2069,15 +6089,19 @@ async def cb_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     info = CLASSES[player["class"]]
     pet = PETS.get(player["pet_id"], PETS["wolf"])
     stats = get_player_battle_stats(player)
-    pos = get_player_position(chat.id, user.id)
+    pos = await db_call(get_player_position, chat.id, user.id, snap=snap)
+    xp, needed, fraction = level_progress(player["level"], player["xp"])
+    xp_line = f"{xp}/{needed} XP" if needed else "макс. уровень"
 
     text = (
         f"👤 Профиль: {user.first_name}\n\n"
         f"{info['emoji']} Класс: {info['name']} (Ур. {player['level']}/{MAX_LEVEL})\n"
+        f"✨ {progress_bar(fraction)} {xp_line}\n"
+        f"📚 Всего опыта: {total_xp(player['level'], player['xp'])}\n"
         f"📊 Позиция: #{pos}\n\n"
         f"⚔️ Боевые статы:\n"
-        f"  ⚔️ Атака: {stats['attack']} | 🛡️ Защита: {stats['defense']}\n"
-        f"  💥 Крит: {stats['crit_chance']}%\n\n"
+        f"  ⚔️ Атака: {stats.attack} | 🛡️ Защита: {stats.defense}\n"
+        f"  💥 Крит: {stats.crit_chance}%\n\n"
         f"📈 Статистика:\n"
         f"  Побед: {player['total_battles_won']} | Поражений: {player['total_battles_lost']}\n"
         f"  Боссов убито: {player['total_bosses_killed']}\n"
@@ -2096,8 +6120,8 @@ async def cb_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    items = get_inventory(chat.id, user.id)
-    player = get_player(chat.id, user.id)
+    items = await db_call(get_inventory, chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
     
     if not items:
         text = "🎒 Инвентарь пуст."
@@ -2122,7 +6146,8 @@ async def cb_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 lines.append(f"  {p['emoji']} {p['name']} x{qty}")
             elif iid in RUNES:
                 r = RUNES[iid]
-                lines.append(f"  {r['emoji']} {r['name']} x{qty}")
+                emoji = "✅" if iid == player["equipped_rune"] else "  "
+                lines.append(f"{emoji} {r['emoji']} {r['name']} x{qty}")
             elif iid == "health_potion":
                 lines.append(f"  🧪 Зелье лечения x{qty}")
         text = "\n".join(lines)
@@ -2140,11 +6165,12 @@ async def cb_show_equipment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
-    inventory = get_inventory(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
+    inventory = await db_call(get_inventory, chat.id, user.id)
 
     weapons_in_inv = [it for it in inventory if it["item_id"] in WEAPONS]
     armor_in_inv = [it for it in inventory if it["item_id"] in ARMOR]
+    runes_in_inv = [it for it in inventory if it["item_id"] in RUNES]
 
     text = "🛠️ ЭКИПИРОВКА\n\n"
 
@@ -2162,6 +6188,15 @@ async def cb_show_equipment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         text += "🛡️ Броня: не экипирована\n"
 
+    rune = RUNES.get(player["equipped_rune"])
+    if rune:
+        text += (
+            f"🔮 Руна: {rune['emoji']} {rune['name']} "
+            f"(+{rune['attack_bonus']} атак, +{rune['defense_bonus']} защ, +{rune['crit_bonus']}% крит)\n"
+        )
+    else:
+        text += "🔮 Руна: не экипирована\n"
+
     text += "\n\n" + build_player_card(player)
 
     keyboard: List[List[InlineKeyboardButton]] = []
@@ -2169,6 +6204,8 @@ async def cb_show_equipment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard.append([InlineKeyboardButton("🔧 Смена оружия", callback_data="select_weapon")])
     if armor_in_inv:
         keyboard.append([InlineKeyboardButton("🔧 Смена брони", callback_data="select_armor")])
+    if runes_in_inv:
+        keyboard.append([InlineKeyboardButton("🔧 Смена руны", callback_data="select_rune")])
 
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="inventory")])
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -2179,9 +6216,9 @@ async def cb_select_weapon_to_equip(update: Update, context: ContextTypes.DEFAUL
     user = query.from_user
     chat = query.message.chat
 
-    inventory = get_inventory(chat.id, user.id)
+    inventory = await db_call(get_inventory, chat.id, user.id)
     weapons = [it for it in inventory if it["item_id"] in WEAPONS]
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
 
     if not weapons:
         await query.answer("Нет оружия в инвентаре.", show_alert=True)
@@ -2215,40 +6252,89 @@ async def cb_equip_weapon_handler(update: Update, context: ContextTypes.DEFAULT_
     chat = query.message.chat
 
     weapon_id = query.data.replace("equip_weapon_", "")
-    if equip_weapon(chat.id, user.id, weapon_id):
+    if await db_write(equip_weapon, chat.id, user.id, weapon_id):
         weapon = WEAPONS[weapon_id]
         await query.answer(f"✅ Экипирован: {weapon['emoji']} {weapon['name']}", show_alert=False)
         await cb_show_equipment(update, context)
     else:
-        await query.answer("❌ Не удалось экипировать оружие.", show_alert=True)
+        await query.answer("❌ Не удалось экипировать оружие.", show_alert=True)
+
+
+async def cb_select_armor_to_equip(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = query.from_user
+    chat = query.message.chat
+
+    inventory = await db_call(get_inventory, chat.id, user.id)
+    armor_list = [it for it in inventory if it["item_id"] in ARMOR]
+    player = await db_call(get_player, chat.id, user.id)
+
+    if not armor_list:
+        await query.answer("Нет брони в инвентаре.", show_alert=True)
+        return
+
+    text = "🛡️ Выбери броню:\n\n"
+    keyboard: List[List[InlineKeyboardButton]] = []
+
+    for armor_inv in armor_list:
+        aid = armor_inv["item_id"]
+        armor = ARMOR[aid]
+        emoji = "✅" if aid == player["equipped_armor"] else "  "
+        text += f"{emoji} {armor['emoji']} {armor['name']} (+{armor['defense']})\n"
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    f"✓ {armor['emoji']} {armor['name']}",
+                    callback_data=f"equip_armor_{aid}",
+                )
+            ]
+        )
+
+    text += "\n\n" + build_player_card(player)
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="equipment")])
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_equip_armor_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = query.from_user
+    chat = query.message.chat
+
+    armor_id = query.data.replace("equip_armor_", "")
+    if await db_write(equip_armor, chat.id, user.id, armor_id):
+        armor = ARMOR[armor_id]
+        await query.answer(f"✅ Экипирована: {armor['emoji']} {armor['name']}", show_alert=False)
+        await cb_show_equipment(update, context)
+    else:
+        await query.answer("❌ Не удалось экипировать броню.", show_alert=True)
 
 
-async def cb_select_armor_to_equip(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_select_rune_to_equip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user = query.from_user
     chat = query.message.chat
 
-    inventory = get_inventory(chat.id, user.id)
-    armor_list = [it for it in inventory if it["item_id"] in ARMOR]
-    player = get_player(chat.id, user.id)
+    inventory = await db_call(get_inventory, chat.id, user.id)
+    runes = [it for it in inventory if it["item_id"] in RUNES]
+    player = await db_call(get_player, chat.id, user.id)
 
-    if not armor_list:
-        await query.answer("Нет брони в инвентаре.", show_alert=True)
+    if not runes:
+        await query.answer("Нет рун в инвентаре.", show_alert=True)
         return
 
-    text = "🛡️ Выбери броню:\n\n"
+    text = "🔮 Выбери руну:\n\n"
     keyboard: List[List[InlineKeyboardButton]] = []
 
-    for armor_inv in armor_list:
-        aid = armor_inv["item_id"]
-        armor = ARMOR[aid]
-        emoji = "✅" if aid == player["equipped_armor"] else "  "
-        text += f"{emoji} {armor['emoji']} {armor['name']} (+{armor['defense']})\n"
+    for rune_inv in runes:
+        rid = rune_inv["item_id"]
+        rune = RUNES[rid]
+        emoji = "✅" if rid == player["equipped_rune"] else "  "
+        text += f"{emoji} {rune['emoji']} {rune['name']} (+{rune['attack_bonus']}/+{rune['defense_bonus']})\n"
         keyboard.append(
             [
                 InlineKeyboardButton(
-                    f"✓ {armor['emoji']} {armor['name']}",
-                    callback_data=f"equip_armor_{aid}",
+                    f"✓ {rune['emoji']} {rune['name']}",
+                    callback_data=f"equip_rune_{rid}",
                 )
             ]
         )
@@ -2258,18 +6344,18 @@ async def cb_select_armor_to_equip(update: Update, context: ContextTypes.DEFAULT
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-async def cb_equip_armor_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_equip_rune_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user = query.from_user
     chat = query.message.chat
 
-    armor_id = query.data.replace("equip_armor_", "")
-    if equip_armor(chat.id, user.id, armor_id):
-        armor = ARMOR[armor_id]
-        await query.answer(f"✅ Экипирована: {armor['emoji']} {armor['name']}", show_alert=False)
+    rune_id = query.data.replace("equip_rune_", "")
+    if await db_write(equip_rune, chat.id, user.id, rune_id):
+        rune = RUNES[rune_id]
+        await query.answer(f"✅ Экипирована: {rune['emoji']} {rune['name']}", show_alert=False)
         await cb_show_equipment(update, context)
     else:
-        await query.answer("❌ Не удалось экипировать броню.", show_alert=True)
+        await query.answer("❌ Не удалось экипировать руну.", show_alert=True)
 
 
 # ===================== МАГАЗИН =====================
@@ -2279,7 +6365,7 @@ async def cb_show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
 
     text = (
         f"🏪 МАГАЗИН\n\n"
@@ -2307,7 +6393,7 @@ async def cb_show_weapons_shop(update: Update, context: ContextTypes.DEFAULT_TYP
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
 
     text = f"⚔️ ОРУЖИЕ (Золото: {player['gold']} 💰)\n\n"
     keyboard: List[List[InlineKeyboardButton]] = []
@@ -2339,7 +6425,7 @@ async def cb_show_armor_shop(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
 
     text = f"🛡️ БРОНЯ (Золото: {player['gold']} 💰)\n\n"
     keyboard: List[List[InlineKeyboardButton]] = []
@@ -2371,7 +6457,7 @@ async def cb_show_pets_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
 
     text = f"🐾 ПИТОМЦЫ (Золото: {player['gold']} 💰)\n\n"
     keyboard: List[List[InlineKeyboardButton]] = []
@@ -2403,7 +6489,7 @@ async def cb_show_runes_shop(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
 
     text = f"⚡ РУНЫ (Золото: {player['gold']} 💰)\n\n"
     keyboard: List[List[InlineKeyboardButton]] = []
@@ -2437,12 +6523,12 @@ async def cb_buy_weapon(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Оружие не найдено.", show_alert=True)
         return
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
     if not can_use_item(player["class"], weapon_id):
         await query.answer("❌ Не для твоего класса!", show_alert=True)
         return
 
-    if buy_item(chat.id, user.id, weapon_id):
+    if await db_write(buy_item, chat.id, user.id, weapon_id):
         weapon = WEAPONS[weapon_id]
         await query.answer(f"✅ Куплено: {weapon['emoji']} {weapon['name']}", show_alert=True)
         await cb_show_weapons_shop(update, context)
@@ -2460,12 +6546,12 @@ async def cb_buy_armor(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Броня не найдена.", show_alert=True)
         return
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
     if not can_use_item(player["class"], armor_id):
         await query.answer("❌ Не для твоего класса!", show_alert=True)
         return
 
-    if buy_item(chat.id, user.id, armor_id):
+    if await db_write(buy_item, chat.id, user.id, armor_id):
         armor = ARMOR[armor_id]
         await query.answer(f"✅ Куплено: {armor['emoji']} {armor['name']}", show_alert=True)
         await cb_show_armor_shop(update, context)
@@ -2483,7 +6569,7 @@ async def cb_buy_pet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Питомец не найден.", show_alert=True)
         return
 
-    if buy_pet(chat.id, user.id, pet_id):
+    if await db_write(buy_pet, chat.id, user.id, pet_id):
         pet = PETS[pet_id]
         await query.answer(f"✅ Куплено: {pet['emoji']} {pet['name']}", show_alert=True)
         await cb_show_pets_shop(update, context)
@@ -2501,7 +6587,7 @@ async def cb_buy_rune(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Руна не найдена.", show_alert=True)
         return
 
-    if buy_item(chat.id, user.id, rune_id):
+    if await db_write(buy_item, chat.id, user.id, rune_id):
         rune = RUNES[rune_id]
         await query.answer(f"✅ Куплено: {rune['emoji']} {rune['name']}", show_alert=True)
         await cb_show_runes_shop(update, context)
@@ -2517,7 +6603,7 @@ async def cb_show_locations(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
     if not player:
         await query.answer("Сначала создай персонажа.", show_alert=True)
         return
@@ -2544,6 +6630,7 @@ async def cb_show_locations(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ]
             )
 
+    keyboard.append([InlineKeyboardButton("🧭 Экспедиция", callback_data="expedition")])
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")])
     
     text = "\n".join(lines)
@@ -2564,7 +6651,8 @@ async def cb_select_location(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer("Локация не найдена.", show_alert=True)
         return
 
-    player = get_player(chat.id, user.id)
+    snap = await get_snapshot(update, context).load("player")
+    player = snap.player
     if not player:
         await query.answer("Персонаж не найден.", show_alert=True)
         return
@@ -2576,7 +6664,7 @@ async def cb_select_location(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    battle = start_battle(chat.id, user.id, loc_id)
+    battle = await db_write(start_battle, chat.id, user.id, loc_id, snap=snap)
     if not battle:
         await query.answer("Не удалось начать бой.", show_alert=True)
         return
@@ -2597,6 +6685,7 @@ async def show_hunt_battle(update: Update, context: ContextTypes.DEFAULT_TYPE, l
     )
     keyboard = [
         [InlineKeyboardButton("⚔️ Атаковать", callback_data="attack")],
+        [InlineKeyboardButton("⏩ До конца", callback_data="auto_battle")],
         [InlineKeyboardButton("🧪 Зелье", callback_data="use_potion")],
         [InlineKeyboardButton("🏃 Сбежать", callback_data="escape")],
     ]
@@ -2609,19 +6698,19 @@ async def cb_attack(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    snap = await get_snapshot(update, context).load("player", "battle")
+    player = snap.player
     if not player:
         await query.answer("Персонаж не найден.", show_alert=True)
         return
 
-    battle = get_active_battle(chat.id, user.id)
-    if not battle:
+    if not snap.battle:
         await query.answer("Нет активного боя.", show_alert=True)
         return
 
-    result = perform_attack(chat.id, user.id, player["username"])
-    if not result.get("success"):
-        await query.answer(result.get("message", "Ошибка."), show_alert=True)
+    result = await db_write(perform_attack, chat.id, user.id, player["username"], snap=snap)
+    if not result or not result.get("success"):
+        await query.answer((result or {}).get("message", "Ошибка."), show_alert=True)
         return
 
     lines = []
@@ -2650,7 +6739,10 @@ async def cb_attack(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lines.append("")
         lines.append("Хочешь ещё? 🤺")
         
-        keyboard.append([InlineKeyboardButton("🔄 Снова охотиться", callback_data="locations")])
+        if result["is_dungeon"]:
+            keyboard.append([InlineKeyboardButton("⬇️ Следующий этаж", callback_data="dungeon_continue")])
+        else:
+            keyboard.append([InlineKeyboardButton("🔄 Снова охотиться", callback_data="locations")])
         keyboard.append([InlineKeyboardButton("📊 В главное меню", callback_data="main_menu")])
         
     elif result["defeat"]:
@@ -2665,6 +6757,7 @@ async def cb_attack(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         lines.append("")
         keyboard.append([InlineKeyboardButton("⚔️ Атаковать", callback_data="attack")])
+        keyboard.append([InlineKeyboardButton("⏩ До конца", callback_data="auto_battle")])
         keyboard.append([InlineKeyboardButton("🧪 Зелье", callback_data="use_potion")])
         keyboard.append([InlineKeyboardButton("🏃 Сбежать", callback_data="escape")])
 
@@ -2672,74 +6765,106 @@ async def cb_attack(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-async def cb_use_potion(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Использование зелья"""
+async def cb_auto_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Бой до конца: весь обмен ударами на сервере, одно редактирование сообщения"""
     query = update.callback_query
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
-    battle = get_active_battle(chat.id, user.id)
-    if not player or not battle:
+    snap = await get_snapshot(update, context).load("player", "battle")
+    player = snap.player
+    if not player:
+        await query.answer("Персонаж не найден.", show_alert=True)
+        return
+
+    if not snap.battle:
         await query.answer("Нет активного боя.", show_alert=True)
         return
 
-    if get_item_quantity(chat.id, user.id, "health_potion") <= 0:
-        await query.answer("❌ Нет зелий лечения.", show_alert=True)
+    result = await db_write(auto_battle, chat.id, user.id, player["username"], snap=snap)
+    if not result or not result.get("success"):
+        await query.answer((result or {}).get("message", "Ошибка."), show_alert=True)
         return
 
-    remove_item(chat.id, user.id, "health_potion", 1)
-    heal_amount = int(player["max_health"] * 0.5)
-    new_hp = min(player["max_health"], player["health"] + heal_amount)
+    rounds = result["rounds"]
+    lines = [f"⏩ БОЙ ДО КОНЦА — раундов: {len(rounds)}", ""]
+
+    shown = list(enumerate(rounds, 1))
+    if len(shown) > AUTO_BATTLE_LOG_ROUNDS:
+        half = AUTO_BATTLE_LOG_ROUNDS // 2
+        skipped = len(shown) - 2 * half
+        shown = shown[:half] + [(None, skipped)] + shown[-half:]
+    for number, entry in shown:
+        if number is None:
+            lines.append(f"   … ещё {entry} раундов …")
+            continue
+        damage, is_crit, enemy_damage = entry
+        line = f"{number}. {'💥' if is_crit else '⚔️'} {damage}"
+        if enemy_damage:
+            line += f" | 🩸 -{enemy_damage}"
+        lines.append(line)
+
+    lines.append("")
+    lines.append(f"Ты: ❤️ {result['player_hp']}/{result['player_max_hp']}")
+    total_damage = sum(damage for damage, _, _ in rounds)
+    total_taken = sum(enemy_damage for _, _, enemy_damage in rounds)
+    lines.append(f"Нанесено: {total_damage} | Получено: {total_taken}")
+
+    keyboard: List[List[InlineKeyboardButton]] = []
+    if result["victory"]:
+        lines.append("")
+        lines.append("🏆 ПОБЕДА!")
+        lines.append(f"+ {result['xp_gained']} XP | + {result['gold_gained']} 💰")
+        if result["level_up"] > 0:
+            lines.append(f"⬆️ +{result['level_up']} УРОВНЕЙ!")
+        if result["loot"]:
+            loot = MATERIALS.get(result["loot"], {"name": result["loot"]})
+            lines.append(f"🎁 Добыча: {loot.get('name')}")
+    else:
+        lines.append("")
+        lines.append("💀 ПОРАЖЕНИЕ")
+        lines.append(f"Потеряно золота: -{result['gold_lost']} 💰")
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE players SET health = ? WHERE user_id = ? AND chat_id = ?",
-        (new_hp, user.id, chat.id),
-    )
-    conn.commit()
-    conn.close()
+    if result["is_dungeon"] and result["victory"]:
+        keyboard.append([InlineKeyboardButton("⬇️ Следующий этаж", callback_data="dungeon_continue")])
+    else:
+        keyboard.append([InlineKeyboardButton("🔄 Снова охотиться", callback_data="locations")])
+    keyboard.append([InlineKeyboardButton("📊 В главное меню", callback_data="main_menu")])
 
-    enemy_damage, _ = calculate_damage(battle["enemy_damage"], player["defense"], 5)
-    new_player_hp = new_hp - enemy_damage
+    text = "\n".join(lines)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_use_potion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Использование зелья"""
+    query = update.callback_query
+    user = query.from_user
+    chat = query.message.chat
+
+    snap = get_snapshot(update, context)
+    result = await db_write(use_battle_potion, chat.id, user.id, snap=snap)
+    if not result or not result.get("success"):
+        message = result.get("message", "Ошибка.") if result else "Ошибка."
+        await query.answer(message, show_alert=True)
+        return
 
     lines = [
         "🧪 Ты пьёшь зелье!",
-        f"✨ + {heal_amount} HP (теперь {new_hp}/{player['max_health']})",
-        f"🎯 Враг атакует: -{enemy_damage}",
+        f"✨ + {result['heal_amount']} HP (теперь {result['healed_hp']}/{result['player_max_hp']})",
+        f"🎯 Враг атакует: -{result['enemy_damage']}",
     ]
 
     keyboard: List[List[InlineKeyboardButton]] = []
 
-    if new_player_hp <= 0:
-        end_battle(chat.id, user.id)
-        gold_lost = int(player["gold"] * 0.1)
-        if gold_lost > 0:
-            subtract_gold(chat.id, user.id, gold_lost)
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
-            "UPDATE players SET health = max_health, total_battles_lost = total_battles_lost + 1 WHERE user_id = ? AND chat_id = ?",
-            (user.id, chat.id),
-        )
-        conn.commit()
-        conn.close()
-        lines.append(f"\n💀 ПОРАЖЕНИЕ: -{gold_lost} 💰")
+    if result["defeat"]:
+        lines.append(f"\n💀 ПОРАЖЕНИЕ: -{result['gold_lost']} 💰")
         keyboard.append([InlineKeyboardButton("🔄 Попробовать ещё", callback_data="locations")])
         keyboard.append([InlineKeyboardButton("📊 Меню", callback_data="main_menu")])
     else:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
-            "UPDATE players SET health = ? WHERE user_id = ? AND chat_id = ?",
-            (new_player_hp, user.id, chat.id),
-        )
-        conn.commit()
-        conn.close()
-        lines.append(f"❤️ Твой HP: {new_player_hp}/{player['max_health']}")
+        lines.append(f"❤️ Твой HP: {result['player_hp']}/{result['player_max_hp']}")
         lines.append("")
         keyboard.append([InlineKeyboardButton("⚔️ Атаковать", callback_data="attack")])
+        keyboard.append([InlineKeyboardButton("⏩ До конца", callback_data="auto_battle")])
         keyboard.append([InlineKeyboardButton("🧪 Зелье", callback_data="use_potion")])
         keyboard.append([InlineKeyboardButton("🏃 Сбежать", callback_data="escape")])
 
@@ -2753,53 +6878,29 @@ async def cb_escape(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
-    battle = get_active_battle(chat.id, user.id)
-    if not player or not battle:
+    snap = get_snapshot(update, context)
+    result = await db_write(attempt_escape, chat.id, user.id, snap=snap)
+    if not result or not result.get("success"):
         await query.answer("Нет активного боя.", show_alert=True)
         return
 
-    if random.randint(1, 100) <= 50:
-        end_battle(chat.id, user.id)
+    if result["escaped"]:
         text = "🏃 Ты успешно сбежал!"
         keyboard = [[InlineKeyboardButton("⬅️ В охоту", callback_data="locations")]]
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
-    enemy_damage, _ = calculate_damage(battle["enemy_damage"], player["defense"], 5)
-    new_player_hp = player["health"] - enemy_damage
-
     lines = [
         "❌ Не удалось сбежать!",
-        f"Враг ударил: -{enemy_damage} HP",
+        f"Враг ударил: -{result['enemy_damage']} HP",
     ]
     keyboard: List[List[InlineKeyboardButton]] = []
 
-    if new_player_hp <= 0:
-        end_battle(chat.id, user.id)
-        gold_lost = int(player["gold"] * 0.1)
-        if gold_lost > 0:
-            subtract_gold(chat.id, user.id, gold_lost)
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
-            "UPDATE players SET health = max_health, total_battles_lost = total_battles_lost + 1 WHERE user_id = ? AND chat_id = ?",
-            (user.id, chat.id),
-        )
-        conn.commit()
-        conn.close()
-        lines.append(f"\n💀 ПОРАЖЕНИЕ: -{gold_lost} 💰")
+    if result["defeat"]:
+        lines.append(f"\n💀 ПОРАЖЕНИЕ: -{result['gold_lost']} 💰")
         keyboard.append([InlineKeyboardButton("🔄 Ещё раз", callback_data="locations")])
     else:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
-            "UPDATE players SET health = ? WHERE user_id = ? AND chat_id = ?",
-            (new_player_hp, user.id, chat.id),
-        )
-        conn.commit()
-        conn.close()
-        lines.append(f"❤️ Твой HP: {new_player_hp}/{player['max_health']}")
+        lines.append(f"❤️ Твой HP: {result['player_hp']}/{result['player_max_hp']}")
         lines.append("")
         keyboard.append([InlineKeyboardButton("⚔️ Атаковать", callback_data="attack")])
         keyboard.append([InlineKeyboardButton("🏃 Ещё попытка", callback_data="escape")])
@@ -2816,19 +6917,13 @@ async def cb_dungeon_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    snap = await get_snapshot(update, context).load("player", "dungeon")
+    player = snap.player
     if not player:
         await query.answer("Сначала создай персонажа.", show_alert=True)
         return
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT current_floor, is_active FROM dungeon_progress WHERE user_id = ? AND chat_id = ?",
-        (user.id, chat.id),
-    )
-    row = c.fetchone()
-    conn.close()
+    row = snap.dungeon
 
     floor = row["current_floor"] if row else 1
     is_active = bool(row["is_active"]) if row else False
@@ -2860,20 +6955,29 @@ async def cb_dungeon_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    result = start_dungeon(chat.id, user.id)
+    snap = get_snapshot(update, context)
+    result = await db_write(start_dungeon, chat.id, user.id, snap=snap)
     if not result:
         await query.answer("Уже в подземелье или ошибка.", show_alert=True)
         return
 
-    player = get_player(chat.id, user.id)
+    await show_dungeon_floor(update, result, snap.player)
+
+
+async def show_dungeon_floor(update: Update, result: Dict[str, Any], player: Dict[str, Any]):
+    """Боевой интерфейс этажа подземелья"""
+    query = update.callback_query
+    boss = "👑 БОСС!\n" if result["is_boss"] else ""
     text = (
-        f"🏰 ПОДЗЕМЕЛЬЕ — ЭТАЖ {result['floor']}\n\n"
+        f"🏰 ПОДЗЕМЕЛЬЕ — ЭТАЖ {result['floor']}/{result['floors']}\n\n"
+        f"{boss}"
         f"Враг: {result['enemy_emoji']} {result['enemy_name']}\n"
         f"❤️ {result['enemy_health']}/{result['enemy_max_health']}\n\n"
         f"Твой HP: {player['health']}/{player['max_health']}"
     )
     keyboard = [
         [InlineKeyboardButton("⚔️ Атаковать", callback_data="attack")],
+        [InlineKeyboardButton("⏩ До конца", callback_data="auto_battle")],
         [InlineKeyboardButton("🧪 Зелье", callback_data="use_potion")],
         [InlineKeyboardButton("🏃 Сбежать", callback_data="escape")],
     ]
@@ -2881,33 +6985,248 @@ async def cb_dungeon_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cb_dungeon_continue(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Продолжение подземелья"""
+    """Продолжение подземелья: текущий бой или следующий этаж из плана забега"""
     query = update.callback_query
     user = query.from_user
     chat = query.message.chat
 
-    battle = get_active_battle(chat.id, user.id)
-    if not battle or not battle["is_dungeon"]:
-        await query.answer("Нет активного боя в подземелье.", show_alert=True)
+    snap = await get_snapshot(update, context).load("battle", "player", "dungeon")
+    battle = snap.battle
+    if not battle:
+        result = await db_write(continue_dungeon, chat.id, user.id, snap=snap)
+        if not result:
+            # Забег пройден или закончился поражением — обратно в меню подземелья
+            await cb_dungeon_menu(update, context)
+            return
+        await show_dungeon_floor(update, result, snap.player)
+        return
+
+    if not battle["is_dungeon"]:
+        await query.answer("Сначала закончи текущий бой.", show_alert=True)
         return
 
-    player = get_player(chat.id, user.id)
+    player = snap.player
     enemy = ENEMIES.get(battle["enemy_id"], {"name": "Враг", "emoji": "❓"})
     
     text = (
         f"🏰 ПОДЗЕМЕЛЬЕ ПРОДОЛЖЕНИЕ\n\n"
         f"Враг: {enemy['emoji']} {enemy['name']}\n"
         f"❤️ {battle['enemy_health']}/{battle['enemy_max_health']}\n\n"
-        f"Ты: ❤️ {battle['player_health']}/{battle['player_max_health']}"
+        f"Ты: ❤️ {player['health']}/{player['max_health']}"
     )
     keyboard = [
         [InlineKeyboardButton("⚔️ Атаковать", callback_data="attack")],
+        [InlineKeyboardButton("⏩ До конца", callback_data="auto_battle")],
         [InlineKeyboardButton("🧪 Зелье", callback_data="use_potion")],
         [InlineKeyboardButton("🏃 Сбежать", callback_data="escape")],
     ]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+# ===================== ЭКСПЕДИЦИИ =====================
+
+EXPEDITION_HUNT_CHOICES = (5, 10, 25)
+
+
+def expedition_locations(player: Dict[str, Any]) -> List[str]:
+    return [
+        loc_id for loc_id, loc in LOCATIONS.items()
+        if loc["min_level"] <= player["level"] <= loc["max_level"] + 10
+    ]
+
+
+def schedule_expedition(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    user_id: int,
+    username: str,
+    player: Dict[str, Any],
+    location_id: str,
+    hunts: int,
+) -> Optional[str]:
+    """Ставит экспедицию в JobQueue; возвращает текст ошибки или None"""
+    if location_id not in expedition_locations(player):
+        return "❌ Эта локация тебе не подходит по уровню."
+    if not 1 <= hunts <= EXPEDITION_MAX_HUNTS:
+        return f"❌ Охот в экспедиции: от 1 до {EXPEDITION_MAX_HUNTS}."
+    if battle_store.get(chat_id, user_id):
+        return "❌ Сначала закончи текущий бой."
+    if context.job_queue is None:
+        logger.error("❌ JobQueue недоступна: установи python-telegram-bot[job-queue]")
+        return "❌ Экспедиции сейчас недоступны."
+    if not expeditions.try_start(user_id):
+        return "⏳ Твоя экспедиция уже в пути — дождись отчёта."
+
+    context.job_queue.run_once(
+        expedition_job,
+        when=hunts * EXPEDITION_SEC_PER_HUNT,
+        data={"username": username, "location_id": location_id, "hunts": hunts},
+        name=f"expedition:{user_id}",
+        chat_id=chat_id,
+        user_id=user_id,
+    )
+    logger.info(f"🧭 {username}: экспедиция {location_id} x{hunts}")
+    return None
+
+
+def expedition_report(summary: Dict[str, Any]) -> str:
+    loc = LOCATIONS[summary["location_id"]]
+    lines = [
+        f"🧭 ЭКСПЕДИЦИЯ: {loc['emoji']} {loc['name']}\n",
+        f"Охот: {summary['hunts']}/{summary['planned']} (раундов: {summary['rounds']})",
+        f"⚔️ Побед: {summary['won']}" + (f" (👑 боссов: {summary['bosses']})" if summary["bosses"] else ""),
+        f"⭐ +{summary['xp_gained']} XP",
+        f"💰 +{summary['gold_gained']} золота",
+    ]
+    if summary["loot"]:
+        lines.append("🎁 Добыча:")
+        for item_id, quantity in summary["loot"].items():
+            lines.append(f"  • {MATERIALS.get(item_id, {'name': item_id})['name']} x{quantity}")
+    if summary["level_up"]:
+        lines.append(f"\n⬆️ Новый уровень! (+{summary['level_up']})")
+    if summary["defeat"]:
+        lines.append(f"\n💀 Экспедиция прервана поражением. Потеряно {summary['gold_lost']} золота.")
+    return "\n".join(lines)
+
+
+async def expedition_job(context: ContextTypes.DEFAULT_TYPE):
+    """Разрешает экспедицию целиком и шлёт игроку один отчёт"""
+    job = context.job
+    data = job.data
+    summary = None
+    try:
+        summary = await db_write(
+            run_expedition, job.chat_id, job.user_id, data["username"], data["location_id"], data["hunts"]
+        )
+        if not summary:
+            text = "❌ Экспедиция сорвалась, попробуй ещё раз."
+        elif not summary["success"]:
+            text = f"❌ {summary['message']}"
+        else:
+            text = expedition_report(summary)
+        keyboard = [
+            [InlineKeyboardButton("🧭 Снова в экспедицию", callback_data="expedition")],
+            [InlineKeyboardButton("📊 Меню", callback_data="main_menu")],
+        ]
+        notifier.send(job.chat_id, text, InlineKeyboardMarkup(keyboard))
+    finally:
+        expeditions.finish(job.user_id, summary["hunts"] if summary and summary.get("success") else 0)
+
+
+async def cmd_expedition(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/expedition [локация] [охот] — без аргументов показывает меню"""
+    user = update.effective_user
+    chat = update.effective_chat
+
+    player = await db_call(get_player, chat.id, user.id)
+    if not player:
+        await update.message.reply_text("Сначала создай персонажа: /start")
+        return
+
+    if not context.args:
+        text, keyboard = expedition_menu(player)
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    loc_id = context.args[0]
+    try:
+        hunts = int(context.args[1]) if len(context.args) > 1 else EXPEDITION_HUNT_CHOICES[0]
+    except ValueError:
+        await update.message.reply_text("Использование: /expedition <локация> <кол-во охот>")
+        return
+    if loc_id not in LOCATIONS:
+        await update.message.reply_text("❌ Локация не найдена: " + ", ".join(expedition_locations(player)))
+        return
+
+    error = schedule_expedition(context, chat.id, user.id, user.username or user.first_name, player, loc_id, hunts)
+    if error:
+        await update.message.reply_text(error)
+        return
+    loc = LOCATIONS[loc_id]
+    await update.message.reply_text(
+        f"🧭 Экспедиция в {loc['emoji']} {loc['name']} ({hunts} охот) отправлена. Отчёт придёт сюда."
+    )
+
+
+def expedition_menu(player: Dict[str, Any]) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    text = (
+        "🧭 ЭКСПЕДИЦИЯ\n\n"
+        "Отправь героя на серию охот — бои пройдут без тебя, "
+        "а награда придёт одним отчётом. Первое поражение завершает экспедицию.\n\n"
+        f"В пути: {expeditions.active(player['user_id'])}/{EXPEDITION_MAX_ACTIVE}"
+    )
+    keyboard = [
+        [InlineKeyboardButton(f"{LOCATIONS[loc_id]['emoji']} {LOCATIONS[loc_id]['name']}", callback_data=f"exp_loc_{loc_id}")]
+        for loc_id in expedition_locations(player)
+    ]
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="locations")])
+    return text + "\n\n" + build_player_card(player), keyboard
+
+
+async def cb_expedition_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор локации для экспедиции"""
+    query = update.callback_query
+
+    snap = await get_snapshot(update, context).load("player")
+    if not snap.player:
+        await query.answer("Сначала создай персонажа.", show_alert=True)
+        return
+
+    text, keyboard = expedition_menu(snap.player)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_expedition_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор числа охот"""
+    query = update.callback_query
+
+    loc_id = query.data.replace("exp_loc_", "")
+    loc = LOCATIONS.get(loc_id)
+    if not loc:
+        await query.answer("Локация не найдена.", show_alert=True)
+        return
+
+    text = (
+        f"🧭 ЭКСПЕДИЦИЯ: {loc['emoji']} {loc['name']}\n\n"
+        f"Сколько охот? (~{EXPEDITION_SEC_PER_HUNT:g} с на охоту)"
+    )
+    keyboard = [
+        [
+            InlineKeyboardButton(f"⚔️ x{hunts}", callback_data=f"exp_go_{loc_id}_{hunts}")
+            for hunts in EXPEDITION_HUNT_CHOICES
+            if hunts <= EXPEDITION_MAX_HUNTS
+        ],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="expedition")],
+    ]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_expedition_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отправка экспедиции"""
+    query = update.callback_query
+    user = query.from_user
+    chat = query.message.chat
+
+    loc_id, hunts = query.data.replace("exp_go_", "").rsplit("_", 1)
+    snap = await get_snapshot(update, context).load("player")
+    if not snap.player:
+        await query.answer("Сначала создай персонажа.", show_alert=True)
+        return
+
+    error = schedule_expedition(context, chat.id, user.id, user.username or user.first_name, snap.player, loc_id, int(hunts))
+    if error:
+        await query.answer(error, show_alert=True)
+        return
+
+    loc = LOCATIONS[loc_id]
+    text = (
+        f"🧭 Экспедиция в {loc['emoji']} {loc['name']} отправлена!\n\n"
+        f"Охот: {hunts}. Отчёт придёт отдельным сообщением."
+    )
+    keyboard = [[InlineKeyboardButton("📊 Меню", callback_data="main_menu")]]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
 # ===================== ПВП - УПРОЩЕННОЕ =====================
 
 async def cb_pvp_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2916,17 +7235,18 @@ async def cb_pvp_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     chat = query.message.chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
     if not player:
         await query.answer("Сначала создай персонажа.", show_alert=True)
         return
 
     # Проверяем есть ли уже противник ожидающий
-    opponent = find_pvp_opponent(chat.id, user.id)
+    opponent = await db_call(find_pvp_opponent, chat.id, user.id)
     
     text = (
         f"🤺 ПВП АРЕНА\n\n"
         f"Уровень: {player['level']}\n"
+        f"Рейтинг: {pvp_rating(player)} MMR{'' if player.get('mmr') is not None else ' (калибровка)'}\n"
         f"ПВП Рекорд: {player['pvp_wins']}W-{player['pvp_losses']}L\n\n"
     )
     
@@ -2934,30 +7254,61 @@ async def cb_pvp_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text += (
             f"⚔️ НАЙДЕН ПРОТИВНИК!\n\n"
             f"{CLASSES[opponent['class']]['emoji']} {opponent['username']}\n"
-            f"Уровень: {opponent['level']}\n\n"
+            f"Уровень: {opponent['level']}, рейтинг: {pvp_rating(opponent)} MMR\n\n"
             f"Начинаем сражение?"
         )
         keyboard = [
             [InlineKeyboardButton("⚔️ В БОЙ!", callback_data=f"pvp_fight_{opponent['user_id']}")],
             [InlineKeyboardButton("❌ Отклонить", callback_data="pvp_cancel_search")],
+            [InlineKeyboardButton("🏆 Турнир", callback_data="tournament")],
         ]
+        if pvp_matchmaker.first_sighting(opponent["user_id"], user.id):
+            notifier.send(
+                opponent["chat_id"],
+                f"⚔️ {opponent['username']}, на арене тебя нашёл соперник!\n\n"
+                f"{CLASSES[player['class']]['emoji']} {player['username']} (ур. {player['level']})\n"
+                "Результат боя придёт сюда.",
+            )
     else:
-        add_pvp_queue(chat.id, user.id)
-        confirm_pvp_search(chat.id, user.id)
+        await db_write(add_pvp_queue, chat.id, user.id, pvp_rating(player))
         
         text += (
             "🔍 Поиск противника...\n\n"
-            "Может занять несколько секунд."
+            "Как только соперник найдётся, я пришлю сообщение."
         )
         keyboard = [
-            [InlineKeyboardButton("🔄 Проверить", callback_data="pvp_menu")],
             [InlineKeyboardButton("❌ Отмена", callback_data="pvp_cancel_search")],
+            [InlineKeyboardButton("🏆 Турнир", callback_data="tournament")],
+            [InlineKeyboardButton("📊 Меню", callback_data="main_menu")],
         ]
 
     text += "\n\n" + build_player_card(player)
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+def pvp_defender_report(result: Dict[str, Any]) -> str:
+    """Итог боя глазами защитника: он в бою не участвовал и узнаёт о нём из уведомления"""
+    if result["winner_id"] == result["defender_id"]:
+        head = (
+            f"🏆 ПОБЕДА НА АРЕНЕ!\n\n"
+            f"{result['loser_name']} напал на тебя и проиграл.\n"
+            f"Награда: +{result['reward_gold']} 💰"
+        )
+    else:
+        head = (
+            f"💀 ПОРАЖЕНИЕ НА АРЕНЕ\n\n"
+            f"{result['winner_name']} напал на тебя и победил.\n"
+            f"Потеря: -{result['reward_gold']} 💰"
+        )
+    return (
+        f"{head}\n"
+        f"Рейтинг: {result['defender_mmr']} MMR ({result['defender_mmr_delta']:+d})\n\n"
+        f"Боевая статистика:\n"
+        f"Твой урон: {result['defender_damage']} {'💥' if result['defender_crit'] else ''}\n"
+        f"Его урон: {result['attacker_damage']} {'💥' if result['attacker_crit'] else ''}"
+    )
+
+
 async def cb_pvp_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ПВП БОЙ"""
     query = update.callback_query
@@ -2966,13 +7317,13 @@ async def cb_pvp_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     opponent_id = int(query.data.replace("pvp_fight_", ""))
     
-    result = pvp_battle(chat.id, user.id, opponent_id, user.username or user.first_name)
+    result = await db_write(pvp_battle, chat.id, user.id, opponent_id, user.username or user.first_name)
     
-    if not result.get("success"):
-        await query.answer(result.get("message", "Ошибка боя."), show_alert=True)
+    if not result or not result.get("success"):
+        await query.answer((result or {}).get("message", "Ошибка боя."), show_alert=True)
         return
 
-    attacker = get_player(chat.id, user.id)
+    attacker = await db_call(get_player, chat.id, user.id)
     
     winner_name = result["winner_name"]
     loser_name = result["loser_name"]
@@ -2982,7 +7333,8 @@ async def cb_pvp_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = (
             f"🏆 ТЫ ПОБЕДИЛ!\n\n"
             f"Противник: {loser_name}\n"
-            f"Награда: +{reward} 💰\n\n"
+            f"Награда: +{reward} 💰\n"
+            f"Рейтинг: {result['attacker_mmr']} MMR ({result['attacker_mmr_delta']:+d})\n\n"
             f"Боевая статистика:\n"
             f"Твой урон: {result['attacker_damage']} {'💥' if result['attacker_crit'] else ''}\n"
             f"Его урон: {result['defender_damage']} {'💥' if result['defender_crit'] else ''}"
@@ -2991,7 +7343,8 @@ async def cb_pvp_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = (
             f"💀 ТЫ ПРОИГРАЛ\n\n"
             f"Победитель: {winner_name}\n"
-            f"Потеря: -{reward} 💰\n\n"
+            f"Потеря: -{reward} 💰\n"
+            f"Рейтинг: {result['attacker_mmr']} MMR ({result['attacker_mmr_delta']:+d})\n\n"
             f"Боевая статистика:\n"
             f"Его урон: {result['defender_damage']} {'💥' if result['defender_crit'] else ''}\n"
             f"Твой урон: {result['attacker_damage']} {'💥' if result['attacker_crit'] else ''}"
@@ -3004,6 +7357,8 @@ async def cb_pvp_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📊 Меню", callback_data="main_menu")],
     ]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    notifier.send(result["defender_chat_id"], pvp_defender_report(result), InlineKeyboardMarkup(keyboard))
+
 
 
 async def cb_pvp_cancel_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3012,9 +7367,9 @@ async def cb_pvp_cancel_search(update: Update, context: ContextTypes.DEFAULT_TYP
     user = query.from_user
     chat = query.message.chat
 
-    cancel_pvp_search(chat.id, user.id)
+    await db_write(cancel_pvp_search, chat.id, user.id)
     
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
     text = "❌ Поиск отменён.\n\n" + build_player_card(player)
     keyboard = [
         [InlineKeyboardButton("📊 Главное меню", callback_data="main_menu")],
@@ -3022,6 +7377,146 @@ async def cb_pvp_cancel_search(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+# ===================== ТУРНИРЫ =====================
+
+def tournament_menu(chat_id: int, user_id: int) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    lobby = tournaments.lobby(chat_id)
+    if lobby is None:
+        text = (
+            "🏆 ТУРНИР\n\n"
+            "Запись не открыта. Выбери формат — ты станешь организатором, "
+            "остальные запишутся кнопкой. Бои идут по статам на момент старта, "
+            "итоги раундов приходят в чат.\n\n"
+            f"Призовой фонд: {TOURNAMENT_PRIZE_PER_ENTRANT} 💰 за участника, "
+            "делится между тремя лучшими."
+        )
+        keyboard = [
+            [InlineKeyboardButton(title, callback_data=f"tour_open_{fmt}")]
+            for fmt, title in TOURNAMENT_FORMATS.items()
+        ]
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="pvp_menu")])
+        return text, keyboard
+
+    entrants = list(lobby["entrants"].values())
+    text = (
+        f"🏆 ТУРНИР — {TOURNAMENT_FORMATS[lobby['format']]}\n\n"
+        f"Участников: {len(entrants)}/{TOURNAMENT_MAX_ENTRANTS} "
+        f"(минимум {TOURNAMENT_MIN_ENTRANTS})\n"
+        + ", ".join(entrants[:30])
+        + (f" и ещё {len(entrants) - 30}" if len(entrants) > 30 else "")
+    )
+    if lobby["running"]:
+        text += "\n\n⏳ Турнир идёт — итоги раундов приходят в чат."
+        return text, [[InlineKeyboardButton("⬅️ Назад", callback_data="pvp_menu")]]
+
+    keyboard = [[
+        InlineKeyboardButton("🚪 Выйти", callback_data="tour_leave")
+        if user_id in lobby["entrants"]
+        else InlineKeyboardButton("✍️ Записаться", callback_data="tour_join")
+    ]]
+    if user_id == lobby["organizer_id"]:
+        keyboard.append([
+            InlineKeyboardButton("▶️ Начать", callback_data="tour_start"),
+            InlineKeyboardButton("❌ Отменить", callback_data="tour_cancel"),
+        ])
+    keyboard.append([
+        InlineKeyboardButton("🔄 Обновить", callback_data="tournament"),
+        InlineKeyboardButton("⬅️ Назад", callback_data="pvp_menu"),
+    ])
+    return text, keyboard
+
+
+async def cmd_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/tournament — лобби турнира в этом чате"""
+    text, keyboard = tournament_menu(update.effective_chat.id, update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_tournament_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Лобби турнира"""
+    query = update.callback_query
+    text, keyboard = tournament_menu(query.message.chat.id, query.from_user.id)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_tournament_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Открытие записи на турнир"""
+    query = update.callback_query
+    user = query.from_user
+    chat = query.message.chat
+
+    snap = await get_snapshot(update, context).load("player")
+    if not snap.player:
+        await query.answer("Сначала создай персонажа.", show_alert=True)
+        return
+
+    error = tournaments.open(chat.id, user.id, snap.player["username"], query.data.replace("tour_open_", ""))
+    if error:
+        await query.answer(error, show_alert=True)
+    text, keyboard = tournament_menu(chat.id, user.id)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_tournament_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запись на турнир"""
+    query = update.callback_query
+    user = query.from_user
+    chat = query.message.chat
+
+    snap = await get_snapshot(update, context).load("player")
+    if not snap.player:
+        await query.answer("Сначала создай персонажа.", show_alert=True)
+        return
+
+    error = tournaments.join(chat.id, user.id, snap.player["username"])
+    if error:
+        await query.answer(error, show_alert=True)
+        return
+    text, keyboard = tournament_menu(chat.id, user.id)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_tournament_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выход из списка участников"""
+    query = update.callback_query
+    chat = query.message.chat
+
+    error = tournaments.leave(chat.id, query.from_user.id)
+    if error:
+        await query.answer(error, show_alert=True)
+        return
+    text, keyboard = tournament_menu(chat.id, query.from_user.id)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_tournament_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмена турнира организатором"""
+    query = update.callback_query
+    chat = query.message.chat
+
+    error = tournaments.cancel(chat.id, query.from_user.id)
+    if error:
+        await query.answer(error, show_alert=True)
+        return
+    text, keyboard = tournament_menu(chat.id, query.from_user.id)
+    await query.edit_message_text("❌ Турнир отменён.\n\n" + text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def cb_tournament_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Старт турнира: раунды идут фоновой задачей, обработчик сразу отвечает"""
+    query = update.callback_query
+    chat = query.message.chat
+
+    error = tournaments.begin(chat.id, query.from_user.id)
+    if error:
+        await query.answer(error, show_alert=True)
+        return
+
+    context.application.create_task(tournaments.run(chat.id), update=update)
+    text, keyboard = tournament_menu(chat.id, query.from_user.id)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
 # ===================== КРАФТИНГ =====================
 
 async def cb_crafting(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3031,7 +7526,7 @@ async def cb_crafting(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
 
-    player = get_player(chat.id, user.id)
+    player = await db_call(get_player, chat.id, user.id)
 
     text = f"⚒️ КРАФТИНГ (Золото: {player['gold']} 💰)\n\n"
     keyboard: List[List[InlineKeyboardButton]] = []
@@ -3073,7 +7568,7 @@ async def cb_craft(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Рецепт не найден.", show_alert=True)
         return
 
-    result = craft_item(chat.id, user.id, recipe_id)
+    result = await db_write(craft_item, chat.id, user.id, recipe_id)
 
     if result.get("success"):
         text = f"✨ Крафтено: {result['name']}"
@@ -3106,11 +7601,15 @@ async def cb_ratings_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     chat = query.message.chat
 
-    players = get_global_leaderboard(chat.id, 10)
+    players = await db_call(get_global_leaderboard, chat.id, 10)
     
     text = "⚔️ ТОП-10 ПО УРОВНЮ:\n\n"
     for i, p in enumerate(players, 1):
-        text += f"{i}. {p['username']} — Ур.{p['level']} 💰{p['gold']}\n"
+        _, _, fraction = level_progress(p["level"], p["xp"])
+        text += (
+            f"{i}. {p['username']} — Ур.{p['level']} 💰{p['gold']}\n"
+            f"    {progress_bar(fraction, 8)} {total_xp(p['level'], p['xp'])} XP\n"
+        )
 
     keyboard = [
         [InlineKeyboardButton("⬅️ Назад", callback_data="ratings")],
@@ -3123,12 +7622,19 @@ async def cb_ratings_pvp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     chat = query.message.chat
 
-    players = get_pvp_leaderboard(chat.id, 10)
+    players = await db_call(get_pvp_leaderboard, chat.id, 10)
+    rank = await db_call(get_pvp_rank, chat.id, query.from_user.id)
     
     text = "🤺 ТОП-10 ПВП:\n\n"
     for i, p in enumerate(players, 1):
-        wr = p['winrate']
-        text += f"{i}. {p['username']} — {p['pvp_wins']}W-{p['pvp_losses']}L ({wr}%)\n"
+        games = p['pvp_wins'] + p['pvp_losses']
+        wr = round(100.0 * p['pvp_wins'] / games, 2) if games else 0
+        text += f"{i}. {p['username']} — {p['mmr']} MMR, {p['pvp_wins']}W-{p['pvp_losses']}L ({wr}%)\n"
+
+    if rank:
+        text += f"\nТвоё место: #{rank['place']} ({rank['mmr']} MMR)"
+    else:
+        text += "\nТы ещё не сыграл ни одного боя на арене."
 
     keyboard = [
         [InlineKeyboardButton("⬅️ Назад", callback_data="ratings")],
@@ -3141,7 +7647,7 @@ async def cb_ratings_dungeon(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     chat = query.message.chat
 
-    players = get_dungeon_leaderboard(chat.id, 10)
+    players = await db_call(get_dungeon_leaderboard, chat.id, 10)
     
     text = "🏰 ТОП-10 ПОДЗЕМЕЛЬЯ:\n\n"
     for i, p in enumerate(players, 1):
@@ -3153,13 +7659,87 @@ async def cb_ratings_dungeon(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+# ===================== МЕТРИКИ (HTTP) =====================
+
+metrics_api = FastAPI(title="RuneQuestRPG metrics")
+
+
+@metrics_api.get("/health")
+async def http_health():
+    return {"status": "ok"}
+
+
+@metrics_api.get("/metrics", response_class=PlainTextResponse)
+async def http_metrics():
+    return db_metrics.prometheus()
+
+
+@metrics_api.get("/stats")
+async def http_stats():
+    return {
+        "db": db_metrics.stats(),
+        "db_executor": db_executor.stats(),
+        "db_writer": db_writer.stats(),
+        "player_cache": player_cache.stats(),
+        "battles": battle_store.stats(),
+        "expeditions": expeditions.stats(),
+        "stale_rows": stale_rows.stats(),
+        "combat_log": combat_log.stats(),
+        "pvp_matchmaking": pvp_matchmaker.stats(),
+        "notifier": notifier.stats(),
+        "tournaments": tournaments.stats(),
+        "stat_profiles": stat_profiles.stats(),
+        "round_trips": round_trip_stats.stats(),
+    }
+
+
+def start_metrics_server(port: int = METRICS_PORT) -> uvicorn.Server:
+    """Поднимает HTTP-сервер метрик в отдельном потоке, не трогая event loop бота"""
+    server = uvicorn.Server(uvicorn.Config(metrics_api, host="0.0.0.0", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="metrics-http", daemon=True).start()
+    logger.info(f"📊 Метрики: http://0.0.0.0:{port}/metrics")
+    return server
+
+
 # ===================== ГЛАВНАЯ ФУНКЦИЯ БОТА =====================
 
-async def main():
-    init_database()
+async def on_startup(app: Application):
+    notifier.start(app.bot)
+
+
+async def on_shutdown(app: Application):
+    await notifier.stop()
+
 
-    app = Application.builder().token(BOT_TOKEN).build()
+async def main():
+    storage.init_schema()
+    player_cache.recover()
+    player_cache.start()
+    battle_store.rehydrate()
+    battle_store.start()
+    combat_log.start()
+    pvp_matchmaker.rehydrate()
+    if storage.name == "sqlite":
+        db_writer.start()
+    start_metrics_server()
+
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    if app.job_queue is not None:
+        app.job_queue.run_repeating(
+            sweep_stale_rows_job, interval=SWEEP_INTERVAL_SEC, first=SWEEP_INTERVAL_SEC, name="sweep_stale_rows"
+        )
+    else:
+        logger.warning("⚠️ JobQueue недоступна: уборка устаревших строк и экспедиции отключены")
 
+    app.add_handler(TypeHandler(Update, begin_update_snapshot), group=-1)
+    app.add_handler(TypeHandler(Update, track_round_trips), group=1)
     app.add_handler(CommandHandler("start", cmd_start))
 
     app.add_handler(CallbackQueryHandler(cb_select_class, pattern="^class_"))
@@ -3171,6 +7751,8 @@ async def main():
     app.add_handler(CallbackQueryHandler(cb_equip_weapon_handler, pattern="^equip_weapon_"))
     app.add_handler(CallbackQueryHandler(cb_select_armor_to_equip, pattern="^select_armor$"))
     app.add_handler(CallbackQueryHandler(cb_equip_armor_handler, pattern="^equip_armor_"))
+    app.add_handler(CallbackQueryHandler(cb_select_rune_to_equip, pattern="^select_rune$"))
+    app.add_handler(CallbackQueryHandler(cb_equip_rune_handler, pattern="^equip_rune_"))
 
     app.add_handler(CallbackQueryHandler(cb_show_shop, pattern="^shop$"))
     app.add_handler(CallbackQueryHandler(cb_show_weapons_shop, pattern="^shop_weapons$"))
@@ -3185,6 +7767,7 @@ async def main():
     app.add_handler(CallbackQueryHandler(cb_show_locations, pattern="^locations$"))
     app.add_handler(CallbackQueryHandler(cb_select_location, pattern="^loc_"))
     app.add_handler(CallbackQueryHandler(cb_attack, pattern="^attack$"))
+    app.add_handler(CallbackQueryHandler(cb_auto_battle, pattern="^auto_battle$"))
     app.add_handler(CallbackQueryHandler(cb_use_potion, pattern="^use_potion$"))
     app.add_handler(CallbackQueryHandler(cb_escape, pattern="^escape$"))
 
@@ -3192,10 +7775,23 @@ async def main():
     app.add_handler(CallbackQueryHandler(cb_dungeon_start, pattern="^dungeon_start$"))
     app.add_handler(CallbackQueryHandler(cb_dungeon_continue, pattern="^dungeon_continue$"))
 
+    app.add_handler(CommandHandler("expedition", cmd_expedition))
+    app.add_handler(CallbackQueryHandler(cb_expedition_menu, pattern="^expedition$"))
+    app.add_handler(CallbackQueryHandler(cb_expedition_location, pattern="^exp_loc_"))
+    app.add_handler(CallbackQueryHandler(cb_expedition_start, pattern="^exp_go_"))
+
     app.add_handler(CallbackQueryHandler(cb_pvp_menu, pattern="^pvp_menu$"))
     app.add_handler(CallbackQueryHandler(cb_pvp_fight, pattern="^pvp_fight_"))
     app.add_handler(CallbackQueryHandler(cb_pvp_cancel_search, pattern="^pvp_cancel_search$"))
 
+    app.add_handler(CommandHandler("tournament", cmd_tournament))
+    app.add_handler(CallbackQueryHandler(cb_tournament_menu, pattern="^tournament$"))
+    app.add_handler(CallbackQueryHandler(cb_tournament_open, pattern="^tour_open_"))
+    app.add_handler(CallbackQueryHandler(cb_tournament_join, pattern="^tour_join$"))
+    app.add_handler(CallbackQueryHandler(cb_tournament_leave, pattern="^tour_leave$"))
+    app.add_handler(CallbackQueryHandler(cb_tournament_cancel, pattern="^tour_cancel$"))
+    app.add_handler(CallbackQueryHandler(cb_tournament_start, pattern="^tour_start$"))
+
     app.add_handler(CallbackQueryHandler(cb_crafting, pattern="^crafting$"))
     app.add_handler(CallbackQueryHandler(cb_craft, pattern="^craft_"))
 
@@ -3211,10 +7807,16 @@ async def main():
 
 
 if __name__ == "__main__":
-    import asyncio
-    
     # На Render нужно использовать новый event loop
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("🛑 Бот остановлен")
+    finally:
+        db_executor.shutdown()
+        tournaments.close()
+        combat_log.close()
+        battle_store.close()
+        player_cache.close()
+        db_writer.close()
+        db_pool.close_all()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка планов запросов: каждый запрос бота должен идти по индексу.
+
+Скрипт наполняет временную БД, прогоняет основные функции бота, перехватывает
+все выполненные SQLite-запросы и для каждого делает EXPLAIN QUERY PLAN.
+Полный проход по таблице (SCAN) или временное B-дерево для сортировки
+(USE TEMP B-TREE) считаются регрессией — код возврата 1.
+
+Запуск:
+    python check_query_plans.py [-v]
+"""
+
+import os
+import sys
+import random
+import sqlite3
+import logging
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "plans")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="rq_plans_"), "plans.db")
+
+import bot  # noqa: E402
+
+PLAYERS = 5000
+CHATS = 5
+CHAT_ID = 1
+USER_ID = 1
+OPPONENT_ID = 2
+
+BAD_PLAN_MARKERS = ("SCAN ", "USE TEMP B-TREE")
+SKIP_PREFIXES = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "ANALYZE", "CREATE", "DROP", "EXPLAIN")
+
+statements: list = []
+
+
+def capture(statement: str):
+    statements.append(statement)
+
+
+def seed():
+    bot.migrate_database()
+    rng = random.Random(7)
+    players = []
+    for user_id in range(1, PLAYERS + 1):
+        players.append((
+            user_id,
+            CHAT_ID if user_id <= 2 else rng.randint(1, CHATS),
+            f"p{user_id}",
+            rng.choice(list(bot.CLASSES)),
+            rng.randint(1, 60),
+            100, 100, 50, 50, 10, 5,
+            rng.randint(0, 5000),
+            rng.randint(0, 40),
+            rng.randint(0, 300),
+            rng.randint(0, 20),
+            rng.randint(0, 20),
+        ))
+    with bot.db_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO players (
+                user_id, chat_id, username, class, level,
+                health, max_health, mana, max_mana, attack, defense,
+                gold, dungeon_rating, total_kills, pvp_wins, pvp_losses
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            players,
+        )
+        conn.execute("UPDATE players SET level = 10 WHERE user_id IN (?, ?)", (USER_ID, OPPONENT_ID))
+        conn.execute(
+            "UPDATE players SET mmr = 1000 + 25 * (pvp_wins - pvp_losses) WHERE pvp_wins + pvp_losses > 0"
+        )
+        conn.executemany(
+            "INSERT INTO inventory (user_id, chat_id, item_id, item_type, quantity) VALUES (?, ?, ?, ?, ?)",
+            [
+                (p[0], p[1], item_id, item_type, 1)
+                for p in players
+                for item_id, item_type in (
+                    ("copper_bar", "material"),
+                    ("iron_sword", "weapon"),
+                    ("leather_armor", "armor"),
+                )
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO pvp_queue (user_id, chat_id, is_waiting, confirmed) VALUES (?, ?, 1, ?)",
+            [(p[0], p[1], rng.randint(0, 1)) for p in players[2::7]],
+        )
+        conn.execute("ANALYZE")
+
+
+def exercise():
+    bot.player_cache.get(CHAT_ID, USER_ID)
+    bot.player_exists(CHAT_ID, USER_ID)
+    bot.get_inventory(CHAT_ID, USER_ID)
+    bot.add_item(CHAT_ID, USER_ID, "health_potion", 2)
+    bot.remove_item(CHAT_ID, USER_ID, "health_potion", 1)
+    bot.get_item_quantity(CHAT_ID, USER_ID, "health_potion")
+
+    bot.start_battle(CHAT_ID, USER_ID, "dark_forest")
+    bot.get_active_battle(CHAT_ID, USER_ID)
+    bot.perform_attack(CHAT_ID, USER_ID, "p1")
+    bot.battle_store.checkpoint()
+    bot.end_battle(CHAT_ID, USER_ID)
+    bot.battle_store.checkpoint()
+
+    bot.start_dungeon(CHAT_ID, USER_ID)
+    bot.get_dungeon_progress(CHAT_ID, USER_ID)
+    bot.end_dungeon_logic(CHAT_ID, USER_ID, True)
+    bot.end_battle(CHAT_ID, USER_ID)
+
+    bot.pvp_matchmaker.rehydrate()
+    bot.add_pvp_queue(CHAT_ID, OPPONENT_ID, 10)
+    bot.find_pvp_opponent(CHAT_ID, USER_ID)
+    bot.pvp_battle(CHAT_ID, USER_ID, OPPONENT_ID, "p1")
+    bot.cancel_pvp_search(CHAT_ID, USER_ID)
+    bot.record_tournament(
+        CHAT_ID, "swiss", 2, 1, [(1, USER_ID, OPPONENT_ID, USER_ID, 5, 42)], [(CHAT_ID, USER_ID, 40)]
+    )
+
+    bot.add_gold(CHAT_ID, USER_ID, 10)
+    bot.player_cache.flush()
+    bot.get_global_leaderboard(CHAT_ID)
+    bot.get_pvp_leaderboard(CHAT_ID)
+    bot.get_pvp_rank(CHAT_ID, USER_ID)
+    bot.get_dungeon_leaderboard(CHAT_ID)
+    bot.get_player_position(CHAT_ID, USER_ID)
+
+    bot.stale_rows.run()
+
+
+def explain(conn: sqlite3.Connection, statement: str) -> list:
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statement)]
+
+
+def main():
+    verbose = "-v" in sys.argv
+    logging.getLogger("RuneQuestRPG").setLevel(logging.WARNING)
+
+    seed()
+    # Новый пул и кеш: соединения создаются уже с перехватчиком запросов
+    bot._on_statement = capture
+    bot.db_pool.close_all()
+    bot.db_pool = bot.ConnectionPool(bot.DB_PATH, bot.DB_POOL_SIZE)
+    bot.player_cache = bot.PlayerCache(bot.PLAYER_CACHE_SIZE, bot.PLAYER_CACHE_FLUSH_SEC, bot.PLAYER_JOURNAL_PATH)
+    exercise()
+
+    conn = sqlite3.connect(bot.DB_PATH)
+    failures = 0
+    seen = set()
+    for statement in statements:
+        statement = " ".join(statement.split())
+        if statement in seen or statement.upper().startswith(SKIP_PREFIXES):
+            continue
+        seen.add(statement)
+        plan = explain(conn, statement)
+        bad = [step for step in plan if step.startswith(BAD_PLAN_MARKERS)]
+        if bad:
+            failures += 1
+        if bad or verbose:
+            print(("❌ " if bad else "✅ ") + statement[:120])
+            for step in plan:
+                print(f"     {step}")
+    conn.close()
+
+    print(f"Запросов проверено: {len(seen)}, с полным проходом или сортировкой: {failures}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Сводка по двоичному журналу боёв (COMBAT_LOG_DIR).
+
+Журнал читается потоково через bot.read_combat_log, так что память не
+зависит от числа сегментов. По каждому врагу: сколько боёв начато и
+закончено, доля побед, средняя длина боя, средний урон удара и доля
+критов — исходные данные для балансировки.
+
+Запуск:
+    python combat_log_report.py [каталог журнала]
+"""
+
+import os
+import sys
+import time
+import logging
+from collections import defaultdict
+
+os.environ.setdefault("BOT_TOKEN", "report")
+
+import bot  # noqa: E402
+
+
+def summarize(directory: str) -> dict:
+    enemies = defaultdict(lambda: {
+        "started": 0, "victory": 0, "defeat": 0, "escaped": 0,
+        "rounds": 0, "swings": 0, "damage": 0, "crits": 0, "potions": 0,
+    })
+    kinds = defaultdict(int)
+    open_battles = {}  # seed -> враг; удары и итог приходят без enemy_id
+
+    for event in bot.read_combat_log(directory):
+        kinds[event["kind"]] += 1
+        if event["kind"] == "start":
+            open_battles[event["seed"]] = event["enemy_id"]
+            enemies[event["enemy_id"]]["started"] += 1
+            continue
+        enemy_id = open_battles.get(event["seed"])
+        if enemy_id is None:
+            continue
+        row = enemies[enemy_id]
+        if event["kind"] == "swing":
+            row["swings"] += 1
+            row["damage"] += event["damage"]
+            row["crits"] += event["is_crit"]
+        elif event["kind"] == "potion":
+            row["potions"] += 1
+        elif event["kind"] == "result":
+            row[event["outcome"]] += 1
+            row["rounds"] += event["rounds"]
+            del open_battles[event["seed"]]
+
+    return {"kinds": dict(kinds), "enemies": dict(enemies), "unfinished": len(open_battles)}
+
+
+def main():
+    logging.getLogger("RuneQuestRPG").setLevel(logging.WARNING)
+    directory = sys.argv[1] if len(sys.argv) > 1 else bot.COMBAT_LOG_DIR
+    segments = bot.combat_log_segments(directory)
+    if not segments:
+        print(f"В {directory} нет сегментов журнала боёв")
+        sys.exit(1)
+
+    started = time.perf_counter()
+    summary = summarize(directory)
+    elapsed = time.perf_counter() - started
+    events = sum(summary["kinds"].values())
+    size = sum(os.path.getsize(path) for path in segments)
+
+    print(f"Сегментов: {len(segments)}, {size / 1024:.1f} КиБ, событий: {events} за {elapsed:.3f} с")
+    print("  " + ", ".join(f"{kind}: {count}" for kind, count in sorted(summary["kinds"].items())))
+    print(f"  незавершённых боёв: {summary['unfinished']}")
+    print()
+    print(f"{'враг':<16}{'боёв':>7}{'побед':>8}{'раунды':>8}{'удар':>8}{'криты':>8}{'зелья':>7}")
+    for enemy_id, row in sorted(summary["enemies"].items(), key=lambda item: -item[1]["started"]):
+        finished = row["victory"] + row["defeat"] + row["escaped"]
+        name = bot.ENEMIES.get(enemy_id, {}).get("name", enemy_id)
+        print(
+            f"{name[:15]:<16}{row['started']:>7}"
+            f"{row['victory'] / finished if finished else 0:>8.1%}"
+            f"{row['rounds'] / finished if finished else 0:>8.1f}"
+            f"{row['damage'] / row['swings'] if row['swings'] else 0:>8.0f}"
+            f"{row['crits'] / row['swings'] if row['swings'] else 0:>8.1%}"
+            f"{row['potions']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
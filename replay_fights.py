@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Детерминированное воспроизведение боёв.
+
+Каждый бой хранит seed и строку действий, поэтому replay_fight переигрывает
+его без хранилища и без Telegram. Скрипт умеет:
+
+    python replay_fights.py record [кол-во боёв] [файл.jsonl] [--seed=N]
+        провести бои через живые функции бота (MemoryStorage) и сохранить
+        записи боёв в JSONL;
+    python replay_fights.py check <файл.jsonl>
+        переиграть записанные бои текущим кодом и сравнить исходы — так
+        изменения боевой формулы проверяются на тысячах реальных боёв;
+    python replay_fights.py [кол-во боёв]
+        записать и сразу переиграть (самопроверка движка).
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+
+os.environ.setdefault("BOT_TOKEN", "replay")
+os.environ["STORAGE_BACKEND"] = "memory"
+
+import bot  # noqa: E402
+
+CHAT_ID = 1
+COMPARED = ("outcome", "enemy_hp", "player_hp", "loot")
+
+
+def record_fights(fights: int, seed: int) -> list:
+    """Проводит fights боёв живыми функциями бота; одинаковый seed — одинаковые бои"""
+    random.seed(seed)
+    policy = random.Random(seed)
+    bot.storage = bot.MemoryStorage()
+    bot.player_cache = bot.PlayerCache(bot.PLAYER_CACHE_SIZE, 3600, os.devnull)
+    bot.stat_profiles.clear()
+    bot.battle_store = bot.BattleStore(bot.BATTLE_IDLE_TTL_SEC, bot.BATTLE_CHECKPOINT_SEC)
+    bot.battle_store.rehydrated = True
+    bot.fight_records.clear()
+
+    players = []
+    for user_id, player_class in enumerate(bot.CLASSES, 1):
+        bot.init_player(CHAT_ID, user_id, f"p{user_id}", player_class)
+        bot.add_item(CHAT_ID, user_id, "health_potion", fights)
+        players.append(user_id)
+
+    recorded = []
+    while len(recorded) < fights:
+        user_id = policy.choice(players)
+        player = bot.get_player(CHAT_ID, user_id)
+        locations = [
+            loc_id for loc_id, loc in bot.LOCATIONS.items()
+            if loc["min_level"] <= player["level"] <= loc["max_level"] + 10
+        ]
+        if policy.random() < 0.15:
+            bot.start_dungeon(CHAT_ID, user_id)
+        else:
+            bot.start_battle(CHAT_ID, user_id, policy.choice(locations))
+
+        if policy.random() < 0.1:
+            bot.auto_battle(CHAT_ID, user_id, f"p{user_id}")
+        while bot.get_active_battle(CHAT_ID, user_id):
+            player = bot.get_player(CHAT_ID, user_id)
+            if player["health"] < player["max_health"] * 0.3 and policy.random() < 0.7:
+                bot.use_battle_potion(CHAT_ID, user_id)
+            elif policy.random() < 0.03:
+                bot.attempt_escape(CHAT_ID, user_id)
+            else:
+                bot.perform_attack(CHAT_ID, user_id, f"p{user_id}")
+
+        # Подземелье после боя остаётся открытым — закрываем, чтобы войти снова
+        bot.storage.save_dungeon(CHAT_ID, user_id, current_floor=1, is_active=0)
+        recorded.extend(bot.fight_records)
+        bot.fight_records.clear()
+    return recorded[:fights]
+
+
+def check_fights(records: list) -> int:
+    started = time.perf_counter()
+    mismatches = 0
+    for record in records:
+        replayed = bot.replay_fight(record)
+        if any(replayed[key] != record[key] for key in COMPARED):
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"❌ seed={record['seed']} actions={record['actions']}")
+                print(f"   записано:    {[record[key] for key in COMPARED]}")
+                print(f"   переиграно:  {[replayed[key] for key in COMPARED]}")
+    elapsed = time.perf_counter() - started
+    turns = sum(len(record["actions"]) for record in records)
+    print(
+        f"Переиграно боёв: {len(records)} ({turns} ходов) за {elapsed:.3f} с "
+        f"({len(records) / elapsed:,.0f} боёв/с), расхождений: {mismatches}"
+    )
+    return mismatches
+
+
+def main():
+    logging.getLogger("RuneQuestRPG").setLevel(logging.WARNING)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--seed")]
+    seed = 42
+    for arg in sys.argv[1:]:
+        if arg.startswith("--seed"):
+            seed = int(arg.split("=", 1)[1])
+
+    if args and args[0] == "check":
+        with open(args[1], encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        sys.exit(1 if check_fights(records) else 0)
+
+    if args and args[0] == "record":
+        fights = int(args[1]) if len(args) > 1 else 2000
+        path = args[2] if len(args) > 2 else "fights.jsonl"
+        records = record_fights(fights, seed)
+        with open(path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"Записано боёв: {len(records)} → {path}")
+        return
+
+    fights = int(args[0]) if args else 2000
+    started = time.perf_counter()
+    records = record_fights(fights, seed)
+    print(f"Проведено боёв: {len(records)} за {time.perf_counter() - started:.3f} с")
+    sys.exit(1 if check_fights(records) else 0)
+
+
+if __name__ == "__main__":
+    main()
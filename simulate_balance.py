@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+Монте-Карло симулятор боёв для настройки баланса (офлайн, нужен numpy).
+
+calculate_damage и compile_stat_profile переписаны как векторные
+ядра NumPy: тысячи боёв идут параллельно, раунд за раундом, по тем же
+правилам, что perform_attack (охота и подземелье) и pvp_battle.
+Случайные величины берутся из генератора NumPy, а не из random, поэтому
+конкретные бои не совпадают с ботом, но формулы — совпадают: режим check
+прогоняет живые функции бота на тех же случайных величинах и требует
+полного совпадения результатов (то же проверяет tests/test_simulate_balance.py).
+
+Запуск:
+    pip install -r requirements-dev.txt
+    python simulate_balance.py hunt [--location dark_forest] [--level 5] [--fights 1000000]
+    python simulate_balance.py dungeon [--level 20] [--runs 100000]
+    python simulate_balance.py pvp [--level 10] [--fights 1000000]
+    python simulate_balance.py check
+"""
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import logging
+from typing import Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("Для симулятора нужен numpy: pip install -r requirements-dev.txt")
+
+os.environ.setdefault("BOT_TOKEN", "simulate")
+
+import bot  # noqa: E402
+
+MAX_ROUNDS = 500
+
+
+# ===================== ЯДРА =====================
+
+def damage_kernel(attack, defense, crit_chance, spell_power, variation, spell_roll, crit_roll):
+    """calculate_damage для массивов.
+
+    variation ~ U(0.85, 1.15), spell_roll ~ U(0.8, 1.2), crit_roll ~ целое 1..100 —
+    те же величины, что живая функция берёт из random.
+    """
+    base = np.maximum(1, attack - defense // 2)
+    damage = np.floor(base * variation).astype(np.int64)
+    damage += np.where(spell_power > 0, np.floor(spell_power * spell_roll), 0).astype(np.int64)
+    is_crit = crit_roll <= crit_chance
+    damage = np.where(is_crit, np.floor(damage * 1.5).astype(np.int64), damage)
+    return np.maximum(1, damage), is_crit
+
+
+def draw_damage_rolls(rng: "np.random.Generator", n: int):
+    return (
+        rng.uniform(0.85, 1.15, n),
+        rng.uniform(0.8, 1.2, n),
+        rng.integers(1, 101, n),
+    )
+
+
+class Loadout:
+    """Таблицы бонусов снаряжения: индекс в массиве вместо поиска в словарях"""
+
+    def __init__(self):
+        self.weapons = [None] + list(bot.WEAPONS)
+        self.armors = [None] + list(bot.ARMOR)
+        self.pets = [None] + list(bot.PETS)
+        self.runes = [None] + list(bot.RUNES)
+        self.weapon_attack = np.array([0] + [w["attack"] for w in bot.WEAPONS.values()])
+        self.weapon_crit = np.array([0] + [w["crit"] for w in bot.WEAPONS.values()])
+        self.armor_defense = np.array([0] + [a["defense"] for a in bot.ARMOR.values()])
+        self.pet_attack = np.array([0] + [p["attack_bonus"] for p in bot.PETS.values()])
+        self.pet_defense = np.array([0] + [p["defense_bonus"] for p in bot.PETS.values()])
+        self.rune_attack = np.array([0] + [r["attack_bonus"] for r in bot.RUNES.values()])
+        self.rune_defense = np.array([0] + [r["defense_bonus"] for r in bot.RUNES.values()])
+        self.rune_crit = np.array([0] + [r["crit_bonus"] for r in bot.RUNES.values()])
+
+
+LOADOUT = Loadout()
+
+
+def battle_stats_kernel(classes, attack, defense, weapon_idx, armor_idx, pet_idx, rune_idx=0):
+    """compile_stat_profile для массивов игроков; *_idx — индексы в Loadout (0 = пусто)"""
+    class_crit = np.array([bot.CLASSES[c].get("crit_chance", 5) for c in classes])
+    class_spell = np.array([bot.CLASSES[c].get("spell_power", 0) for c in classes])
+    return {
+        "attack": attack + LOADOUT.weapon_attack[weapon_idx] + LOADOUT.pet_attack[pet_idx] + LOADOUT.rune_attack[rune_idx],
+        "defense": defense + LOADOUT.armor_defense[armor_idx] + LOADOUT.pet_defense[pet_idx] + LOADOUT.rune_defense[rune_idx],
+        "crit_chance": class_crit + LOADOUT.weapon_crit[weapon_idx] + LOADOUT.rune_crit[rune_idx],
+        "spell_power": class_spell,
+    }
+
+
+def player_at_level(player_class: str, level: int) -> dict:
+    """Базовые статы персонажа на уровне level — как их накапливает add_xp"""
+    info = bot.CLASSES[player_class]
+    gained = level - 1
+    return {
+        "class": player_class,
+        "level": level,
+        "max_health": info["health"] + bot.STATS_PER_LEVEL["health"] * gained,
+        "attack": info["attack"] + bot.STATS_PER_LEVEL["attack"] * gained,
+        "defense": info["defense"] + bot.STATS_PER_LEVEL["defense"] * gained,
+    }
+
+
+def loadout_index(weapon, armor, pet, rune=None):
+    return (
+        LOADOUT.weapons.index(weapon),
+        LOADOUT.armors.index(armor),
+        LOADOUT.pets.index(pet),
+        LOADOUT.runes.index(rune),
+    )
+
+
+def fight_kernel(rng, stats, player_hp, player_defense, enemy_hp, enemy_damage):
+    """Раунды perform_attack до конца боя для n боёв сразу.
+
+    Игрок бьёт без учёта защиты врага, враг отвечает по базовой защите игрока
+    с критом 5% — как в perform_attack. Возвращает (победа, раунды, остаток HP).
+    """
+    n = len(enemy_hp)
+    enemy_hp = enemy_hp.copy()
+    player_hp = np.broadcast_to(player_hp, (n,)).copy()
+    rounds = np.zeros(n, dtype=np.int64)
+    active = np.ones(n, dtype=bool)
+    won = np.zeros(n, dtype=bool)
+    zeros = np.zeros(n, dtype=np.int64)
+
+    for _ in range(MAX_ROUNDS):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        k = idx.size
+        rounds[idx] += 1
+
+        dmg, _ = damage_kernel(
+            stats["attack"], zeros[:k], stats["crit_chance"], stats["spell_power"],
+            *draw_damage_rolls(rng, k),
+        )
+        enemy_hp[idx] -= dmg
+        killed = enemy_hp[idx] <= 0
+        won[idx[killed]] = True
+        active[idx[killed]] = False
+
+        idx = idx[~killed]
+        k = idx.size
+        variation, spell_roll, crit_roll = draw_damage_rolls(rng, k)
+        counter, _ = damage_kernel(enemy_damage[idx], player_defense, 5, 0, variation, spell_roll, crit_roll)
+        player_hp[idx] -= counter
+        dead = player_hp[idx] <= 0
+        active[idx[dead]] = False
+
+    return won, rounds, np.maximum(player_hp, 0)
+
+
+class EnemyTable:
+    """Столбцы ENEMIES для набора врагов: выбор врага — индекс в массивах"""
+
+    def __init__(self, enemy_ids, pet=None):
+        enemies = [bot.ENEMIES[e] for e in enemy_ids]
+        self.hp = np.array([e["hp"] for e in enemies])
+        self.damage = np.array([e["damage"] for e in enemies])
+        self.level = np.array([e["level"] for e in enemies])
+        self.gold = np.array([e.get("gold", 0) for e in enemies])
+        if pet in bot.PETS:
+            self.xp = np.array([int(e.get("xp", 0) * bot.PETS[pet]["xp_bonus"]) for e in enemies])
+        else:
+            self.xp = np.array([e.get("xp", 0) for e in enemies])
+
+    def scaled(self, idx, scale):
+        """HP и урон врагов с множителем, как int(hp * scale) в start_battle"""
+        return (
+            np.floor(self.hp[idx] * scale).astype(np.int64),
+            np.floor(self.damage[idx] * scale).astype(np.int64),
+        )
+
+
+# ===================== СЦЕНАРИИ =====================
+
+def simulate_hunt(rng, player_class, level, location_id, weapon, armor, pet, fights, rune=None):
+    player = player_at_level(player_class, level)
+    stats = battle_stats_kernel([player_class], player["attack"], player["defense"], *loadout_index(weapon, armor, pet, rune))
+
+    table = EnemyTable(bot.LOCATIONS[location_id]["enemies"], pet)
+    idx = rng.integers(0, len(table.hp), fights)
+    scale = 1.0 + np.maximum(1, level - table.level[idx]) * 0.12
+    enemy_hp, enemy_damage = table.scaled(idx, scale)
+
+    won, rounds, _ = fight_kernel(rng, stats, player["max_health"], player["defense"], enemy_hp, enemy_damage)
+    return summarize(won, rounds, table.xp[idx], table.gold[idx])
+
+
+def simulate_dungeon(rng, player_class, level, weapon, armor, pet, runs, rune=None):
+    """Забеги с переносом HP между этажами: враги по весам плана generate_dungeon_run"""
+    player = player_at_level(player_class, level)
+    stats = battle_stats_kernel([player_class], player["attack"], player["defense"], *loadout_index(weapon, armor, pet, rune))
+    table = EnemyTable(list(bot.ENEMIES), pet)
+    enemy_index = {enemy_id: i for i, enemy_id in enumerate(bot.ENEMIES)}
+
+    hp = np.full(runs, player["max_health"], dtype=np.int64)
+    depth = np.zeros(runs, dtype=np.int64)
+    alive = np.ones(runs, dtype=bool)
+    floor_win_rate = []
+    for floor in range(1, bot.DUNGEON_RUN_FLOORS + 1):
+        idx = np.flatnonzero(alive)
+        if idx.size == 0:
+            break
+        pool, cum_weights = bot.DUNGEON_FLOOR_POOLS[floor]
+        weights = np.diff(np.concatenate(([0.0], cum_weights)))
+        picks = rng.choice([enemy_index[enemy_id] for enemy_id in pool], size=idx.size, p=weights / weights.sum())
+        enemy_hp, enemy_damage = table.scaled(picks, bot.DUNGEON_FLOOR_SCALE[floor])
+        won, _, left = fight_kernel(rng, stats, hp[idx], player["defense"], enemy_hp, enemy_damage)
+        hp[idx] = left
+        depth[idx[won]] = floor
+        alive[idx[~won]] = False
+        floor_win_rate.append((floor, won.mean(), idx.size))
+
+    return {
+        "runs": runs,
+        "avg_depth": depth.mean(),
+        "median_depth": float(np.median(depth)),
+        "max_depth": int(depth.max()),
+        "floors": floor_win_rate,
+    }
+
+
+def simulate_pvp(rng, class_a, class_b, level, fights, loadout_a=(None, None, "wolf"), loadout_b=(None, None, "wolf")):
+    """Одна размена ударами, как в pvp_battle: кто нанёс больше — победил"""
+    a = player_at_level(class_a, level)
+    b = player_at_level(class_b, level)
+    stats_a = battle_stats_kernel([class_a], a["attack"], a["defense"], *loadout_index(*loadout_a))
+    stats_b = battle_stats_kernel([class_b], b["attack"], b["defense"], *loadout_index(*loadout_b))
+
+    dmg_a, _ = damage_kernel(
+        stats_a["attack"], stats_b["defense"], stats_a["crit_chance"], stats_a["spell_power"],
+        *draw_damage_rolls(rng, fights),
+    )
+    b_hp = b["max_health"] - dmg_a
+    dmg_b, _ = damage_kernel(
+        stats_b["attack"], stats_a["defense"], stats_b["crit_chance"], stats_b["spell_power"],
+        *draw_damage_rolls(rng, fights),
+    )
+    dmg_b = np.where(b_hp <= 0, 0, dmg_b)
+    a_hp = a["max_health"] - dmg_b
+
+    a_wins = (b_hp <= 0) | ((a_hp > 0) & (b_hp < a_hp))
+    return {"fights": fights, "win_rate_a": a_wins.mean(), "avg_damage_a": dmg_a.mean(), "avg_damage_b": dmg_b.mean()}
+
+
+def summarize(won, rounds, xp, gold) -> dict:
+    wins = won.sum()
+    return {
+        "fights": len(won),
+        "win_rate": won.mean(),
+        "avg_ttk": rounds[won].mean() if wins else float("nan"),
+        "xp_per_fight": (xp * won).mean(),
+        "gold_per_fight": (gold * won).mean(),
+    }
+
+
+# ===================== СВЕРКА С БОТОМ =====================
+
+class ReplayRandom:
+    """Подменяет модуль random в боте: отдаёт заранее вытянутые величины"""
+
+    def __init__(self, variation, spell_roll, crit_roll, spell_power):
+        self._values = []
+        for v, s, c, sp in zip(variation, spell_roll, crit_roll, spell_power):
+            self._values.append(float(v))
+            if sp > 0:
+                self._values.append(float(s))
+            self._values.append(int(c))
+        self._values.reverse()
+
+    def uniform(self, a, b):
+        return self._values.pop()
+
+    def randint(self, a, b):
+        return self._values.pop()
+
+
+def damage_mismatches(samples: int, seed: int = 12345) -> int:
+    """calculate_damage на случайных входах против damage_kernel"""
+    rng = np.random.default_rng(seed)
+    attack = rng.integers(1, 400, samples)
+    defense = rng.integers(0, 300, samples)
+    crit = rng.integers(0, 60, samples)
+    spell = np.where(rng.random(samples) < 0.5, 0, rng.integers(1, 80, samples))
+    variation, spell_roll, crit_roll = draw_damage_rolls(rng, samples)
+    vec_damage, vec_crit = damage_kernel(attack, defense, crit, spell, variation, spell_roll, crit_roll)
+
+    live_random = bot.random
+    bot.random = ReplayRandom(variation, spell_roll, crit_roll, spell)
+    try:
+        live = [
+            bot.calculate_damage(int(attack[i]), int(defense[i]), int(crit[i]), int(spell[i]))
+            for i in range(samples)
+        ]
+    finally:
+        bot.random = live_random
+    return sum(
+        1 for i, (d, c) in enumerate(live) if d != vec_damage[i] or c != bool(vec_crit[i])
+    )
+
+
+def stat_profile_mismatches() -> Tuple[int, int]:
+    """compile_stat_profile на всех сочетаниях класса, снаряжения и руны: (расхождений, сочетаний)"""
+    combos = list(itertools.product(bot.CLASSES, LOADOUT.weapons, LOADOUT.armors, LOADOUT.pets, LOADOUT.runes))
+    mismatches = 0
+    for player_class, weapon, armor, pet, rune in combos:
+        base = player_at_level(player_class, 10)
+        live_stats = bot.compile_stat_profile(
+            {
+                "class": player_class,
+                "attack": base["attack"],
+                "defense": base["defense"],
+                "equipped_weapon": weapon,
+                "equipped_armor": armor,
+                "pet_id": pet,
+                "equipped_rune": rune,
+            }
+        ).as_dict()
+        vec_stats = battle_stats_kernel(
+            [player_class], base["attack"], base["defense"], *loadout_index(weapon, armor, pet, rune)
+        )
+        if any(int(np.asarray(vec_stats[k]).item()) != v for k, v in live_stats.items()):
+            mismatches += 1
+    return mismatches, len(combos)
+
+
+def check(samples: int = 200000) -> bool:
+    damage = damage_mismatches(samples)
+    print(f"calculate_damage: {samples} выборок, расхождений: {damage}")
+    profiles, combos = stat_profile_mismatches()
+    print(f"compile_stat_profile: {combos} сочетаний, расхождений: {profiles}")
+    return damage == 0 and profiles == 0
+
+
+# ===================== CLI =====================
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(x).ljust(w) for x, w in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Монте-Карло симулятор баланса RuneQuestRPG")
+    parser.add_argument("mode", choices=["hunt", "dungeon", "pvp", "check"])
+    parser.add_argument("--class", dest="player_class", choices=list(bot.CLASSES))
+    parser.add_argument("--level", type=int, default=5)
+    parser.add_argument("--location", choices=list(bot.LOCATIONS))
+    parser.add_argument("--weapon", choices=list(bot.WEAPONS))
+    parser.add_argument("--armor", choices=list(bot.ARMOR))
+    parser.add_argument("--pet", choices=list(bot.PETS), default="wolf")
+    parser.add_argument("--rune", choices=list(bot.RUNES))
+    parser.add_argument("--fights", type=int, default=1_000_000)
+    parser.add_argument("--runs", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    logging.getLogger("RuneQuestRPG").setLevel(logging.WARNING)
+
+    if args.mode == "check":
+        sys.exit(0 if check() else 1)
+
+    rng = np.random.default_rng(args.seed)
+    classes = [args.player_class] if args.player_class else list(bot.CLASSES)
+    started = time.perf_counter()
+    simulated = 0
+
+    if args.mode == "hunt":
+        locations = [args.location] if args.location else list(bot.LOCATIONS)
+        rows = []
+        for location_id, player_class in itertools.product(locations, classes):
+            r = simulate_hunt(rng, player_class, args.level, location_id, args.weapon, args.armor, args.pet, args.fights, args.rune)
+            simulated += r["fights"]
+            rows.append([
+                location_id, player_class, f"{r['win_rate']:.1%}", f"{r['avg_ttk']:.2f}",
+                f"{r['xp_per_fight']:.1f}", f"{r['gold_per_fight']:.1f}",
+            ])
+        print_table(["локация", "класс", "победы", "раундов", "XP/бой", "золото/бой"], rows)
+
+    elif args.mode == "dungeon":
+        rows = []
+        for player_class in classes:
+            r = simulate_dungeon(rng, player_class, args.level, args.weapon, args.armor, args.pet, args.runs, args.rune)
+            simulated += sum(n for _, _, n in r["floors"])
+            first = ", ".join(f"{f}:{rate:.0%}" for f, rate, _ in r["floors"][:5])
+            rows.append([player_class, f"{r['avg_depth']:.2f}", r["median_depth"], r["max_depth"], first])
+        print_table(["класс", "ср. глубина", "медиана", "макс", "победы по этажам"], rows)
+
+    else:
+        rows = []
+        for class_a, class_b in itertools.product(classes, list(bot.CLASSES)):
+            r = simulate_pvp(rng, class_a, class_b, args.level, args.fights)
+            simulated += r["fights"]
+            rows.append([class_a, class_b, f"{r['win_rate_a']:.1%}", f"{r['avg_damage_a']:.1f}", f"{r['avg_damage_b']:.1f}"])
+        print_table(["атакующий", "защитник", "победы", "урон", "ответный урон"], rows)
+
+    elapsed = time.perf_counter() - started
+    print(f"\n{simulated} боёв за {elapsed:.2f} с ({simulated / elapsed:,.0f} боёв/с)")
+
+
+if __name__ == "__main__":
+    main()
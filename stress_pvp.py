@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочная проверка боёв ПВП на гонки.
+
+Защитники встают в очередь арены, затем нападающие одновременно жмут
+«⚔️ В БОЙ!» (cb_pvp_fight) — в том числе по одному защитнику по
+нескольку раз. Прогон идёт трижды: каждая запись своей транзакцией в
+потоках DBExecutor, через писателя с group commit и снова транзакциями, но
+без захвата в памяти матчмейкера — как если бы у каждого процесса был свой
+матчмейкер, и дубли отсекал только claim_pvp_opponent в SQLite. После
+прогона проверяются инварианты:
+
+    каждый защитник побывал в бою не больше одного раза;
+    побед + поражений ровно вдвое больше, чем записей pvp_battles;
+    золото и рейтинг только переходят от проигравшего к победителю;
+    в очереди не осталось никого, с кем уже сразились.
+
+Запуск:
+    python stress_pvp.py [защитников] [нажатий на защитника]
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "stress")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="rq_stress_"), "stress.db")
+
+import bot  # noqa: E402
+
+CHAT_ID = 1
+START_GOLD = 1000
+
+
+class FakeQuery:
+    """Минимальный CallbackQuery: ответы складываются в список"""
+
+    def __init__(self, data: str, user_id: int):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id, username=f"p{user_id}", first_name=f"p{user_id}")
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID))
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        self.answers.append(text)
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        self.edits.append(text)
+
+
+def seed(first_id: int, defenders: int, attackers: int):
+    players = list(range(first_id, first_id + defenders + attackers))
+    for user_id in players:
+        bot.init_player(CHAT_ID, user_id, f"p{user_id}", random.choice(list(bot.CLASSES)))
+        bot.player_cache.set(CHAT_ID, user_id, gold=START_GOLD, level=random.randint(1, 20))
+    for user_id in players[:defenders]:
+        player = bot.get_player(CHAT_ID, user_id)
+        bot.db_writer.call(bot.add_pvp_queue, CHAT_ID, user_id, bot.pvp_rating(player))
+    bot.player_cache.flush()
+    return players[:defenders], players[defenders:]
+
+
+async def fire(defenders: list, attackers: list, presses: int) -> list:
+    queries = [
+        FakeQuery(f"pvp_fight_{defender_id}", random.choice(attackers))
+        for defender_id in defenders
+        for _ in range(presses)
+    ]
+    random.shuffle(queries)
+    await asyncio.gather(*(
+        bot.cb_pvp_fight(SimpleNamespace(callback_query=query), None) for query in queries
+    ))
+    return queries
+
+
+def check(defenders: list, attackers: list, queries: list, matchmaker: bool = True) -> list:
+    bot.player_cache.flush()
+    players = defenders + attackers
+    marks = ", ".join("?" for _ in players)
+    with bot.db_connection() as conn:
+        battles = conn.execute(
+            f"SELECT defender_id, COUNT(*) FROM pvp_battles WHERE defender_id IN ({marks}) GROUP BY defender_id",
+            players,
+        ).fetchall()
+        totals = conn.execute(
+            f"SELECT SUM(pvp_wins + pvp_losses), SUM(gold) FROM players WHERE user_id IN ({marks})",
+            players,
+        ).fetchone()
+        queued = {row[0] for row in conn.execute(f"SELECT user_id FROM pvp_queue WHERE user_id IN ({marks})", players)}
+
+    fought = {defender_id for defender_id, _ in battles}
+    won = sum(1 for query in queries if query.edits)
+    rejected = sum(1 for query in queries if query.answers)
+    # До первого боя рейтинг выводится из уровня; Эло только перекладывает очки
+    mmr_drift = 0
+    for user_id in players:
+        player = bot.get_player(CHAT_ID, user_id)
+        if player["mmr"] is not None:
+            mmr_drift += player["mmr"] - bot.PVP_MMR_START - (player["level"] - 1) * bot.PVP_MMR_PER_LEVEL
+
+    errors = []
+    if any(count > 1 for _, count in battles):
+        errors.append(f"защитник в нескольких боях: {[tuple(row) for row in battles if row[1] > 1][:5]}")
+    if won != len(fought) or won + rejected != len(queries):
+        errors.append(f"боёв {won}, отказов {rejected}, нажатий {len(queries)}, защитников в боях {len(fought)}")
+    if (totals[0] or 0) != 2 * won:
+        errors.append(f"побед + поражений {totals[0]}, ожидалось {2 * won}")
+    if totals[1] != START_GOLD * len(players):
+        errors.append(f"золото {totals[1]}, ожидалось {START_GOLD * len(players)}")
+    if mmr_drift:
+        errors.append(f"сумма изменений MMR {mmr_drift}, ожидалось 0")
+    if queued & fought:
+        errors.append(f"в очереди остались сразившиеся: {sorted(queued & fought)[:5]}")
+    if matchmaker and any(bot.pvp_matchmaker.waiting(user_id) for user_id in fought):
+        errors.append("матчмейкер держит сразившихся")
+    return errors
+
+
+def run(
+    label: str, first_id: int, defenders: int, presses: int, via_writer: bool, sql_claim_only: bool = False
+) -> bool:
+    defender_ids, attacker_ids = seed(first_id, defenders, max(2, defenders // 2))
+    if via_writer:
+        bot.db_writer.start()
+    if sql_claim_only:
+        # Матчмейкер этого «процесса» всегда считает защитника свободным
+        bot.pvp_matchmaker.claim = lambda user_id: {"user_id": user_id, "joined": time.monotonic()}
+    started = time.perf_counter()
+    try:
+        queries = asyncio.run(fire(defender_ids, attacker_ids, presses))
+    finally:
+        if sql_claim_only:
+            del bot.pvp_matchmaker.claim
+    elapsed = time.perf_counter() - started
+    if via_writer:
+        bot.db_writer.close()
+
+    # Без захвата в памяти матчмейкер держит всех защитников — его здесь не проверяем
+    errors = check(defender_ids, attacker_ids, queries, matchmaker=not sql_claim_only)
+    print(
+        f"{label}: {len(queries)} нажатий за {elapsed:.3f} с "
+        f"({len(queries) / elapsed:,.0f}/с), боёв {sum(1 for q in queries if q.edits)}"
+    )
+    for error in errors:
+        print(f"  ❌ {error}")
+    return not errors
+
+
+def main():
+    defenders = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    presses = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    # Очередь на BEGIN IMMEDIATE здесь нарочная — предупреждения о медленных вызовах не нужны
+    logging.getLogger("RuneQuestRPG").setLevel(logging.ERROR)
+    random.seed(42)
+
+    bot.migrate_database()
+    ok = run("транзакция на бой", 1, defenders, presses, via_writer=False)
+    ok = run("писатель + group commit", 1_000_000, defenders, presses, via_writer=True) and ok
+    ok = run("только захват в SQLite", 2_000_000, defenders, presses, via_writer=False, sql_claim_only=True) and ok
+    print(f"  {bot.pvp_matchmaker.stats()}")
+    bot.player_cache.close()
+    bot.db_executor.shutdown()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""Общая настройка: бот импортируется из корня репозитория с временной базой"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("BOT_TOKEN", "tests")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="rq_tests_"), "tests.db"))
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""Векторные ядра симулятора баланса считают ровно так же, как бот"""
+
+import simulate_balance
+
+
+def test_damage_kernel_matches_calculate_damage():
+    assert simulate_balance.damage_mismatches(50000) == 0
+
+
+def test_damage_kernel_matches_calculate_damage_other_seed():
+    assert simulate_balance.damage_mismatches(50000, seed=2024) == 0
+
+
+def test_stat_profile_kernel_matches_compile_stat_profile():
+    mismatches, combos = simulate_balance.stat_profile_mismatches()
+    assert combos > 0
+    assert mismatches == 0